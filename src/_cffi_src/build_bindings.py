@@ -83,6 +83,111 @@ const SECURITY_INFORMATION WFSPY_GROUP_SECURITY_INFORMATION = GROUP_SECURITY_INF
 const SECURITY_INFORMATION WFSPY_DACL_SECURITY_INFORMATION = DACL_SECURITY_INFORMATION;
 const SECURITY_INFORMATION WFSPY_SACL_SECURITY_INFORMATION = SACL_SECURITY_INFORMATION;
 
+// Maximum size (in bytes) of a file name in a FSP_FSCTL_DIR_INFO (i.e. 255 WCHAR)
+#define _WFSPY_DIR_INFO_FILE_NAME_SIZEMAX (255 * sizeof(WCHAR))
+const UINT32 WFSPY_DIR_INFO_FILE_NAME_SIZEMAX = _WFSPY_DIR_INFO_FILE_NAME_SIZEMAX;
+
+
+// Building FSP_FSCTL_DIR_INFO entries one by one from Python is costly, hence
+// those helpers taking a whole batch of entries in a single call.
+// `file_infos` is an array of `count` FSP_FSCTL_FILE_INFO, the UTF-16 name of
+// the i-th entry being stored in `file_names` between `name_offsets[i]` and
+// `name_offsets[i + 1]` (so `name_offsets` contains `count + 1` items).
+typedef union {
+    FSP_FSCTL_DIR_INFO V;
+    UINT8 B[sizeof(FSP_FSCTL_DIR_INFO) + _WFSPY_DIR_INFO_FILE_NAME_SIZEMAX];
+} WFSPY_DIR_INFO_BUF;
+
+static BOOLEAN build_FSP_FSCTL_DIR_INFO(
+    WFSPY_DIR_INFO_BUF *DirInfoBuf,
+    const FSP_FSCTL_FILE_INFO *file_infos,
+    const UINT8 *file_names,
+    const UINT32 *name_offsets,
+    ULONG index
+) {
+    UINT32 name_size = name_offsets[index + 1] - name_offsets[index];
+    if (name_size > _WFSPY_DIR_INFO_FILE_NAME_SIZEMAX)
+        return FALSE;
+    memset(&DirInfoBuf->V, 0, sizeof(FSP_FSCTL_DIR_INFO));
+    DirInfoBuf->V.Size = (UINT16)(sizeof(FSP_FSCTL_DIR_INFO) + name_size);
+    DirInfoBuf->V.FileInfo = file_infos[index];
+    memcpy(DirInfoBuf->V.FileNameBuf, file_names + name_offsets[index], name_size);
+    return TRUE;
+}
+
+// Returns the number of entries that fit in the transfer buffer
+ULONG add_FSP_FSCTL_DIR_INFO_batch(
+    const FSP_FSCTL_FILE_INFO *file_infos,
+    const UINT8 *file_names,
+    const UINT32 *name_offsets,
+    ULONG count,
+    PVOID Buffer,
+    ULONG Length,
+    PULONG PBytesTransferred
+) {
+    WFSPY_DIR_INFO_BUF DirInfoBuf;
+    ULONG i;
+    for (i = 0; i < count; i++) {
+        if (!build_FSP_FSCTL_DIR_INFO(&DirInfoBuf, file_infos, file_names, name_offsets, i))
+            break;
+        if (!FspFileSystemAddDirInfo(&DirInfoBuf.V, Buffer, Length, PBytesTransferred))
+            break;
+    }
+    return i;
+}
+
+// Returns the number of entries added to the directory buffer
+ULONG fill_FSP_FSCTL_DIR_INFO_batch(
+    const FSP_FSCTL_FILE_INFO *file_infos,
+    const UINT8 *file_names,
+    const UINT32 *name_offsets,
+    ULONG count,
+    PVOID *PDirBuffer,
+    PNTSTATUS PResult
+) {
+    WFSPY_DIR_INFO_BUF DirInfoBuf;
+    ULONG i;
+    for (i = 0; i < count; i++) {
+        if (!build_FSP_FSCTL_DIR_INFO(&DirInfoBuf, file_infos, file_names, name_offsets, i))
+            break;
+        if (!FspFileSystemFillDirectoryBuffer(PDirBuffer, &DirInfoBuf.V, PResult))
+            break;
+    }
+    return i;
+}
+
+
+// FSP_FSCTL_TRANSACT_REQ/RSP are opaque for CFFI, hence those helpers for the
+// asynchronous operations (i.e. returning STATUS_PENDING): the identity of the
+// request is saved when the operation starts, then used to build the response
+// sent once the operation is completed.
+void get_FSP_FSCTL_TRANSACT_REQ_identity(UINT32 *PKind, UINT64 *PHint)
+{
+    FSP_FSCTL_TRANSACT_REQ *Request = FspFileSystemGetOperationContext()->Request;
+    *PKind = Request->Kind;
+    *PHint = Request->Hint;
+}
+
+void send_FSP_FSCTL_TRANSACT_RSP(
+    FSP_FILE_SYSTEM *FileSystem,
+    UINT32 Kind,
+    UINT64 Hint,
+    NTSTATUS Status,
+    UINT32 Information,
+    const FSP_FSCTL_FILE_INFO *FileInfo
+) {
+    FSP_FSCTL_TRANSACT_RSP Response;
+    memset(&Response, 0, sizeof Response);
+    Response.Size = sizeof Response;
+    Response.Kind = Kind;
+    Response.Hint = Hint;
+    Response.IoStatus.Status = Status;
+    Response.IoStatus.Information = Information;
+    if (FspFsctlTransactWriteKind == Kind && NULL != FileInfo)
+        memcpy(&Response.Rsp.Write.FileInfo, FileInfo, sizeof *FileInfo);
+    FspFileSystemSendResponse(FileSystem, &Response);
+}
+
 
 // Bitfields are not handled with CFFI, hence this big hack...
 void configure_FSP_FSCTL_VOLUME_PARAMS(
@@ -281,6 +386,38 @@ void configure_FSP_FSCTL_VOLUME_PARAMS(
 );
 
 
+// Batched FSP_FSCTL_DIR_INFO helpers
+ULONG add_FSP_FSCTL_DIR_INFO_batch(
+    const FSP_FSCTL_FILE_INFO * file_infos,
+    const UINT8 * file_names,
+    const UINT32 * name_offsets,
+    ULONG count,
+    PVOID Buffer,
+    ULONG Length,
+    PULONG PBytesTransferred
+);
+ULONG fill_FSP_FSCTL_DIR_INFO_batch(
+    const FSP_FSCTL_FILE_INFO * file_infos,
+    const UINT8 * file_names,
+    const UINT32 * name_offsets,
+    ULONG count,
+    PVOID * PDirBuffer,
+    PNTSTATUS PResult
+);
+
+
+// Asynchronous operations helpers
+void get_FSP_FSCTL_TRANSACT_REQ_identity(UINT32 * PKind, UINT64 * PHint);
+void send_FSP_FSCTL_TRANSACT_RSP(
+    FSP_FILE_SYSTEM * FileSystem,
+    UINT32 Kind,
+    UINT64 Hint,
+    NTSTATUS Status,
+    UINT32 Information,
+    const FSP_FSCTL_FILE_INFO * FileInfo
+);
+
+
 // Expose #define as const to be available at runtime
 
 extern const DWORD WFSPY_SECURITY_DESCRIPTOR_REVISION;
@@ -316,6 +453,8 @@ extern const SECURITY_INFORMATION WFSPY_GROUP_SECURITY_INFORMATION;
 extern const SECURITY_INFORMATION WFSPY_DACL_SECURITY_INFORMATION;
 extern const SECURITY_INFORMATION WFSPY_SACL_SECURITY_INFORMATION;
 
+extern const UINT32 WFSPY_DIR_INFO_FILE_NAME_SIZEMAX;
+
 size_t wcslen(const wchar_t *str);
 """
 )
@@ -1,7 +1,21 @@
 from ._version import __version__
 from .plumbing import enable_debug_log, FILE_ATTRIBUTE, CREATE_FILE_CREATE_OPTIONS
-from .file_system import FileSystem
-from .operations import BaseFileSystemOperations, BaseFileContext
+from .file_system import FileSystem, OPERATION_GUARD_STRATEGY
+from .locks import ReadWriteLock, LockManager
+from .operations import (
+    BaseFileSystemOperations,
+    BaseAsyncFileSystemOperations,
+    FileSystemOperationsWrapper,
+    BaseFileContext,
+    FileInfo,
+    FileNameCache,
+    FileContextTable,
+    NegativeLookupCache,
+    OperationStatistics,
+    OpenResult,
+    WriteResult,
+    split_file_name,
+)
 from .plumbing.exceptions import (
     WinFSPyError,
     FileSystemAlreadyStarted,
@@ -23,8 +37,21 @@ __all__ = (
     "FILE_ATTRIBUTE",
     "CREATE_FILE_CREATE_OPTIONS",
     "FileSystem",
+    "OPERATION_GUARD_STRATEGY",
+    "ReadWriteLock",
+    "LockManager",
     "BaseFileSystemOperations",
+    "BaseAsyncFileSystemOperations",
+    "FileSystemOperationsWrapper",
     "BaseFileContext",
+    "FileInfo",
+    "FileNameCache",
+    "FileContextTable",
+    "NegativeLookupCache",
+    "OperationStatistics",
+    "OpenResult",
+    "WriteResult",
+    "split_file_name",
     "WinFSPyError",
     "FileSystemAlreadyStarted",
     "FileSystemNotStarted",
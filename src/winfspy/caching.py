@@ -0,0 +1,1167 @@
+"""Cache layers to put in front of any file system operations.
+
+Each layer is a `FileSystemOperationsWrapper`, so they can be stacked, e.g.
+`WriteBackCache(InMemoryFileSystemOperations("memfs"))`.
+
+The layers key their caches on the file names, compared case-insensitively
+unless `case_sensitive` is set. It defaults to the `case_sensitive_search`
+volume parameter of the file system.
+"""
+
+import time
+import bisect
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
+
+from .operations import (
+    FileInfo,
+    FileSystemOperationsWrapper,
+    OpenResult,
+    WriteResult,
+    _file_info_values,
+)
+from .plumbing import NTStatusError, NTStatusEndOfFile, CREATE_FILE_CREATE_OPTIONS
+
+
+__all__ = ("WriteBackCache", "ReadAheadCache", "CachingFileSystemOperations", "MetadataCache")
+
+
+logger = logging.getLogger("winfspy")
+
+
+# See `FspCleanupDelete`
+_CLEANUP_DELETE = 0x01
+
+
+def _as_file_info(info) -> FileInfo:
+    if isinstance(info, FileInfo):
+        return info
+    return FileInfo(*_file_info_values(info), file_name=info.get("file_name"))
+
+
+def _get_entry_file_name(entry_info) -> str:
+    if isinstance(entry_info, FileInfo):
+        return entry_info.file_name
+    return entry_info["file_name"]
+
+
+def _join_file_name(directory_name: str, name: str) -> str:
+    return directory_name.rstrip("\\") + "\\" + name
+
+
+class _InvalidationTracker:
+    """
+    Tell whether a file has been invalidated since a lookup started, so the
+    (possibly outdated) result of this lookup is not cached.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clock = 0
+        self._invalidated_at = {}
+        self._lookups_in_flight = 0
+
+    def start_lookup(self) -> int:
+        with self._lock:
+            self._lookups_in_flight += 1
+            return self._clock
+
+    def end_lookup(self) -> None:
+        with self._lock:
+            self._lookups_in_flight -= 1
+            if not self._lookups_in_flight:
+                self._invalidated_at.clear()
+
+    def invalidate(self, file_name) -> None:
+        with self._lock:
+            self._clock += 1
+            if self._lookups_in_flight:
+                self._invalidated_at[file_name] = self._clock
+
+    def is_valid(self, file_name, clock) -> bool:
+        return self._invalidated_at.get(file_name, 0) <= clock
+
+
+class _OpenedFilesWrapper(FileSystemOperationsWrapper):
+    """
+    Keep track of the file name of each opened file context, so the caches can
+    be keyed by file (several contexts might be opened on the same file).
+
+    The names are normalized by `_normalize_file_name`, so the contexts opened
+    with different casings on a case-insensitive volume share the same key.
+    """
+
+    def __init__(self, operations, case_sensitive=None):
+        super().__init__(operations)
+        self._case_sensitive = case_sensitive
+        self._opened_files_lock = threading.Lock()
+        self._opened_files = {}
+
+    @property
+    def case_sensitive(self) -> bool:
+        if self._case_sensitive is not None:
+            return self._case_sensitive
+        if self._file_system is None:
+            return False
+        return bool(self._file_system.volume_params.get("case_sensitive_search", False))
+
+    def _normalize_file_name(self, file_name):
+        if file_name is None or self.case_sensitive:
+            return file_name
+        return file_name.casefold()
+
+    def _get_file_name(self, file_context):
+        """
+        Returns the normalized name of the file opened as `file_context`.
+        """
+        return self._opened_files.get(file_context)
+
+    def _add_opened_file(self, ret, file_name):
+        file_context = ret.file_context if isinstance(ret, OpenResult) else ret
+        with self._opened_files_lock:
+            self._opened_files[file_context] = self._normalize_file_name(file_name)
+
+    def _is_affected_by_rename(self, name: str, file_name: str) -> bool:
+        # Children of a renamed directory are renamed too
+        return name == file_name or name.startswith(file_name.rstrip("\\") + "\\")
+
+    def create(
+        self,
+        file_name,
+        create_options,
+        granted_access,
+        file_attributes,
+        security_descriptor,
+        allocation_size,
+    ):
+        ret = super().create(
+            file_name,
+            create_options,
+            granted_access,
+            file_attributes,
+            security_descriptor,
+            allocation_size,
+        )
+        self._add_opened_file(ret, file_name)
+        return ret
+
+    def open(self, file_name, create_options, granted_access):
+        ret = super().open(file_name, create_options, granted_access)
+        self._add_opened_file(ret, file_name)
+        return ret
+
+    def close(self, file_context):
+        try:
+            return super().close(file_context)
+        finally:
+            with self._opened_files_lock:
+                self._opened_files.pop(file_context, None)
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        ret = super().rename(file_context, file_name, new_file_name, replace_if_exists)
+        file_name = self._normalize_file_name(file_name)
+        new_file_name = self._normalize_file_name(new_file_name)
+        with self._opened_files_lock:
+            for opened_context, name in self._opened_files.items():
+                if self._is_affected_by_rename(name, file_name):
+                    self._opened_files[opened_context] = new_file_name + name[len(file_name) :]
+        return ret
+
+
+class _DirtyFile:
+    """
+    Data written to a file but not yet to the wrapped operations, merged into
+    sorted, non-overlapping and non-adjacent extents.
+    """
+
+    def __init__(self, file_context, file_info):
+        self.lock = threading.Lock()
+        # Context used to write the extents to the wrapped operations
+        self.file_context = file_context
+        # File info provided by the wrapped operations when the file became dirty
+        self.file_info = file_info
+        self.file_size = file_info.file_size
+        self.since = time.monotonic()
+        self.starts = []
+        self.ends = []
+        self.datas = []
+        self.dirty_bytes = 0
+        # Set once flushed or discarded, the file is then no longer dirty
+        self.done = False
+
+    def add(self, offset: int, data) -> int:
+        """
+        Returns the number of dirty bytes added.
+        """
+        end = offset + len(data)
+        # Extents overlapping or adjacent to the written range
+        lo = bisect.bisect_left(self.ends, offset)
+        hi = bisect.bisect_right(self.starts, end)
+        removed = sum(len(self.datas[i]) for i in range(lo, hi))
+
+        if lo == hi:
+            extent = bytearray(data)
+            self.starts.insert(lo, offset)
+            self.ends.insert(lo, end)
+            self.datas.insert(lo, extent)
+
+        elif hi - lo == 1 and self.starts[lo] <= offset:
+            # Most common case (e.g. sequential writes): extend the extent in place
+            extent = self.datas[lo]
+            relative = offset - self.starts[lo]
+            extent[relative : relative + len(data)] = data
+            self.ends[lo] = self.starts[lo] + len(extent)
+
+        else:
+            start = min(offset, self.starts[lo])
+            extent = bytearray(max(end, self.ends[hi - 1]) - start)
+            for i in range(lo, hi):
+                extent[self.starts[i] - start : self.ends[i] - start] = self.datas[i]
+            extent[offset - start : end - start] = data
+            self.starts[lo:hi] = [start]
+            self.ends[lo:hi] = [start + len(extent)]
+            self.datas[lo:hi] = [extent]
+
+        added = len(extent) - removed
+        self.dirty_bytes += added
+        self.file_size = max(self.file_size, end)
+        return added
+
+    def needs_flush_before_read(self, offset: int, length: int) -> bool:
+        end = offset + length
+        # Data beyond the end of the file as known by the wrapped operations
+        if end > self.file_info.file_size:
+            return True
+        lo = bisect.bisect_right(self.ends, offset)
+        hi = bisect.bisect_left(self.starts, end)
+        return lo < hi
+
+    def get_file_info(self, file_info=None) -> FileInfo:
+        file_info = self.file_info if file_info is None else _as_file_info(file_info)
+        return file_info._replace(
+            file_size=self.file_size,
+            allocation_size=max(file_info.allocation_size, self.file_size),
+        )
+
+
+class WriteBackCache(_OpenedFilesWrapper):
+    """
+    Buffer the writes in memory, so a storm of small writes ends up as a few
+    large writes to the wrapped operations.
+
+    Adjacent and overlapping writes to a file are merged into extents, written
+    to the wrapped operations on `flush`, `cleanup`, `close` and before any
+    operation depending on the file data (e.g. `read`, `set_file_size`).
+    A background thread also flushes the files dirty for more than `max_age`
+    seconds, or the oldest ones once more than half of `max_dirty_bytes` are
+    buffered, using a pool of `flush_threads` threads. Past `max_dirty_bytes`,
+    the file is flushed right away by the writing thread.
+
+    Note the buffer provided to the wrapped `write` is a `bytearray`.
+    """
+
+    def __init__(
+        self,
+        operations,
+        max_dirty_bytes=64 * 1024 * 1024,
+        max_age=5.0,
+        flush_threads=4,
+        case_sensitive=None,
+    ):
+        super().__init__(operations, case_sensitive)
+        self.max_dirty_bytes = max_dirty_bytes
+        self.max_age = max_age
+        self.dirty_bytes = 0
+        self.buffered_writes = 0
+        self.flushed_writes = 0
+        self._dirty_lock = threading.Lock()
+        self._dirty_files = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=flush_threads, thread_name_prefix="winfspy-write-back"
+        )
+        self._stopped = False
+        self._flusher_wakeup = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._run_flusher, name="winfspy-write-back-flusher", daemon=True
+        )
+        self._flusher.start()
+
+    def get_stats(self) -> dict:
+        return {
+            "dirty_bytes": self.dirty_bytes,
+            "dirty_files": len(self._dirty_files),
+            "buffered_writes": self.buffered_writes,
+            "flushed_writes": self.flushed_writes,
+        }
+
+    def shutdown(self) -> None:
+        """
+        Flush all the dirty files and stop the background threads.
+        """
+        self._stopped = True
+        self._flusher_wakeup.set()
+        self._flusher.join()
+        self.flush_all()
+        self._executor.shutdown()
+
+    def flush_all(self) -> None:
+        with self._dirty_lock:
+            file_names = list(self._dirty_files)
+        for file_name in file_names:
+            self._flush_file(file_name)
+
+    def _account(self, dirty_bytes=0, buffered_writes=0, flushed_writes=0) -> None:
+        with self._dirty_lock:
+            self.dirty_bytes += dirty_bytes
+            self.buffered_writes += buffered_writes
+            self.flushed_writes += flushed_writes
+
+    def _get_dirty_file(self, file_name):
+        with self._dirty_lock:
+            return self._dirty_files.get(file_name)
+
+    def _get_or_create_dirty_file(self, file_name, file_context):
+        dirty_file = self._get_dirty_file(file_name)
+        if dirty_file is not None:
+            return dirty_file
+        file_info = _as_file_info(self.operations.get_file_info(file_context))
+        with self._dirty_lock:
+            return self._dirty_files.setdefault(file_name, _DirtyFile(file_context, file_info))
+
+    def _flush_file(self, file_name, discard=False) -> None:
+        dirty_file = self._get_dirty_file(file_name)
+        if dirty_file is None:
+            return
+        with dirty_file.lock:
+            if dirty_file.done:
+                return
+            # Extents are removed as they get written, so a failure leaves only
+            # the remaining ones dirty
+            while dirty_file.datas and not discard:
+                self.operations.write(
+                    dirty_file.file_context, dirty_file.datas[0], dirty_file.starts[0], False, False
+                )
+                self._account(dirty_bytes=-len(dirty_file.datas[0]), flushed_writes=1)
+                dirty_file.dirty_bytes -= len(dirty_file.datas[0])
+                del dirty_file.starts[0], dirty_file.ends[0], dirty_file.datas[0]
+            self._account(dirty_bytes=-dirty_file.dirty_bytes)
+            dirty_file.done = True
+            with self._dirty_lock:
+                del self._dirty_files[file_name]
+
+    def _flush_file_logged(self, file_name) -> None:
+        try:
+            self._flush_file(file_name)
+        except BaseException:
+            logger.exception("Cannot flush %s, will retry later", file_name)
+
+    def _flush_file_context(self, file_context, offset=None, length=None) -> None:
+        file_name = self._get_file_name(file_context)
+        dirty_file = self._get_dirty_file(file_name)
+        if dirty_file is None:
+            return
+        if offset is not None:
+            with dirty_file.lock:
+                if not dirty_file.needs_flush_before_read(offset, length):
+                    return
+        self._flush_file(file_name)
+
+    def _flush_renamed_files(self, file_name) -> None:
+        with self._dirty_lock:
+            file_names = [
+                name for name in self._dirty_files if self._is_affected_by_rename(name, file_name)
+            ]
+        for name in file_names:
+            self._flush_file(name)
+
+    def _run_flusher(self) -> None:
+        while not self._stopped:
+            self._flusher_wakeup.wait(self.max_age / 2)
+            self._flusher_wakeup.clear()
+            now = time.monotonic()
+            with self._dirty_lock:
+                dirty_files = sorted(self._dirty_files.items(), key=lambda item: item[1].since)
+                excess = self.dirty_bytes - self.max_dirty_bytes // 2
+            futures = []
+            # Oldest first, until under the memory pressure threshold
+            for file_name, dirty_file in dirty_files:
+                if excess <= 0 and now - dirty_file.since < self.max_age:
+                    break
+                excess -= dirty_file.dirty_bytes
+                futures.append(self._executor.submit(self._flush_file_logged, file_name))
+            for future in futures:
+                future.result()
+
+    def _patch_entry_info(self, directory_name, entry_info):
+        file_name = self._normalize_file_name(
+            _join_file_name(directory_name, _get_entry_file_name(entry_info))
+        )
+        dirty_file = self._get_dirty_file(file_name)
+        if dirty_file is None:
+            return entry_info
+        return dirty_file.get_file_info(entry_info)
+
+    # Operations
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        file_name = self._get_file_name(file_context)
+        while True:
+            dirty_file = self._get_or_create_dirty_file(file_name, file_context)
+            with dirty_file.lock:
+                # Flushed in the meantime
+                if dirty_file.done:
+                    continue
+                if write_to_end_of_file:
+                    offset = dirty_file.file_size
+                length = len(buffer)
+                # Constrained I/O never extends the file
+                if constrained_io:
+                    length = max(0, min(length, dirty_file.file_size - offset))
+                added = 0
+                if length:
+                    with memoryview(buffer) as view:
+                        added = dirty_file.add(offset, view[:length])
+                    dirty_file.file_context = file_context
+                file_info = dirty_file.get_file_info()
+                break
+
+        self._account(dirty_bytes=added, buffered_writes=1)
+        if self.dirty_bytes > self.max_dirty_bytes:
+            # The write is buffered anyway, a failure is retried later
+            self._flush_file_logged(file_name)
+        elif self.dirty_bytes > self.max_dirty_bytes // 2:
+            self._flusher_wakeup.set()
+
+        return WriteResult(length, file_info)
+
+    def read(self, file_context, offset, length):
+        self._flush_file_context(file_context, offset, length)
+        return super().read(file_context, offset, length)
+
+    def read_into(self, file_context, offset, buffer):
+        self._flush_file_context(file_context, offset, len(buffer))
+        return super().read_into(file_context, offset, buffer)
+
+    def flush(self, file_context):
+        # Flushing the volume
+        if file_context is None:
+            self.flush_all()
+        else:
+            self._flush_file_context(file_context)
+        return super().flush(file_context)
+
+    def get_file_info(self, file_context):
+        file_info = super().get_file_info(file_context)
+        dirty_file = self._get_dirty_file(self._get_file_name(file_context))
+        if dirty_file is None:
+            return file_info
+        return dirty_file.get_file_info(file_info)
+
+    def set_basic_info(
+        self,
+        file_context,
+        file_attributes,
+        creation_time,
+        last_access_time,
+        last_write_time,
+        change_time,
+        file_info,
+    ):
+        file_info = super().set_basic_info(
+            file_context,
+            file_attributes,
+            creation_time,
+            last_access_time,
+            last_write_time,
+            change_time,
+            file_info,
+        )
+        dirty_file = self._get_dirty_file(self._get_file_name(file_context))
+        if dirty_file is None:
+            return file_info
+        return dirty_file.get_file_info(file_info)
+
+    def set_file_size(self, file_context, new_size, set_allocation_size):
+        self._flush_file_context(file_context)
+        return super().set_file_size(file_context, new_size, set_allocation_size)
+
+    def overwrite(self, file_context, file_attributes, replace_file_attributes, allocation_size):
+        self._flush_file_context(file_context)
+        return super().overwrite(
+            file_context, file_attributes, replace_file_attributes, allocation_size
+        )
+
+    def cleanup(self, file_context, file_name, flags):
+        # No need to write the data of a file about to be deleted
+        self._flush_file(self._get_file_name(file_context), discard=bool(flags & _CLEANUP_DELETE))
+        return super().cleanup(file_context, file_name, flags)
+
+    def close(self, file_context):
+        file_name = self._get_file_name(file_context)
+        try:
+            self._flush_file(file_name)
+        except NTStatusError:
+            dirty_file = self._get_dirty_file(file_name)
+            # The context won't be usable to flush the remaining data
+            if dirty_file is not None and dirty_file.file_context is file_context:
+                logger.exception("Cannot flush %s, dirty data is lost", file_name)
+                self._flush_file(file_name, discard=True)
+        return super().close(file_context)
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        self._flush_renamed_files(self._normalize_file_name(file_name))
+        self._flush_file(self._normalize_file_name(new_file_name))
+        return super().rename(file_context, file_name, new_file_name, replace_if_exists)
+
+    def read_directory(self, file_context, marker):
+        entries_info = super().read_directory(file_context, marker)
+        if not self._dirty_files:
+            return entries_info
+        directory_name = self._get_file_name(file_context)
+        return (self._patch_entry_info(directory_name, entry_info) for entry_info in entries_info)
+
+    def get_dir_info_by_name(self, file_context, file_name):
+        entry_info = super().get_dir_info_by_name(file_context, file_name)
+        dirty_file = self._get_dirty_file(
+            self._normalize_file_name(_join_file_name(self._get_file_name(file_context), file_name))
+        )
+        if dirty_file is None:
+            return entry_info
+        return dirty_file.get_file_info(entry_info)._replace(file_name=file_name)
+
+
+class _ReadStream:
+    """
+    Read pattern of a file context, along with the windows prefetched for it.
+    """
+
+    def __init__(self, sequential_only, window_size):
+        self.lock = threading.Lock()
+        # Opened with `FILE_SEQUENTIAL_ONLY`
+        self.sequential_only = sequential_only
+        self.next_offset = 0
+        self.sequential_reads = 0
+        self.window_size = window_size
+        self.prefetch_end = 0
+        # Contiguous (start, length, future) windows, in ascending order
+        self.windows = []
+
+
+class ReadAheadCache(_OpenedFilesWrapper):
+    """
+    Prefetch the data of the files read sequentially.
+
+    A file context is considered sequential once `trigger` reads followed each
+    other (or right away if opened with `FILE_SEQUENTIAL_ONLY`). The next `depth`
+    windows are then read from the wrapped operations by a pool of `threads`
+    threads, and the next reads are served from them. The window size doubles
+    from `window_size` up to `max_window_size` as long as the reads remain
+    sequential, and the prefetching is cancelled on a random access.
+    At most `max_buffered_bytes` are prefetched across all the file contexts.
+    """
+
+    def __init__(
+        self,
+        operations,
+        window_size=128 * 1024,
+        max_window_size=4 * 1024 * 1024,
+        depth=2,
+        trigger=2,
+        max_buffered_bytes=64 * 1024 * 1024,
+        threads=4,
+        case_sensitive=None,
+    ):
+        super().__init__(operations, case_sensitive)
+        self.window_size = window_size
+        self.max_window_size = max_window_size
+        self.depth = depth
+        self.trigger = trigger
+        self.max_buffered_bytes = max_buffered_bytes
+        self.buffered_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.prefetched_bytes = 0
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix="winfspy-read-ahead"
+        )
+
+    def get_stats(self) -> dict:
+        return {
+            "buffered_bytes": self.buffered_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "prefetched_bytes": self.prefetched_bytes,
+        }
+
+    def shutdown(self) -> None:
+        with self._lock:
+            streams = list(self._streams.values())
+        for stream in streams:
+            with stream.lock:
+                self._drop_windows(stream)
+        self._executor.shutdown()
+
+    def _account(self, buffered_bytes=0, hits=0, misses=0, prefetched_bytes=0) -> None:
+        with self._lock:
+            self.buffered_bytes += buffered_bytes
+            self.hits += hits
+            self.misses += misses
+            self.prefetched_bytes += prefetched_bytes
+
+    def _add_stream(self, ret, create_options) -> None:
+        file_context = ret.file_context if isinstance(ret, OpenResult) else ret
+        sequential_only = bool(create_options & CREATE_FILE_CREATE_OPTIONS.FILE_SEQUENTIAL_ONLY)
+        with self._lock:
+            self._streams[file_context] = _ReadStream(sequential_only, self.window_size)
+
+    def _drop_windows(self, stream, before=None):
+        """
+        Drop the windows ending before `before` (all of them by default), returns
+        those which were being prefetched.
+        """
+        running = []
+        while stream.windows:
+            start, length, future = stream.windows[0]
+            if before is not None and start + length > before:
+                break
+            del stream.windows[0]
+            if not future.cancel():
+                running.append(future)
+            self._account(buffered_bytes=-length)
+        if not stream.windows:
+            stream.prefetch_end = stream.next_offset
+        return running
+
+    def _invalidate_file(self, file_name) -> None:
+        # Prefetched data of all the contexts opened on the file is stale
+        with self._lock:
+            streams = [
+                stream
+                for file_context, stream in self._streams.items()
+                if self._get_file_name(file_context) == file_name
+            ]
+        for stream in streams:
+            with stream.lock:
+                self._drop_windows(stream)
+                stream.sequential_reads = 0
+
+    def _prefetch(self, file_context, offset, length):
+        try:
+            return self.operations.read(file_context, offset, length)
+        except NTStatusEndOfFile:
+            return b""
+
+    def _schedule_prefetch(self, file_context, stream) -> None:
+        end = stream.next_offset + self.depth * stream.window_size
+        while stream.prefetch_end < end and self.buffered_bytes < self.max_buffered_bytes:
+            start, length = stream.prefetch_end, stream.window_size
+            future = self._executor.submit(self._prefetch, file_context, start, length)
+            stream.windows.append((start, length, future))
+            stream.prefetch_end += length
+            stream.window_size = min(2 * stream.window_size, self.max_window_size)
+            self._account(buffered_bytes=length, prefetched_bytes=length)
+
+    def _read_ahead(self, file_context, offset, length):
+        """
+        Returns the data from the prefetched windows, or `None` if they don't
+        cover the requested range.
+        """
+        stream = self._streams.get(file_context)
+        if stream is None:
+            return None
+
+        with stream.lock:
+            if offset == stream.next_offset:
+                stream.sequential_reads += 1
+            else:
+                # Random access
+                self._drop_windows(stream)
+                stream.sequential_reads = 0
+                stream.window_size = self.window_size
+            stream.next_offset = offset + length
+            # The windows already consumed are no longer needed
+            self._drop_windows(stream, before=offset)
+            if not stream.windows or stream.windows[0][0] > offset:
+                futures = None
+            else:
+                futures = [future for start, _, future in stream.windows if start < offset + length]
+                windows_start = stream.windows[0][0]
+                windows_end = stream.windows[-1][0] + stream.windows[-1][1]
+                if windows_end < offset + length:
+                    futures = None
+            if stream.sequential_only or stream.sequential_reads >= self.trigger:
+                stream.prefetch_end = max(stream.prefetch_end, stream.next_offset)
+                self._schedule_prefetch(file_context, stream)
+
+        if futures is None:
+            return None
+        try:
+            data = b"".join(future.result() for future in futures)
+        except BaseException:
+            # E.g. cancelled by a write, or an error from the wrapped operations
+            return None
+        data = data[offset - windows_start : offset - windows_start + length]
+        # Reading at the end of file is left to the wrapped operations
+        return data or None
+
+    # Operations
+
+    def create(
+        self,
+        file_name,
+        create_options,
+        granted_access,
+        file_attributes,
+        security_descriptor,
+        allocation_size,
+    ):
+        ret = super().create(
+            file_name,
+            create_options,
+            granted_access,
+            file_attributes,
+            security_descriptor,
+            allocation_size,
+        )
+        self._add_stream(ret, create_options)
+        return ret
+
+    def open(self, file_name, create_options, granted_access):
+        ret = super().open(file_name, create_options, granted_access)
+        self._add_stream(ret, create_options)
+        return ret
+
+    def close(self, file_context):
+        with self._lock:
+            stream = self._streams.pop(file_context, None)
+        if stream is not None:
+            with stream.lock:
+                running = self._drop_windows(stream)
+            # The context must not be used once closed
+            futures_wait(running)
+        return super().close(file_context)
+
+    def read(self, file_context, offset, length):
+        data = self._read_ahead(file_context, offset, length)
+        if data is None:
+            self._account(misses=1)
+            return super().read(file_context, offset, length)
+        self._account(hits=1)
+        return data
+
+    def read_into(self, file_context, offset, buffer):
+        data = self._read_ahead(file_context, offset, len(buffer))
+        if data is None:
+            self._account(misses=1)
+            return super().read_into(file_context, offset, buffer)
+        self._account(hits=1)
+        buffer[: len(data)] = data
+        return len(data)
+
+    # Invalidation occurs once the data is modified, so a window prefetched in
+    # the meantime is not kept
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        try:
+            return super().write(file_context, buffer, offset, write_to_end_of_file, constrained_io)
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def set_file_size(self, file_context, new_size, set_allocation_size):
+        try:
+            return super().set_file_size(file_context, new_size, set_allocation_size)
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def overwrite(self, file_context, file_attributes, replace_file_attributes, allocation_size):
+        try:
+            return super().overwrite(
+                file_context, file_attributes, replace_file_attributes, allocation_size
+            )
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        # The replaced file (if any) is gone
+        self._invalidate_file(self._normalize_file_name(new_file_name))
+        return super().rename(file_context, file_name, new_file_name, replace_if_exists)
+
+
+class CachingFileSystemOperations(_OpenedFilesWrapper):
+    """
+    Cache the file data in blocks of `block_size` bytes (aligned on the block
+    size), with a least recently used eviction once the cached blocks exceed
+    `max_cached_bytes`.
+
+    The blocks of a file are invalidated when it is modified (`write`,
+    `set_file_size`, `overwrite`, deleted on `cleanup`) or renamed.
+    """
+
+    def __init__(
+        self,
+        operations,
+        block_size=64 * 1024,
+        max_cached_bytes=256 * 1024 * 1024,
+        case_sensitive=None,
+    ):
+        super().__init__(operations, case_sensitive)
+        self.block_size = block_size
+        self.max_cached_bytes = max_cached_bytes
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        # (file name, block index) -> block data, least recently used first
+        self._blocks = OrderedDict()
+        self._file_blocks = {}
+        self._invalidation_tracker = _InvalidationTracker()
+
+    def get_stats(self) -> dict:
+        return {
+            "cached_bytes": self.cached_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _invalidate_file(self, file_name) -> None:
+        self._invalidation_tracker.invalidate(file_name)
+        with self._lock:
+            for index in self._file_blocks.pop(file_name, ()):
+                self.cached_bytes -= len(self._blocks.pop((file_name, index)))
+
+    def _invalidate_renamed_files(self, file_name) -> None:
+        with self._lock:
+            file_names = [
+                name for name in self._file_blocks if self._is_affected_by_rename(name, file_name)
+            ]
+        for name in file_names:
+            self._invalidate_file(name)
+
+    def _add_blocks(self, file_name, first_index, blocks, clock) -> None:
+        with self._lock:
+            if not self._invalidation_tracker.is_valid(file_name, clock):
+                return
+            indexes = self._file_blocks.setdefault(file_name, set())
+            for index, block in enumerate(blocks, first_index):
+                key = (file_name, index)
+                previous = self._blocks.pop(key, None)
+                if previous is not None:
+                    self.cached_bytes -= len(previous)
+                self._blocks[key] = block
+                indexes.add(index)
+                self.cached_bytes += len(block)
+            while self.cached_bytes > self.max_cached_bytes:
+                (evicted_name, evicted_index), evicted = self._blocks.popitem(last=False)
+                self.cached_bytes -= len(evicted)
+                self.evictions += 1
+                evicted_indexes = self._file_blocks[evicted_name]
+                evicted_indexes.discard(evicted_index)
+                if not evicted_indexes:
+                    del self._file_blocks[evicted_name]
+
+    def _read_blocks(self, file_context, offset, length):
+        file_name = self._get_file_name(file_context)
+        first_index = offset // self.block_size
+        last_index = (offset + length - 1) // self.block_size
+
+        blocks = []
+        clock = self._invalidation_tracker.start_lookup()
+        with self._lock:
+            for index in range(first_index, last_index + 1):
+                block = self._blocks.get((file_name, index))
+                if block is None:
+                    break
+                self._blocks.move_to_end((file_name, index))
+                blocks.append(block)
+                # End of file
+                if len(block) < self.block_size:
+                    break
+            complete = len(blocks) == last_index - first_index + 1 or (
+                blocks and len(blocks[-1]) < self.block_size
+            )
+            if complete:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+        try:
+            if not complete:
+                # Read all the missing blocks at once
+                missing_index = first_index + len(blocks)
+                missing_offset = missing_index * self.block_size
+                missing_length = (last_index + 1) * self.block_size - missing_offset
+                try:
+                    data = self.operations.read(file_context, missing_offset, missing_length)
+                except NTStatusEndOfFile:
+                    data = b""
+                missing_blocks = [
+                    bytes(data[i : i + self.block_size])
+                    for i in range(0, len(data), self.block_size)
+                ]
+                self._add_blocks(file_name, missing_index, missing_blocks, clock)
+                blocks += missing_blocks
+
+        finally:
+            self._invalidation_tracker.end_lookup()
+
+        relative = offset - first_index * self.block_size
+        data = b"".join(blocks)[relative : relative + length]
+        if not data:
+            raise NTStatusEndOfFile()
+        return data
+
+    # Operations
+
+    def read(self, file_context, offset, length):
+        return self._read_blocks(file_context, offset, length)
+
+    def read_into(self, file_context, offset, buffer):
+        data = self._read_blocks(file_context, offset, len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    # Invalidation occurs once the data is modified, so a block read in the
+    # meantime is not kept
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        try:
+            return super().write(file_context, buffer, offset, write_to_end_of_file, constrained_io)
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def set_file_size(self, file_context, new_size, set_allocation_size):
+        try:
+            return super().set_file_size(file_context, new_size, set_allocation_size)
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def overwrite(self, file_context, file_attributes, replace_file_attributes, allocation_size):
+        try:
+            return super().overwrite(
+                file_context, file_attributes, replace_file_attributes, allocation_size
+            )
+        finally:
+            self._invalidate_file(self._get_file_name(file_context))
+
+    def cleanup(self, file_context, file_name, flags):
+        try:
+            return super().cleanup(file_context, file_name, flags)
+        finally:
+            if flags & _CLEANUP_DELETE:
+                self._invalidate_file(self._get_file_name(file_context))
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        try:
+            return super().rename(file_context, file_name, new_file_name, replace_if_exists)
+        finally:
+            self._invalidate_renamed_files(self._normalize_file_name(file_name))
+            self._invalidate_file(self._normalize_file_name(new_file_name))
+
+
+class MetadataCache(_OpenedFilesWrapper):
+    """
+    Cache the results of `get_security_by_name`, `get_file_info` and
+    `get_dir_info_by_name`, so the bursts of lookups Windows issues for a
+    single file access end up as a single lookup from the wrapped operations.
+
+    The results are kept for `ttl` seconds, which defaults to the
+    `file_info_timeout` volume parameter of the file system (i.e. as long as
+    the file info is cached by WinFSP). They are invalidated when the file is
+    modified by the operations going through this layer (e.g. `create`,
+    `rename`, `set_basic_info`, `write`, `cleanup`).
+    """
+
+    def __init__(self, operations, ttl=None, maxsize=4096, case_sensitive=None):
+        super().__init__(operations, case_sensitive)
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        # (kind, file name) -> (expiration time, result)
+        self._entries = OrderedDict()
+        self._invalidation_tracker = _InvalidationTracker()
+
+    @property
+    def ttl(self) -> float:
+        if self._ttl is not None:
+            return self._ttl
+        if self._file_system is None:
+            return 0.0
+        # Volume params timeouts are in milliseconds
+        return self._file_system.volume_params.get("file_info_timeout", 0) / 1000
+
+    def get_stats(self) -> dict:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _lookup(self, kind, file_name, fetch, *args):
+        ttl = self.ttl
+        if ttl <= 0 or file_name is None:
+            return fetch(*args)
+        key = (kind, file_name)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+
+        clock = self._invalidation_tracker.start_lookup()
+        try:
+            result = fetch(*args)
+            self._store(key, now + ttl, result, clock)
+        finally:
+            self._invalidation_tracker.end_lookup()
+        return result
+
+    def _store(self, key, expiration, result, clock) -> None:
+        with self._lock:
+            if not self._invalidation_tracker.is_valid(key[1], clock):
+                return
+            self._entries[key] = (expiration, result)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _invalidate_file(self, file_name) -> None:
+        self._invalidation_tracker.invalidate(file_name)
+        with self._lock:
+            self._entries.pop(("security", file_name), None)
+            self._entries.pop(("file_info", file_name), None)
+
+    def _invalidate_renamed_files(self, file_name) -> None:
+        with self._lock:
+            file_names = {
+                name for _, name in self._entries if self._is_affected_by_rename(name, file_name)
+            }
+        for name in file_names:
+            self._invalidate_file(name)
+
+    def _invalidate_file_context(self, file_context) -> None:
+        self._invalidate_file(self._get_file_name(file_context))
+
+    # Operations
+
+    def get_security_by_name(self, file_name):
+        return self._lookup(
+            "security",
+            self._normalize_file_name(file_name),
+            super().get_security_by_name,
+            file_name,
+        )
+
+    def get_file_info(self, file_context):
+        return self._lookup(
+            "file_info", self._get_file_name(file_context), super().get_file_info, file_context
+        )
+
+    def get_dir_info_by_name(self, file_context, file_name):
+        # Same file info than `get_file_info` for the entry
+        entry_name = self._normalize_file_name(
+            _join_file_name(self._get_file_name(file_context), file_name)
+        )
+        entry_info = self._lookup(
+            "file_info", entry_name, super().get_dir_info_by_name, file_context, file_name
+        )
+        return _as_file_info(entry_info)._replace(file_name=file_name)
+
+    def create(
+        self,
+        file_name,
+        create_options,
+        granted_access,
+        file_attributes,
+        security_descriptor,
+        allocation_size,
+    ):
+        self._invalidate_file(self._normalize_file_name(file_name))
+        return super().create(
+            file_name,
+            create_options,
+            granted_access,
+            file_attributes,
+            security_descriptor,
+            allocation_size,
+        )
+
+    # Invalidation occurs once the file is modified, so a lookup done in the
+    # meantime is not kept
+
+    def overwrite(self, file_context, file_attributes, replace_file_attributes, allocation_size):
+        try:
+            return super().overwrite(
+                file_context, file_attributes, replace_file_attributes, allocation_size
+            )
+        finally:
+            self._invalidate_file_context(file_context)
+
+    def cleanup(self, file_context, file_name, flags):
+        try:
+            return super().cleanup(file_context, file_name, flags)
+        finally:
+            # Deleted or with updated attributes/times
+            if flags:
+                self._invalidate_file_context(file_context)
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        try:
+            return super().write(file_context, buffer, offset, write_to_end_of_file, constrained_io)
+        finally:
+            self._invalidate_file_context(file_context)
+
+    def flush(self, file_context):
+        try:
+            return super().flush(file_context)
+        finally:
+            if file_context is not None:
+                self._invalidate_file_context(file_context)
+
+    def set_basic_info(
+        self,
+        file_context,
+        file_attributes,
+        creation_time,
+        last_access_time,
+        last_write_time,
+        change_time,
+        file_info,
+    ):
+        try:
+            return super().set_basic_info(
+                file_context,
+                file_attributes,
+                creation_time,
+                last_access_time,
+                last_write_time,
+                change_time,
+                file_info,
+            )
+        finally:
+            self._invalidate_file_context(file_context)
+
+    def set_file_size(self, file_context, new_size, set_allocation_size):
+        try:
+            return super().set_file_size(file_context, new_size, set_allocation_size)
+        finally:
+            self._invalidate_file_context(file_context)
+
+    def set_security(self, file_context, security_information, modification_descriptor):
+        try:
+            return super().set_security(file_context, security_information, modification_descriptor)
+        finally:
+            self._invalidate_file_context(file_context)
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        try:
+            return super().rename(file_context, file_name, new_file_name, replace_if_exists)
+        finally:
+            self._invalidate_renamed_files(self._normalize_file_name(file_name))
+            self._invalidate_file(self._normalize_file_name(new_file_name))
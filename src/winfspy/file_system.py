@@ -1,10 +1,11 @@
 import os
+import enum
 import time
 import errno
 
 from .plumbing import ffi, lib, cook_ntstatus, nt_success, file_system_interface_trampoline_factory
 from .plumbing import WinFSPyError, FileSystemAlreadyStarted, FileSystemNotStarted
-from .operations import BaseFileSystemOperations
+from .operations import BaseFileSystemOperations, OperationStatistics
 
 
 def _volume_params_factory(
@@ -106,16 +107,55 @@ def _volume_params_factory(
     return volume_params
 
 
+class OPERATION_GUARD_STRATEGY(enum.IntEnum):
+    """
+    How WinFSP serializes the operations before dispatching them.
+
+    With `FINE`, only the operations altering the namespace (e.g. create, rename,
+    delete) are exclusive with each other, the others run concurrently. With
+    `COARSE`, most operations are exclusive with each other, which spares the
+    implementation any locking but serializes the file system.
+    """
+
+    FINE = lib.FSP_FILE_SYSTEM_OPERATION_GUARD_STRATEGY_FINE
+    COARSE = lib.FSP_FILE_SYSTEM_OPERATION_GUARD_STRATEGY_COARSE
+
+
 class FileSystem:
-    def __init__(self, mountpoint, operations, debug=False, **volume_params):
+    def __init__(
+        self,
+        mountpoint,
+        operations,
+        debug=False,
+        dispatcher_threads=0,
+        operation_guard_strategy=OPERATION_GUARD_STRATEGY.FINE,
+        **volume_params,
+    ):
+        """
+        `dispatcher_threads` is the number of threads dispatching the operations,
+        0 letting WinFSP pick a default based on the number of CPUs. With "auto",
+        the operations are instrumented and the thread count recommended by
+        `OperationStatistics.recommended_dispatcher_threads` is applied on restart.
+
+        `operation_guard_strategy` is an `OPERATION_GUARD_STRATEGY`.
+        """
         self.started = False
         if not isinstance(operations, BaseFileSystemOperations):
             raise ValueError(f"`operations` must be a `BaseFileSystemOperations` instance.")
+        if dispatcher_threads != "auto" and (
+            not isinstance(dispatcher_threads, int) or dispatcher_threads < 0
+        ):
+            raise ValueError("`dispatcher_threads` must be a positive integer or `auto`.")
+        if dispatcher_threads == "auto" and operations.operation_statistics is None:
+            operations.operation_statistics = OperationStatistics()
 
         self.debug = debug
+        self.dispatcher_threads = dispatcher_threads
+        self.operation_guard_strategy = OPERATION_GUARD_STRATEGY(operation_guard_strategy)
         self.volume_params = volume_params
         self.mountpoint = mountpoint
         self.operations = operations
+        self.operations._bind_file_system(self)
         self._apply_volume_params()
         self._create_file_system()
 
@@ -127,10 +167,7 @@ class FileSystem:
             )
 
         # Enable `pass_query_directory_file_name` by default if `get_dir_info_by_name` is available
-        get_dir_info_by_name_available = (
-            type(self.operations).get_dir_info_by_name
-            is not BaseFileSystemOperations.get_dir_info_by_name
-        )
+        get_dir_info_by_name_available = self.operations._is_implemented("get_dir_info_by_name")
         if (
             get_dir_info_by_name_available
             and "pass_query_directory_file_name" not in self.volume_params
@@ -138,9 +175,7 @@ class FileSystem:
             self.volume_params["pass_query_directory_file_name"] = True
 
         self._volume_params = _volume_params_factory(**self.volume_params)
-        set_delete_available = (
-            type(self.operations).set_delete is not BaseFileSystemOperations.set_delete
-        )
+        set_delete_available = self.operations._is_implemented("set_delete")
         self._file_system_interface = file_system_interface_trampoline_factory(
             set_delete_available=set_delete_available
         )
@@ -166,6 +201,10 @@ class FileSystem:
         self._operations_handle = ffi.new_handle(self.operations)
         self._file_system_ptr[0].UserContext = self._operations_handle
 
+        lib.FspFileSystemSetOperationGuardStrategyF(
+            self._file_system_ptr[0], self.operation_guard_strategy
+        )
+
         if self.debug:
             lib.FspFileSystemSetDebugLogF(self._file_system_ptr[0], 0xFFFFFFFF)
 
@@ -177,7 +216,9 @@ class FileSystem:
         result = lib.FspFileSystemSetMountPoint(self._file_system_ptr[0], self.mountpoint)
         if not nt_success(result):
             raise WinFSPyError(f"Cannot mount file system: {cook_ntstatus(result).name}")
-        result = lib.FspFileSystemStartDispatcher(self._file_system_ptr[0], 0)
+        result = lib.FspFileSystemStartDispatcher(
+            self._file_system_ptr[0], self._get_dispatcher_threads()
+        )
         if not nt_success(result):
             raise WinFSPyError(f"Cannot start file system dispatcher: {cook_ntstatus(result).name}")
         # Since winfsp 1.12.22301 (2022-2), the file system might not be reachable as soon as the dispatcher is started.
@@ -196,6 +237,13 @@ class FileSystem:
                     continue
                 raise
 
+    def _get_dispatcher_threads(self):
+        if self.dispatcher_threads != "auto":
+            return self.dispatcher_threads
+        # WinFSP default until some operations have been recorded
+        recommended = self.operations.operation_statistics.recommended_dispatcher_threads()
+        return recommended or 0
+
     def restart(self, **volume_params):
         self.stop()
         self.volume_params.update(volume_params)
@@ -0,0 +1,120 @@
+"""Locking helpers for the file system operations.
+
+WinFSP dispatches the operations from several threads, these helpers let an
+implementation serialize only the operations that actually conflict.
+"""
+
+import threading
+from contextlib import contextmanager
+
+
+__all__ = (
+    "ReadWriteLock",
+    "LockManager",
+)
+
+
+class ReadWriteLock:
+    """
+    Lock shared by any number of readers or held by a single writer.
+
+    Writers are given priority over new readers so they don't starve.
+    The lock is not reentrant.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+        self._waiting_writers = 0
+
+    def acquire_read(self) -> None:
+        with self._condition:
+            while self._writer or self._waiting_writers:
+                self._condition.wait()
+            self._readers += 1
+
+    def release_read(self) -> None:
+        with self._condition:
+            self._readers -= 1
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self) -> None:
+        with self._condition:
+            self._waiting_writers += 1
+            try:
+                while self._writer or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = True
+
+    def release_write(self) -> None:
+        with self._condition:
+            self._writer = False
+            self._condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+class LockManager:
+    """
+    Reader-writer locks created on demand for arbitrary hashable keys
+    (e.g. a path or a file object), and dropped once no longer used.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        # Key -> [lock, number of users]
+        self._locks = {}
+
+    def __len__(self):
+        return len(self._locks)
+
+    def _checkout(self, key) -> ReadWriteLock:
+        with self._mutex:
+            entry = self._locks.get(key)
+            if entry is None:
+                entry = self._locks[key] = [ReadWriteLock(), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _checkin(self, key) -> None:
+        with self._mutex:
+            entry = self._locks[key]
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+
+    @contextmanager
+    def read(self, key):
+        lock = self._checkout(key)
+        try:
+            with lock.read():
+                yield
+        finally:
+            self._checkin(key)
+
+    @contextmanager
+    def write(self, key):
+        lock = self._checkout(key)
+        try:
+            with lock.write():
+                yield
+        finally:
+            self._checkin(key)
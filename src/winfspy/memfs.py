@@ -3,16 +3,34 @@
 Useful for testing and as a reference.
 """
 
+import os
 import sys
+import mmap
+import time
+import zlib
+import struct
+import hashlib
 import logging
 import argparse
+import tempfile
+import itertools
 import threading
-from functools import wraps
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import partial, wraps
 from pathlib import Path, PureWindowsPath
 
 from winfspy import (
     FileSystem,
     BaseFileSystemOperations,
+    FileInfo,
+    FileNameCache,
+    LockManager,
+    NegativeLookupCache,
+    OpenResult,
+    ReadWriteLock,
+    WriteResult,
     enable_debug_log,
     FILE_ATTRIBUTE,
     CREATE_FILE_CREATE_OPTIONS,
@@ -25,13 +43,14 @@ from winfspy import (
     NTStatusMediaWriteProtected,
 )
 from winfspy.plumbing.win32_filetime import filetime_now
-from winfspy.plumbing.security_descriptor import SecurityDescriptor
+from winfspy.plumbing.security_descriptor import SecurityDescriptor, SecurityDescriptorPool
 
 
 def operation(fn):
     """Decorator for file system operations.
 
-    Provides both logging and thread-safety
+    Provides logging, thread-safety is up to the operation (see
+    `InMemoryFileSystemOperations._namespace_lock` and `_file_locks`)
     """
     name = fn.__name__
 
@@ -40,8 +59,7 @@ def operation(fn):
         head = args[0] if args else None
         tail = args[1:] if args else ()
         try:
-            with self._thread_lock:
-                result = fn(self, *args, **kwargs)
+            result = fn(self, *args, **kwargs)
         except Exception as exc:
             logging.info(f" NOK | {name:20} | {head!r:20} | {tail!r:20} | {exc!r}")
             raise
@@ -52,6 +70,23 @@ def operation(fn):
     return wrapper
 
 
+def journaled(fn):
+    """Decorator for the operations modifying the file system.
+
+    Runs the operation within a journal transaction (see `Journal.transaction`)
+    if the file system is journaled.
+    """
+
+    @wraps(fn)
+    def wrapper(self, *args, **kwargs):
+        if self.journal is None:
+            return fn(self, *args, **kwargs)
+        with self.journal.transaction():
+            return fn(self, *args, **kwargs)
+
+    return wrapper
+
+
 class BaseFileObj:
     @property
     def name(self):
@@ -75,42 +110,473 @@ class BaseFileObj:
         self.index_number = 0
         self.file_size = 0
 
+    def _copy_metadata(self, file_obj):
+        # Not forced to archive
+        self.attributes = file_obj.attributes
+        self.creation_time = file_obj.creation_time
+        self.last_access_time = file_obj.last_access_time
+        self.last_write_time = file_obj.last_write_time
+        self.change_time = file_obj.change_time
+        self.index_number = file_obj.index_number
+        self.file_size = file_obj.file_size
+
     def get_file_info(self):
-        return {
-            "file_attributes": self.attributes,
-            "allocation_size": self.allocation_size,
-            "file_size": self.file_size,
-            "creation_time": self.creation_time,
-            "last_access_time": self.last_access_time,
-            "last_write_time": self.last_write_time,
-            "change_time": self.change_time,
-            "index_number": self.index_number,
-        }
+        return FileInfo(
+            file_attributes=self.attributes,
+            allocation_size=self.allocation_size,
+            file_size=self.file_size,
+            creation_time=self.creation_time,
+            last_access_time=self.last_access_time,
+            last_write_time=self.last_write_time,
+            change_time=self.change_time,
+            index_number=self.index_number,
+        )
 
     def __repr__(self):
         return f"{type(self).__name__}:{self.file_name}"
 
 
+class _SharedChunk:
+    """Read-only chunk shared between files, released once unused"""
+
+    __slots__ = ("view",)
+
+
+class _SharedSlot(_SharedChunk):
+    # `slot` is None for a chunk in RAM
+    __slots__ = ("_storage", "_slot")
+
+    def __init__(self, storage, slot, view):
+        self.view = view
+        self._storage = storage
+        self._slot = slot
+
+    def __del__(self):
+        self._storage.release_slot(self._slot)
+
+
+class _DedupedChunk(_SharedChunk):
+    __slots__ = ("_store", "_digest")
+
+    def __init__(self, store, digest, data):
+        self.view = data.view if isinstance(data, _SharedChunk) else data
+        self._store = store
+        self._digest = digest
+
+    def __del__(self):
+        self._store.release(self._digest)
+
+
+class DedupeStore:
+    """
+    Content-addressed store of file chunks, identical chunks being stored once.
+
+    The files written are deduplicated in the background (see `schedule` and
+    `get_scheduled`), `settle_delay` seconds after their last write, so the
+    hashing doesn't slow down the writes nor gets repeated for a file being
+    written. Once deduplicated, a chunk is shared read-only like the chunks
+    of a clone, and copied if modified. The chunks full of zeros are dropped
+    altogether, since a missing chunk reads as zeros.
+    """
+
+    def __init__(self, chunk_size, settle_delay=1.0):
+        self.chunk_size = chunk_size
+        self.settle_delay = settle_delay
+        self._lock = threading.Lock()
+        self._scheduled_changed = threading.Condition(self._lock)
+        # Digest -> [data, reference count], the data being the first chunk
+        # seen with this digest (see `FileObj.share_chunk`)
+        self._blocks = {}
+        # Digests released on garbage collection, to be processed with the lock held
+        self._released = deque()
+        # File -> time of the last write, oldest first
+        self._scheduled = OrderedDict()
+        self._closed = False
+        self._zeros_digest = self._get_digest(bytes(chunk_size))
+
+    def _get_digest(self, data):
+        return hashlib.blake2b(data, digest_size=32).digest()
+
+    def _process_released(self):
+        while self._released:
+            digest = self._released.popleft()
+            block = self._blocks[digest]
+            block[1] -= 1
+            if not block[1]:
+                del self._blocks[digest]
+
+    def release(self, digest):
+        # No locking since it is called on garbage collection, which might happen
+        # while the lock is held (appending to a deque is atomic anyway)
+        self._released.append(digest)
+
+    def get_stats(self):
+        with self._lock:
+            self._process_released()
+            return {
+                "blocks": len(self._blocks),
+                "references": sum(block[1] for block in self._blocks.values()),
+                # Already accounted by the storage of the files the blocks come from
+                "physical_size": len(self._blocks) * self.chunk_size,
+            }
+
+    def schedule(self, file_obj):
+        with self._lock:
+            self._scheduled[file_obj] = time.monotonic()
+            self._scheduled.move_to_end(file_obj)
+            self._scheduled_changed.notify()
+
+    def unschedule(self, file_obj):
+        with self._lock:
+            self._scheduled.pop(file_obj, None)
+
+    def get_scheduled(self):
+        """Wait for a file to deduplicate, None being returned once closed"""
+        with self._lock:
+            while not self._closed:
+                if not self._scheduled:
+                    self._scheduled_changed.wait()
+                    continue
+                file_obj, scheduled_at = next(iter(self._scheduled.items()))
+                delay = scheduled_at + self.settle_delay - time.monotonic()
+                if delay <= 0:
+                    del self._scheduled[file_obj]
+                    return file_obj
+                self._scheduled_changed.wait(delay)
+            return None
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._scheduled_changed.notify_all()
+
+    def dedupe(self, file_obj):
+        """Share the chunks of `file_obj` with identical ones, the file must be locked"""
+        for index, chunk in list(file_obj.chunks.items()):
+            digest = self._get_digest(chunk)
+            if digest == self._zeros_digest:
+                file_obj._free_chunk(index)
+                continue
+            with self._lock:
+                self._process_released()
+                block = self._blocks.get(digest)
+                if block is None:
+                    # The chunk is kept where it is (possibly spilled) rather than copied
+                    block = self._blocks[digest] = [file_obj.share_chunk(index), 0]
+                else:
+                    file_obj._free_chunk(index)
+                block[1] += 1
+            file_obj.shared_chunks[index] = _DedupedChunk(self, digest, block[0])
+
+
+class SpillStorage:
+    """
+    Allocate the chunks of the files, keeping the hot files in RAM and
+    spilling the others into memory-mapped temporary files.
+
+    A file is spilled as soon as its size exceeds `spill_threshold` bytes, and
+    the coldest files are spilled when the chunks in RAM, including the ones
+    shared between files (see `share`), exceed `ram_budget` bytes (see
+    `pick_cold_files`). The chunks of a spilled file are views on the mapping,
+    so reading them copies straight into the transfer buffer.
+
+    The temporary files are arenas of `arena_size` bytes split in chunk slots,
+    the slots being recycled once freed.
+    """
+
+    def __init__(
+        self,
+        chunk_size,
+        ram_budget=None,
+        spill_threshold=None,
+        arena_size=64 * 1024 * 1024,
+        directory=None,
+    ):
+        if arena_size % chunk_size:
+            raise ValueError("`arena_size` must be a multiple of `chunk_size`")
+        self.chunk_size = chunk_size
+        self.ram_budget = ram_budget
+        self.spill_threshold = spill_threshold
+        self.arena_size = arena_size
+        self.directory = directory
+        self.ram_usage = 0
+        self.shared_ram_usage = 0
+        self._lock = threading.Lock()
+        # Files with chunks in RAM, coldest first
+        self._ram_files = OrderedDict()
+        # (temporary file, mapping, view on the mapping) for each arena
+        self._arenas = []
+        self._free_slots = []
+        # Slots released on garbage collection, to be processed with the lock held
+        # (None for a shared chunk in RAM)
+        self._released_slots = deque()
+        self._slots_per_arena = arena_size // chunk_size
+        self._zeros = bytes(chunk_size)
+
+    def _process_released(self):
+        while self._released_slots:
+            slot = self._released_slots.popleft()
+            if slot is None:
+                self.shared_ram_usage -= self.chunk_size
+            else:
+                self._free_slots.append(slot)
+
+    def get_stats(self):
+        with self._lock:
+            self._process_released()
+            slots = len(self._arenas) * self._slots_per_arena
+            return {
+                "ram_usage": self.ram_usage,
+                "shared_ram_usage": self.shared_ram_usage,
+                "spilled_usage": (slots - len(self._free_slots)) * self.chunk_size,
+                "spill_capacity": slots * self.chunk_size,
+            }
+
+    def _allocate_slot(self, data):
+        self._process_released()
+        if not self._free_slots:
+            file = tempfile.TemporaryFile(dir=self.directory)
+            file.truncate(self.arena_size)
+            mapping = mmap.mmap(file.fileno(), self.arena_size)
+            first_slot = len(self._arenas) * self._slots_per_arena
+            self._arenas.append((file, mapping, memoryview(mapping)))
+            self._free_slots.extend(reversed(range(first_slot, first_slot + self._slots_per_arena)))
+        slot = self._free_slots.pop()
+        arena_index, slot_index = divmod(slot, self._slots_per_arena)
+        start = slot_index * self.chunk_size
+        chunk = self._arenas[arena_index][2][start : start + self.chunk_size]
+        chunk[:] = data
+        return slot, chunk
+
+    def allocate(self, file_obj, index):
+        """Add a zeroed chunk at `index` to `file_obj`"""
+        with self._lock:
+            if file_obj.spilled:
+                slot, chunk = self._allocate_slot(self._zeros)
+                file_obj.chunk_slots[index] = slot
+            else:
+                chunk = bytearray(self.chunk_size)
+                self.ram_usage += self.chunk_size
+                if self.ram_budget is not None:
+                    self._ram_files[file_obj] = None
+                    self._ram_files.move_to_end(file_obj)
+            file_obj.chunks[index] = chunk
+            return chunk
+
+    def free(self, file_obj, index):
+        with self._lock:
+            del file_obj.chunks[index]
+            slot = file_obj.chunk_slots.pop(index, None)
+            if slot is None:
+                self.ram_usage -= self.chunk_size
+            else:
+                self._free_slots.append(slot)
+
+    def share(self, file_obj, index):
+        """
+        Detach the chunk at `index` from `file_obj` and return it as read-only data
+        to be shared. A shared chunk in RAM counts in `shared_ram_usage` instead of
+        `ram_usage`, until no longer used.
+        """
+        with self._lock:
+            chunk = file_obj.chunks.pop(index)
+            slot = file_obj.chunk_slots.pop(index, None)
+            if slot is None:
+                self.ram_usage -= self.chunk_size
+                self.shared_ram_usage += self.chunk_size
+            return _SharedSlot(self, slot, chunk)
+
+    def release_slot(self, slot):
+        # No locking since it is called on garbage collection, which might happen
+        # while the lock is held (appending to a deque is atomic anyway)
+        self._released_slots.append(slot)
+
+    def touch(self, file_obj):
+        if file_obj.spilled or self.ram_budget is None:
+            return
+        with self._lock:
+            if file_obj in self._ram_files:
+                self._ram_files.move_to_end(file_obj)
+
+    def forget(self, file_obj):
+        with self._lock:
+            self._ram_files.pop(file_obj, None)
+
+    def spill(self, file_obj):
+        """Move the chunks of `file_obj` out of RAM, the file must be locked"""
+        with self._lock:
+            if file_obj.spilled:
+                return
+            file_obj.spilled = True
+            self._ram_files.pop(file_obj, None)
+            for index, data in list(file_obj.chunks.items()):
+                slot, file_obj.chunks[index] = self._allocate_slot(data)
+                file_obj.chunk_slots[index] = slot
+                self.ram_usage -= self.chunk_size
+
+    def pick_cold_files(self):
+        """Coldest files to spill to get the RAM usage back within the budget"""
+        if self.ram_budget is None:
+            return []
+        with self._lock:
+            # The shared chunks can't be spilled, so more files are spilled instead
+            self._process_released()
+            excess = self.ram_usage + self.shared_ram_usage - self.ram_budget
+            cold_files = []
+            for file_obj in self._ram_files:
+                if excess <= 0:
+                    break
+                cold_files.append(file_obj)
+                excess -= len(file_obj.chunks) * self.chunk_size
+            return cold_files
+
+
 class FileObj(BaseFileObj):
 
     allocation_unit = 4096
+    # The data is stored in chunks of this size, a missing chunk reading as zeros
+    chunk_size = 64 * 1024
 
-    def __init__(self, path, attributes, security_descriptor, allocation_size=0):
+    def __init__(self, path, attributes, security_descriptor, allocation_size=0, storage=None):
         super().__init__(path, attributes, security_descriptor)
-        self.data = bytearray(allocation_size)
+        # Chunk index -> bytearray (or view on the spill storage) of `chunk_size` bytes
+        self.chunks = {}
+        # Optional `SpillStorage` allocating the chunks
+        self.storage = storage
+        # Chunk index -> slot in `storage`, once the file is spilled
+        self.chunk_slots = {}
+        self.spilled = False
+        # Chunk index -> read-only data shared with a loaded image or with other
+        # files (see `InMemoryFileSystemOperations.load_image` and `clone`), to be
+        # copied before being modified
+        self.shared_chunks = {}
+        self.allocation_size = allocation_size
         self.attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
         assert not self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
 
-    @property
-    def allocation_size(self):
-        return len(self.data)
+    def _iter_chunks(self, offset, end_offset):
+        """Yield `(index, start, stop)` for each chunk covering `offset:end_offset`"""
+        while offset < end_offset:
+            index, start = divmod(offset, self.chunk_size)
+            stop = min(self.chunk_size, start + end_offset - offset)
+            yield index, start, stop
+            offset += stop - start
+
+    def get_chunk(self, index):
+        """Data of the chunk at `index`, None for a hole"""
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            chunk = self.shared_chunks.get(index)
+            if isinstance(chunk, _SharedChunk):
+                chunk = chunk.view
+        return chunk
+
+    def get_chunk_indexes(self):
+        return self.chunks.keys() | self.shared_chunks.keys()
+
+    def copy(self, storage=None):
+        """
+        Return a copy of the file, sharing its data: the chunks become read-only
+        and each file copies a chunk before modifying it.
+        """
+        for index in list(self.chunks):
+            self.shared_chunks[index] = self.share_chunk(index)
+        file_obj = FileObj(
+            self.path,
+            self.attributes,
+            self.security_descriptor,
+            self.allocation_size,
+            storage=storage,
+        )
+        file_obj._copy_metadata(self)
+        file_obj.shared_chunks = dict(self.shared_chunks)
+        return file_obj
+
+    def share_chunk(self, index):
+        """Detach the chunk at `index` as read-only data, see `SpillStorage.share`"""
+        if self.storage is None:
+            return self.chunks.pop(index)
+        return self.storage.share(self, index)
+
+    def _read_chunks(self, offset, view):
+        position = 0
+        for index, start, stop in self._iter_chunks(offset, offset + len(view)):
+            length = stop - start
+            chunk = self.get_chunk(index)
+            if chunk is None:
+                view[position : position + length] = bytes(length)
+            else:
+                with memoryview(chunk) as chunk_view:
+                    view[position : position + length] = chunk_view[start:stop]
+            position += length
+
+    def _allocate_chunk(self, index):
+        if self.storage is not None:
+            return self.storage.allocate(self, index)
+        chunk = self.chunks[index] = bytearray(self.chunk_size)
+        return chunk
+
+    def _get_writable_chunk(self, index):
+        chunk = self.chunks.get(index)
+        if chunk is None:
+            chunk = self._allocate_chunk(index)
+            # Copy on write of the shared data
+            shared_chunk = self.shared_chunks.pop(index, None)
+            if isinstance(shared_chunk, _SharedChunk):
+                chunk[:] = shared_chunk.view
+            elif shared_chunk is not None:
+                chunk[:] = shared_chunk
+        return chunk
+
+    def _free_chunk(self, index):
+        if self.storage is not None:
+            self.storage.free(self, index)
+        else:
+            del self.chunks[index]
+
+    def _touch(self):
+        if self.storage is not None:
+            self.storage.touch(self)
+
+    def _spill_if_large(self):
+        if self.storage is None:
+            return
+        self.storage.touch(self)
+        threshold = self.storage.spill_threshold
+        if threshold is not None and self.file_size > threshold:
+            self.storage.spill(self)
+
+    def _write_chunks(self, buffer, offset):
+        with memoryview(buffer) as view:
+            position = 0
+            for index, start, stop in self._iter_chunks(offset, offset + len(view)):
+                length = stop - start
+                chunk = self._get_writable_chunk(index)
+                chunk[start:stop] = view[position : position + length]
+                position += length
+
+    def _discard_chunks(self, offset):
+        """Drop the data past `offset`, so it reads as zeros if the file grows again"""
+        index, start = divmod(offset, self.chunk_size)
+        if start:
+            if index in self.chunks or index in self.shared_chunks:
+                self._get_writable_chunk(index)[start:] = bytes(self.chunk_size - start)
+            index += 1
+        for discarded_index in [i for i in self.chunks if i >= index]:
+            self._free_chunk(discarded_index)
+        for discarded_index in [i for i in self.shared_chunks if i >= index]:
+            del self.shared_chunks[discarded_index]
+
+    def release(self):
+        """Free the data of the file once deleted"""
+        self._discard_chunks(0)
+        if self.storage is not None:
+            self.storage.forget(self)
 
     def set_allocation_size(self, allocation_size):
         if allocation_size < self.allocation_size:
-            self.data = self.data[:allocation_size]
-        if allocation_size > self.allocation_size:
-            self.data += bytearray(allocation_size - self.allocation_size)
-        assert self.allocation_size == allocation_size
+            self._discard_chunks(allocation_size)
+        self.allocation_size = allocation_size
         self.file_size = min(self.file_size, allocation_size)
 
     def adapt_allocation_size(self, file_size):
@@ -119,8 +585,7 @@ class FileObj(BaseFileObj):
 
     def set_file_size(self, file_size):
         if file_size < self.file_size:
-            zeros = bytearray(self.file_size - file_size)
-            self.data[file_size : self.file_size] = zeros
+            self._discard_chunks(file_size)
         if file_size > self.allocation_size:
             self.adapt_allocation_size(file_size)
         self.file_size = file_size
@@ -128,8 +593,21 @@ class FileObj(BaseFileObj):
     def read(self, offset, length):
         if offset >= self.file_size:
             raise NTStatusEndOfFile()
+        self._touch()
         end_offset = min(self.file_size, offset + length)
-        return self.data[offset:end_offset]
+        data = bytearray(end_offset - offset)
+        self._read_chunks(offset, memoryview(data))
+        return data
+
+    def read_into(self, offset, buffer):
+        if offset >= self.file_size:
+            raise NTStatusEndOfFile()
+        self._touch()
+        end_offset = min(self.file_size, offset + len(buffer))
+        transferred_length = end_offset - offset
+        with memoryview(buffer) as view:
+            self._read_chunks(offset, view[:transferred_length])
+        return transferred_length
 
     def write(self, buffer, offset, write_to_end_of_file):
         if write_to_end_of_file:
@@ -137,7 +615,9 @@ class FileObj(BaseFileObj):
         end_offset = offset + len(buffer)
         if end_offset > self.file_size:
             self.set_file_size(end_offset)
-        self.data[offset:end_offset] = buffer
+        # Spill (if needed) before writing, so the data is only copied once
+        self._spill_if_large()
+        self._write_chunks(buffer, offset)
         return len(buffer)
 
     def constrained_write(self, buffer, offset):
@@ -145,7 +625,8 @@ class FileObj(BaseFileObj):
             return 0
         end_offset = min(self.file_size, offset + len(buffer))
         transferred_length = end_offset - offset
-        self.data[offset:end_offset] = buffer[:transferred_length]
+        self._spill_if_large()
+        self._write_chunks(buffer[:transferred_length], offset)
         return transferred_length
 
 
@@ -153,8 +634,235 @@ class FolderObj(BaseFileObj):
     def __init__(self, path, attributes, security_descriptor):
         super().__init__(path, attributes, security_descriptor)
         self.allocation_size = 0
+        # Lowercased name -> entry, names being looked up case-insensitively
+        self.children = {}
+        # Names of the children, kept sorted so listings can resume from a marker
+        self.sorted_names = []
         assert self.attributes & FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
 
+    def copy(self, storage=None):
+        """Return a copy of the folder, without its children"""
+        file_obj = FolderObj(self.path, self.attributes, self.security_descriptor)
+        file_obj._copy_metadata(self)
+        return file_obj
+
+    def get_child(self, name):
+        return self.children[name.lower()]
+
+    def add_child(self, file_obj):
+        key = file_obj.name.lower()
+        replaced_obj = self.children.get(key)
+        if replaced_obj is not None:
+            self._remove_sorted_name(replaced_obj.name)
+        self.children[key] = file_obj
+        insort(self.sorted_names, file_obj.name)
+
+    def remove_child(self, file_obj):
+        del self.children[file_obj.name.lower()]
+        self._remove_sorted_name(file_obj.name)
+
+    def _remove_sorted_name(self, name):
+        index = bisect_left(self.sorted_names, name)
+        assert self.sorted_names[index] == name
+        del self.sorted_names[index]
+
+    def list_children(self, marker=None, count=None):
+        """Children sorted by name, starting strictly after `marker`"""
+        start = 0 if marker is None else bisect_right(self.sorted_names, marker)
+        stop = None if count is None else start + count
+        return [self.children[name.lower()] for name in self.sorted_names[start:stop]]
+
+
+_IMAGE_MAGIC = b"WFSPYMFS"
+_IMAGE_VERSION = 1
+# Magic, version, chunk size, table offset, table size
+_IMAGE_HEADER = struct.Struct("<8sIIQQ")
+# Parent index, is folder, attributes, creation/last access/last write/change times,
+# index number, descriptor index, file size, allocation size, chunk count, name size
+_IMAGE_ENTRY = struct.Struct("<iBIQQQQQIQQII")
+# Chunk index, data offset
+_IMAGE_CHUNK = struct.Struct("<QQ")
+_IMAGE_SIZE = struct.Struct("<I")
+
+# Journal record size, CRC32 of the record
+_JOURNAL_FRAME = struct.Struct("<II")
+_JOURNAL_CREATE = 1
+_JOURNAL_WRITE = 2
+_JOURNAL_SET_FILE_SIZE = 3
+_JOURNAL_RENAME = 4
+_JOURNAL_SET_BASIC_INFO = 5
+_JOURNAL_SET_SECURITY = 6
+_JOURNAL_DELETE = 7
+_JOURNAL_SET_VOLUME_LABEL = 8
+# Record type -> (fixed size fields, number of variable size fields)
+_JOURNAL_RECORDS = {
+    # Index number, parent index number, is folder, attributes, allocation size,
+    # creation time; name, security descriptor
+    _JOURNAL_CREATE: (struct.Struct("<QQBIQQ"), 2),
+    # Index number, offset; data
+    _JOURNAL_WRITE: (struct.Struct("<QQ"), 1),
+    # Index number, size, is allocation size
+    _JOURNAL_SET_FILE_SIZE: (struct.Struct("<QQB"), 0),
+    # Index number, new parent index number; new name
+    _JOURNAL_RENAME: (struct.Struct("<QQ"), 1),
+    # Index number, attributes, creation/last access/last write/change times
+    _JOURNAL_SET_BASIC_INFO: (struct.Struct("<QIQQQQ"), 0),
+    # Index number; security descriptor
+    _JOURNAL_SET_SECURITY: (struct.Struct("<Q"), 1),
+    # Index number
+    _JOURNAL_DELETE: (struct.Struct("<Q"), 0),
+    # Volume label
+    _JOURNAL_SET_VOLUME_LABEL: (struct.Struct(""), 1),
+}
+
+
+def _encode_journal_record(record_type, *fields):
+    fixed_fields, variable_fields_count = _JOURNAL_RECORDS[record_type]
+    split = len(fields) - variable_fields_count
+    parts = [bytes([record_type]), fixed_fields.pack(*fields[:split])]
+    for field in fields[split:]:
+        parts += [_IMAGE_SIZE.pack(len(field)), field]
+    return b"".join(parts)
+
+
+def _decode_journal_record(record):
+    record_type = record[0]
+    fixed_fields, variable_fields_count = _JOURNAL_RECORDS[record_type]
+    fields = list(fixed_fields.unpack_from(record, 1))
+    offset = 1 + fixed_fields.size
+    for _ in range(variable_fields_count):
+        (size,) = _IMAGE_SIZE.unpack_from(record, offset)
+        offset += _IMAGE_SIZE.size + size
+        fields.append(record[offset - size : offset])
+    return record_type, fields
+
+
+class Journal:
+    """
+    Append-only journal of the changes made to a memfs volume, stored in
+    `directory` along with the image of the last checkpoint.
+
+    Each record is framed by its size and CRC32, so a record torn by a crash
+    is detected and dropped on recovery. Records are handed to the OS as soon
+    as they are appended, which is enough to survive the death of the process,
+    and `sync` makes them durable: concurrent calls share a single fsync.
+
+    A checkpoint saves a new image and starts a new journal, so the recovery
+    only replays the changes since the last checkpoint.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        generations = [path.name[6:] for path in self.directory.glob("image-*")]
+        self.generation = max((int(g) for g in generations if g.isdigit()), default=0)
+        self._fd = None
+        self._lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+        # Operations run with the read lock, checkpoints with the write lock
+        self._checkpoint_lock = ReadWriteLock()
+        self._appended = 0
+        self._synced = 0
+        self.size = 0
+
+    def _get_path(self, kind, generation):
+        return self.directory / f"{kind}-{generation:08d}"
+
+    @property
+    def image_path(self):
+        path = self._get_path("image", self.generation)
+        return path if path.exists() else None
+
+    def recover(self):
+        """Return the valid records of the journal, which is then opened for appending"""
+        path = self._get_path("journal", self.generation)
+        data = path.read_bytes() if path.exists() else b""
+        records = []
+        offset = 0
+        while offset + _JOURNAL_FRAME.size <= len(data):
+            size, crc = _JOURNAL_FRAME.unpack_from(data, offset)
+            start = offset + _JOURNAL_FRAME.size
+            record = data[start : start + size]
+            if len(record) != size or zlib.crc32(record) != crc:
+                break
+            records.append(record)
+            offset = start + size
+
+        # Drop the torn end, if any
+        self._fd = os.open(path, os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0))
+        os.ftruncate(self._fd, offset)
+        os.lseek(self._fd, offset, os.SEEK_SET)
+        self.size = offset
+        self._remove_previous_generations()
+        return records
+
+    @contextmanager
+    def transaction(self):
+        with self._checkpoint_lock.read():
+            yield
+
+    def append(self, record):
+        frame = _JOURNAL_FRAME.pack(len(record), zlib.crc32(record)) + record
+        with self._lock:
+            with memoryview(frame) as view:
+                while view:
+                    view = view[os.write(self._fd, view) :]
+            self._appended += 1
+            self.size += len(frame)
+
+    def sync(self):
+        with self._lock:
+            target = self._appended
+        with self._sync_lock:
+            # Already covered by a concurrent call
+            if self._synced >= target:
+                return
+            with self._lock:
+                target = self._appended
+            os.fsync(self._fd)
+            self._synced = target
+
+    def checkpoint(self, save_image):
+        """Save a new image with `save_image(path)` and start a new journal"""
+        with self._checkpoint_lock.write(), self._sync_lock:
+            generation = self.generation + 1
+            image_path = self._get_path("image", generation)
+            save_image(image_path)
+            with open(image_path, "rb") as file:
+                os.fsync(file.fileno())
+            fd = os.open(
+                self._get_path("journal", generation),
+                os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+            )
+            with self._lock:
+                os.close(self._fd)
+                self._fd = fd
+                self.generation = generation
+                self.size = 0
+                self._synced = self._appended
+        self._remove_previous_generations()
+
+    def _remove_previous_generations(self):
+        # Called on each checkpoint, so a removal failing is retried on the next one
+        for path in self.directory.iterdir():
+            kind, _, generation = path.name.partition("-")
+            if kind in ("image", "journal") and generation.isdigit():
+                if int(generation) < self.generation:
+                    try:
+                        path.unlink()
+                    # E.g. the previous image still being mapped (on Windows)
+                    except OSError as exc:
+                        logging.warning(
+                            f"Cannot remove {path}, will retry on next checkpoint: {exc}"
+                        )
+
+    def close(self):
+        with self._sync_lock, self._lock:
+            if self._fd is not None:
+                os.fsync(self._fd)
+                os.close(self._fd)
+                self._fd = None
+
 
 class OpenedObj:
     def __init__(self, file_obj):
@@ -165,80 +873,634 @@ class OpenedObj:
 
 
 class InMemoryFileSystemOperations(BaseFileSystemOperations):
-    def __init__(self, volume_label, read_only=False):
-        super().__init__()
+
+    # Number of children retrieved at once when listing a directory
+    read_directory_page_size = 64
+
+    def __init__(
+        self,
+        volume_label,
+        read_only=False,
+        ram_budget=None,
+        spill_threshold=None,
+        journal_dir=None,
+        checkpoint_interval=60.0,
+        dedupe=False,
+    ):
+        """
+        Files past `spill_threshold` bytes, as well as the coldest files once
+        the data in RAM exceeds `ram_budget` bytes, are moved to memory-mapped
+        temporary files (see `SpillStorage`). By default all data stays in RAM.
+
+        With `journal_dir`, the file system is recovered from and persisted to
+        this directory (see `Journal`), a checkpoint being made every
+        `checkpoint_interval` seconds. `shutdown` must be called once done.
+
+        With `dedupe`, identical file chunks are stored once (see `DedupeStore`).
+        The volume info reports the memory actually used by the file data.
+        """
+        super().__init__(
+            file_name_cache=FileNameCache(split=PureWindowsPath),
+            security_descriptor_pool=SecurityDescriptorPool(),
+            # Entries are looked up through `PureWindowsPath`, i.e. case-insensitively
+            negative_lookup_cache=NegativeLookupCache(case_sensitive=False),
+        )
         if len(volume_label) > 31:
             raise ValueError("`volume_label` must be 31 characters long max")
 
         max_file_nodes = 1024
         max_file_size = 16 * 1024 * 1024
-        file_nodes = 1
 
         self._volume_info = {
             "total_size": max_file_nodes * max_file_size,
-            "free_size": (max_file_nodes - file_nodes) * max_file_size,
             "volume_label": volume_label,
         }
 
         self.read_only = read_only
+        # Also accounts for the memory used, even if nothing is to be spilled
+        self.spill_storage = SpillStorage(FileObj.chunk_size, ram_budget, spill_threshold)
+        self._closed = threading.Event()
+        self.dedupe_store = None
+        if dedupe:
+            self.dedupe_store = DedupeStore(FileObj.chunk_size)
+            self._dedupe_thread = threading.Thread(target=self._run_dedupe, daemon=True)
+            self._dedupe_thread.start()
         self._root_path = PureWindowsPath("/")
         self._root_obj = FolderObj(
             self._root_path,
             FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-            SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"),
+            self.security_descriptor_pool.intern(
+                SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)")
+            ),
+        )
+        # (path, mapping) of the image loaded, see `load_image`
+        self._image = None
+        # Unique identifier of each entry, also used to refer to it in the journal
+        self._index_numbers = itertools.count(1)
+        self._root_obj.index_number = next(self._index_numbers)
+        # Guards the tree of entries (and the volume info): operations adding,
+        # removing or moving an entry are exclusive, the lookups are shared
+        self._namespace_lock = ReadWriteLock()
+        # Guard the data and metadata of each file object, so operations on
+        # distinct files don't wait for each other
+        self._file_locks = LockManager()
+
+        self.journal = None
+        if journal_dir is not None:
+            journal = Journal(journal_dir)
+            if journal.image_path is not None:
+                self.load_image(journal.image_path)
+            self._replay(journal.recover())
+            self.journal = journal
+            # Persist the root folder and volume label of a new volume
+            if journal.image_path is None:
+                self.checkpoint()
+            self._checkpoint_thread = threading.Thread(
+                target=self._run_checkpoints, args=(checkpoint_interval,), daemon=True
+            )
+            self._checkpoint_thread.start()
+
+    def _get_entry(self, path):
+        """Raises `KeyError` if there is no entry at `path`"""
+        file_obj = self._root_obj
+        for name in path.parts[1:]:
+            if not isinstance(file_obj, FolderObj):
+                raise KeyError(path)
+            file_obj = file_obj.get_child(name)
+        return file_obj
+
+    def _spill_cold_files(self):
+        # Called without holding any file lock, since the cold files get locked
+        for file_obj in self.spill_storage.pick_cold_files():
+            with self._file_locks.write(file_obj):
+                self.spill_storage.spill(file_obj)
+
+    def _walk(self, file_obj):
+        """Yield the entries of the subtree of `file_obj`, parents first, along with their parent"""
+        stack = [(file_obj, None)]
+        while stack:
+            file_obj, parent_obj = stack.pop()
+            yield file_obj, parent_obj
+            if isinstance(file_obj, FolderObj):
+                stack.extend((child, file_obj) for child in file_obj.children.values())
+
+    def _set_subtree_path(self, file_obj, path):
+        stack = [(file_obj, path)]
+        while stack:
+            file_obj, path = stack.pop()
+            file_obj.path = path
+            if isinstance(file_obj, FolderObj):
+                stack.extend((child, path / child.name) for child in file_obj.children.values())
+
+    def _add_entry(self, parent_obj, file_obj):
+        file_obj.index_number = next(self._index_numbers)
+        parent_obj.add_child(file_obj)
+        self._log(
+            _JOURNAL_CREATE,
+            file_obj.index_number,
+            parent_obj.index_number,
+            isinstance(file_obj, FolderObj),
+            file_obj.attributes,
+            file_obj.allocation_size,
+            file_obj.creation_time,
+            file_obj.name.encode("utf-8"),
+            file_obj.security_descriptor.to_bytes(),
         )
-        self._entries = {self._root_path: self._root_obj}
-        self._thread_lock = threading.Lock()
+
+    def _release_entry(self, file_obj):
+        self.security_descriptor_pool.release(file_obj.security_descriptor)
+        if isinstance(file_obj, FileObj):
+            if self.dedupe_store is not None:
+                self.dedupe_store.unschedule(file_obj)
+            # Possibly being deduplicated
+            with self._file_locks.write(file_obj):
+                file_obj.release()
+
+    def _move_entry(self, file_obj, parent_obj, new_parent_obj, new_file_name):
+        replaced_obj = new_parent_obj.children.get(new_file_name.name.lower())
+        if replaced_obj is not None and replaced_obj is not file_obj:
+            # The replaced file is about to be dropped
+            self._release_entry(replaced_obj)
+        parent_obj.remove_child(file_obj)
+        self._set_subtree_path(file_obj, new_file_name)
+        new_parent_obj.add_child(file_obj)
+
+    def _log_basic_info(self, file_obj):
+        self._log(
+            _JOURNAL_SET_BASIC_INFO,
+            file_obj.index_number,
+            file_obj.attributes,
+            file_obj.creation_time,
+            file_obj.last_access_time,
+            file_obj.last_write_time,
+            file_obj.change_time,
+        )
+
+    def _log(self, record_type, *fields):
+        if self.journal is not None:
+            self.journal.append(_encode_journal_record(record_type, *fields))
+
+    # Journal
+
+    def _replay(self, records):
+        file_objs = {file_obj.index_number: file_obj for file_obj, _ in self._walk(self._root_obj)}
+        for record in records:
+            record_type, fields = _decode_journal_record(record)
+            file_obj = file_objs.get(fields[0])
+
+            if record_type == _JOURNAL_CREATE:
+                index_number, parent_index_number, is_folder, attributes = fields[:4]
+                allocation_size, creation_time, name, descriptor = fields[4:]
+                parent_obj = file_objs[parent_index_number]
+                path = parent_obj.path / name.decode("utf-8")
+                security_descriptor = self.security_descriptor_pool.intern(
+                    SecurityDescriptor.from_bytes(descriptor)
+                )
+                if is_folder:
+                    file_obj = FolderObj(path, attributes, security_descriptor)
+                else:
+                    file_obj = FileObj(
+                        path,
+                        attributes,
+                        security_descriptor,
+                        allocation_size,
+                        storage=self.spill_storage,
+                    )
+                file_obj.creation_time = creation_time
+                file_obj.last_access_time = creation_time
+                file_obj.last_write_time = creation_time
+                file_obj.change_time = creation_time
+                file_obj.index_number = index_number
+                parent_obj.add_child(file_obj)
+                file_objs[index_number] = file_obj
+
+            elif record_type == _JOURNAL_WRITE:
+                _, offset, data = fields
+                file_obj.write(data, offset, False)
+
+            elif record_type == _JOURNAL_SET_FILE_SIZE:
+                _, size, is_allocation_size = fields
+                if is_allocation_size:
+                    file_obj.set_allocation_size(size)
+                else:
+                    file_obj.set_file_size(size)
+
+            elif record_type == _JOURNAL_RENAME:
+                _, new_parent_index_number, new_name = fields
+                new_parent_obj = file_objs[new_parent_index_number]
+                self._move_entry(
+                    file_obj,
+                    self._get_entry(file_obj.path.parent),
+                    new_parent_obj,
+                    new_parent_obj.path / new_name.decode("utf-8"),
+                )
+
+            elif record_type == _JOURNAL_SET_BASIC_INFO:
+                (
+                    _,
+                    file_obj.attributes,
+                    file_obj.creation_time,
+                    file_obj.last_access_time,
+                    file_obj.last_write_time,
+                    file_obj.change_time,
+                ) = fields
+
+            elif record_type == _JOURNAL_SET_SECURITY:
+                old_descriptor = file_obj.security_descriptor
+                file_obj.security_descriptor = self.security_descriptor_pool.intern(
+                    SecurityDescriptor.from_bytes(fields[1])
+                )
+                self.security_descriptor_pool.release(old_descriptor)
+
+            elif record_type == _JOURNAL_DELETE:
+                self._get_entry(file_obj.path.parent).remove_child(file_obj)
+                self._release_entry(file_obj)
+
+            elif record_type == _JOURNAL_SET_VOLUME_LABEL:
+                self._volume_info["volume_label"] = fields[0].decode("utf-8")
+
+        self._index_numbers = itertools.count(max(file_objs) + 1)
+
+    def checkpoint(self):
+        """Save an image of the file system and start a new journal"""
+        # The previous image can then be removed, even if it was loaded
+        self.journal.checkpoint(partial(self.save_image, rebase=True))
+
+    def _run_checkpoints(self, checkpoint_interval):
+        while not self._closed.wait(checkpoint_interval):
+            if self.journal.size:
+                self.checkpoint()
+
+    def shutdown(self):
+        """Stop the background threads and close the journal, if any"""
+        self._closed.set()
+        if self.dedupe_store is not None:
+            self.dedupe_store.close()
+            self._dedupe_thread.join()
+        if self.journal is not None:
+            self._checkpoint_thread.join()
+            self.journal.close()
+
+    # Deduplication
+
+    def _run_dedupe(self):
+        while True:
+            file_obj = self.dedupe_store.get_scheduled()
+            if file_obj is None:
+                return
+            try:
+                with self._file_locks.write(file_obj):
+                    self.dedupe_store.dedupe(file_obj)
+            # Keep deduplicating the other files
+            except Exception:
+                logging.exception(f"Cannot deduplicate {file_obj}")
+
+    def _get_physical_size(self):
+        stats = self.spill_storage.get_stats()
+        # The deduplicated blocks are chunks of the storage as well
+        return stats["ram_usage"] + stats["shared_ram_usage"] + stats["spilled_usage"]
+
+    def get_storage_stats(self):
+        """Size of the files, compared to the memory used for their data"""
+        with self._namespace_lock.read():
+            logical_size = sum(
+                file_obj.file_size
+                for file_obj, _ in self._walk(self._root_obj)
+                if isinstance(file_obj, FileObj)
+            )
+        return {"logical_size": logical_size, "physical_size": self._get_physical_size()}
 
     # Debugging helpers
 
+    @journaled
     def _create_directory(self, path):
         path = self._root_path / path
         obj = FolderObj(
             path,
             FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY,
-            self._root_obj.security_descriptor,
+            self.security_descriptor_pool.intern(self._root_obj.security_descriptor),
         )
-        self._entries[path] = obj
+        self._add_entry(self._get_entry(path.parent), obj)
+        self.negative_lookup_cache.invalidate(str(path))
 
+    @journaled
     def _import_files(self, file_path):
         file_path = Path(file_path)
         path = self._root_path / file_path.name
         obj = FileObj(
             path,
             FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE,
-            self._root_obj.security_descriptor,
+            self.security_descriptor_pool.intern(self._root_obj.security_descriptor),
+            storage=self.spill_storage,
+        )
+        self._add_entry(self._get_entry(path.parent), obj)
+        self.negative_lookup_cache.invalidate(str(path))
+        data = file_path.read_bytes()
+        obj.write(data, 0, False)
+        self._log(_JOURNAL_WRITE, obj.index_number, 0, data)
+        if self.dedupe_store is not None:
+            self.dedupe_store.schedule(obj)
+        self._spill_cold_files()
+
+    # Snapshots
+
+    def clone(self, read_only=False):
+        """
+        Return a new file system with the same content, e.g. to mount a fresh
+        copy of a fixture tree for each test.
+
+        Only the entries are copied, the file data being shared until modified
+        (see `FileObj.copy`), so each copy only costs its metadata and the
+        chunks it writes.
+        """
+        clone = type(self)(
+            self._volume_info["volume_label"],
+            read_only=read_only,
+            ram_budget=self.spill_storage.ram_budget,
+            spill_threshold=self.spill_storage.spill_threshold,
+            dedupe=self.dedupe_store is not None,
+        )
+        cloned_objs = {}
+        with self._namespace_lock.read():
+            for file_obj, parent_obj in self._walk(self._root_obj):
+                with self._file_locks.write(file_obj):
+                    cloned_obj = file_obj.copy(clone.spill_storage)
+                cloned_obj.security_descriptor = clone.security_descriptor_pool.intern(
+                    file_obj.security_descriptor
+                )
+                if parent_obj is not None:
+                    cloned_objs[parent_obj].add_child(cloned_obj)
+                cloned_objs[file_obj] = cloned_obj
+
+        clone._release_entry(clone._root_obj)
+        clone._root_obj = cloned_objs[self._root_obj]
+        clone._index_numbers = itertools.count(
+            max(file_obj.index_number for file_obj in cloned_objs.values()) + 1
+        )
+        return clone
+
+    def snapshot(self):
+        """Return a read-only copy of the file system, see `clone`"""
+        return self.clone(read_only=True)
+
+    # Images
+
+    def save_image(self, path, rebase=False):
+        """
+        Save the file system into an image at `path`, see `load_image`.
+
+        The image starts with a header, followed by the file data chunks (aligned
+        for memory mapping) and then by the table of the volume label, security
+        descriptors and entries. Each file is saved atomically, but the file
+        system as a whole is not frozen.
+
+        Saving over the image loaded by `load_image` copies the data still shared
+        with it beforehand, since a mapped file can't be replaced on Windows.
+        With `rebase`, the data shared with the loaded image is shared with the
+        saved image instead, so the former gets unmapped once no longer used.
+        """
+        path = Path(path)
+        tmp_path = path.with_name(path.name + ".tmp")
+        descriptors = {}
+        entries = []
+        indexes = {}
+        # (file, chunk index, chunk shared with the loaded image, offset in the saved image)
+        image_chunks = []
+        with open(tmp_path, "wb") as file, self._namespace_lock.read():
+            file.seek(mmap.ALLOCATIONGRANULARITY)
+            for file_obj, parent_obj in self._walk(self._root_obj):
+                indexes[file_obj] = len(indexes)
+                with self._file_locks.read(file_obj):
+                    descriptor = file_obj.security_descriptor.to_bytes()
+                    chunks = []
+                    if isinstance(file_obj, FileObj):
+                        for index in sorted(file_obj.get_chunk_indexes()):
+                            chunks.append(_IMAGE_CHUNK.pack(index, file.tell()))
+                            chunk = file_obj.shared_chunks.get(index)
+                            if rebase and self._is_image_chunk(chunk):
+                                image_chunks.append((file_obj, index, chunk, file.tell()))
+                            file.write(file_obj.get_chunk(index))
+                    name = file_obj.name.encode("utf-8")
+                    entry = _IMAGE_ENTRY.pack(
+                        -1 if parent_obj is None else indexes[parent_obj],
+                        isinstance(file_obj, FolderObj),
+                        file_obj.attributes,
+                        file_obj.creation_time,
+                        file_obj.last_access_time,
+                        file_obj.last_write_time,
+                        file_obj.change_time,
+                        file_obj.index_number,
+                        descriptors.setdefault(descriptor, len(descriptors)),
+                        file_obj.file_size,
+                        file_obj.allocation_size,
+                        len(chunks),
+                        len(name),
+                    )
+                    entries.append(b"".join([entry, name, *chunks]))
+
+            label = self._volume_info["volume_label"].encode("utf-8")
+            table = [_IMAGE_SIZE.pack(len(label)), label, _IMAGE_SIZE.pack(len(descriptors))]
+            for descriptor in descriptors:
+                table += [_IMAGE_SIZE.pack(len(descriptor)), descriptor]
+            table += [_IMAGE_SIZE.pack(len(entries)), *entries]
+            table = b"".join(table)
+            table_offset = file.tell()
+            file.write(table)
+            file.seek(0)
+            file.write(
+                _IMAGE_HEADER.pack(
+                    _IMAGE_MAGIC, _IMAGE_VERSION, FileObj.chunk_size, table_offset, len(table)
+                )
+            )
+        if self._image is not None and self._image[0] == path.resolve():
+            self._detach_image()
+        os.replace(tmp_path, path)
+        if image_chunks:
+            self._rebase_image(path, image_chunks)
+
+    def _is_image_chunk(self, chunk):
+        return (
+            self._image is not None
+            and isinstance(chunk, memoryview)
+            and chunk.obj is self._image[1]
         )
-        self._entries[path] = obj
-        obj.write(file_path.read_bytes(), 0, False)
+
+    def _rebase_image(self, path, image_chunks):
+        with open(path, "rb") as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        for file_obj, index, chunk, offset in image_chunks:
+            with self._file_locks.write(file_obj):
+                # Not modified in the meantime
+                if file_obj.shared_chunks.get(index) is chunk:
+                    file_obj.shared_chunks[index] = view[offset : offset + FileObj.chunk_size]
+        self._image = (path.resolve(), mapping)
+
+    def _detach_image(self):
+        """Copy the data shared with the loaded image, and unmap it if no longer used"""
+        _, mapping = self._image
+        with self._namespace_lock.read():
+            for file_obj, _ in self._walk(self._root_obj):
+                if not isinstance(file_obj, FileObj):
+                    continue
+                with self._file_locks.write(file_obj):
+                    for index, chunk in list(file_obj.shared_chunks.items()):
+                        if self._is_image_chunk(chunk):
+                            file_obj._get_writable_chunk(index)
+            self._image = None
+        self._spill_cold_files()
+        try:
+            mapping.close()
+        # Still shared with a clone or a snapshot
+        except BufferError:
+            logging.warning("Cannot unmap the image, it is still used by a copy")
+
+    def load_image(self, path):
+        """
+        Replace the content of the file system by the image at `path`, see `save_image`.
+
+        Only the metadata is loaded: the image is mapped in memory, so the data
+        of a file is only paged in when read, and copied once modified. The
+        image must not be modified while in use.
+
+        A journaled file system takes a checkpoint of the loaded content, so the
+        following changes are replayed against it on recovery.
+        """
+        with open(path, "rb") as file:
+            mapping = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapping)
+        magic, version, chunk_size, offset, _ = _IMAGE_HEADER.unpack_from(view)
+        if magic != _IMAGE_MAGIC or version != _IMAGE_VERSION:
+            raise ValueError(f"`{path}` is not a memfs image")
+        if chunk_size != FileObj.chunk_size:
+            raise ValueError(f"`{path}` has been saved with {chunk_size} bytes chunks")
+
+        def read_bytes():
+            nonlocal offset
+            (size,) = _IMAGE_SIZE.unpack_from(view, offset)
+            offset += _IMAGE_SIZE.size + size
+            return bytes(view[offset - size : offset])
+
+        volume_label = read_bytes().decode("utf-8")
+        (count,) = _IMAGE_SIZE.unpack_from(view, offset)
+        offset += _IMAGE_SIZE.size
+        descriptors = [SecurityDescriptor.from_bytes(read_bytes()) for _ in range(count)]
+
+        file_objs = []
+        (count,) = _IMAGE_SIZE.unpack_from(view, offset)
+        offset += _IMAGE_SIZE.size
+        for _ in range(count):
+            (
+                parent_index,
+                is_folder,
+                attributes,
+                creation_time,
+                last_access_time,
+                last_write_time,
+                change_time,
+                index_number,
+                descriptor_index,
+                file_size,
+                allocation_size,
+                chunk_count,
+                name_size,
+            ) = _IMAGE_ENTRY.unpack_from(view, offset)
+            offset += _IMAGE_ENTRY.size
+            name = bytes(view[offset : offset + name_size]).decode("utf-8")
+            offset += name_size
+
+            if parent_index < 0:
+                file_path = self._root_path
+            else:
+                file_path = file_objs[parent_index].path / name
+            security_descriptor = self.security_descriptor_pool.intern(
+                descriptors[descriptor_index]
+            )
+            if is_folder:
+                file_obj = FolderObj(file_path, attributes, security_descriptor)
+            else:
+                file_obj = FileObj(
+                    file_path,
+                    attributes,
+                    security_descriptor,
+                    allocation_size,
+                    storage=self.spill_storage,
+                )
+                file_obj.file_size = file_size
+                for _ in range(chunk_count):
+                    index, data_offset = _IMAGE_CHUNK.unpack_from(view, offset)
+                    offset += _IMAGE_CHUNK.size
+                    file_obj.shared_chunks[index] = view[data_offset : data_offset + chunk_size]
+                # Not forced to archive
+                file_obj.attributes = attributes
+            file_obj.creation_time = creation_time
+            file_obj.last_access_time = last_access_time
+            file_obj.last_write_time = last_write_time
+            file_obj.change_time = change_time
+            file_obj.index_number = index_number
+            if parent_index >= 0:
+                file_objs[parent_index].add_child(file_obj)
+            file_objs.append(file_obj)
+
+        def replace_content():
+            with self._namespace_lock.write():
+                for file_obj, _ in self._walk(self._root_obj):
+                    self._release_entry(file_obj)
+                self._root_obj = file_objs[0]
+                self._index_numbers = itertools.count(
+                    max(file_obj.index_number for file_obj in file_objs) + 1
+                )
+                self._volume_info["volume_label"] = volume_label
+                self._image = (Path(path).resolve(), mapping)
+                self.negative_lookup_cache.clear()
+
+        if self.journal is None:
+            replace_content()
+            return
+
+        # No change gets journaled between the replacement and the checkpoint,
+        # since the journaled operations are excluded during the checkpoint
+        def replace_content_and_save_image(image_path):
+            replace_content()
+            self.save_image(image_path, rebase=True)
+
+        self.journal.checkpoint(replace_content_and_save_image)
 
     # Winfsp operations
 
     @operation
     def get_volume_info(self):
-        return self._volume_info
+        with self._namespace_lock.read():
+            volume_info = dict(self._volume_info)
+        volume_info["free_size"] = max(0, volume_info["total_size"] - self._get_physical_size())
+        return volume_info
 
     @operation
+    @journaled
     def set_volume_label(self, volume_label):
-        self._volume_info["volume_label"] = volume_label
+        with self._namespace_lock.write():
+            self._volume_info["volume_label"] = volume_label
+            self._log(_JOURNAL_SET_VOLUME_LABEL, volume_label.encode("utf-8"))
 
     @operation
     def get_security_by_name(self, file_name):
-        file_name = PureWindowsPath(file_name)
+        file_name = self.file_name_cache.split(file_name)
 
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
+        with self._namespace_lock.read():
+            # Retrieve file
+            try:
+                file_obj = self._get_entry(file_name)
+            except KeyError:
+                raise NTStatusObjectNameNotFound()
 
-        return (
-            file_obj.attributes,
-            file_obj.security_descriptor.handle,
-            file_obj.security_descriptor.size,
-        )
+            return (
+                file_obj.attributes,
+                file_obj.security_descriptor.handle,
+                file_obj.security_descriptor.size,
+            )
 
     @operation
+    @journaled
     def create(
         self,
         file_name,
@@ -251,98 +1513,117 @@ class InMemoryFileSystemOperations(BaseFileSystemOperations):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        file_name = PureWindowsPath(file_name)
+        file_name = self.file_name_cache.split(file_name)
 
-        # `granted_access` is already handle by winfsp
-        # `allocation_size` useless for us
-
-        # Retrieve file
-        try:
-            parent_file_obj = self._entries[file_name.parent]
-            if isinstance(parent_file_obj, FileObj):
-                raise NTStatusNotADirectory()
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
+        with self._namespace_lock.write():
+            # `granted_access` is already handle by winfsp
+            # `allocation_size` useless for us
 
-        # File/Folder already exists
-        if file_name in self._entries:
-            raise NTStatusObjectNameCollision()
+            # Retrieve file
+            try:
+                parent_file_obj = self._get_entry(file_name.parent)
+                if isinstance(parent_file_obj, FileObj):
+                    raise NTStatusNotADirectory()
+            except KeyError:
+                raise NTStatusObjectNameNotFound()
 
-        if create_options & CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE:
-            file_obj = self._entries[file_name] = FolderObj(
-                file_name, file_attributes, security_descriptor
-            )
-        else:
-            file_obj = self._entries[file_name] = FileObj(
-                file_name,
-                file_attributes,
-                security_descriptor,
-                allocation_size,
-            )
+            # File/Folder already exists
+            if file_name.name.lower() in parent_file_obj.children:
+                raise NTStatusObjectNameCollision()
 
-        return OpenedObj(file_obj)
+            if create_options & CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE:
+                file_obj = FolderObj(file_name, file_attributes, security_descriptor)
+            else:
+                file_obj = FileObj(
+                    file_name,
+                    file_attributes,
+                    security_descriptor,
+                    allocation_size,
+                    storage=self.spill_storage,
+                )
+            self._add_entry(parent_file_obj, file_obj)
+
+            # Provide the file info right away, sparing a `get_file_info` call
+            return OpenResult(OpenedObj(file_obj), file_obj.get_file_info())
 
     @operation
     def get_security(self, file_context):
-        return file_context.file_obj.security_descriptor
+        with self._file_locks.read(file_context.file_obj):
+            return file_context.file_obj.security_descriptor
 
     @operation
+    @journaled
     def set_security(self, file_context, security_information, modification_descriptor):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        new_descriptor = file_context.file_obj.security_descriptor.evolve(
-            security_information, modification_descriptor
-        )
-        file_context.file_obj.security_descriptor = new_descriptor
+        with self._file_locks.write(file_context.file_obj):
+            old_descriptor = file_context.file_obj.security_descriptor
+            new_descriptor = old_descriptor.evolve(
+                security_information, modification_descriptor, pool=self.security_descriptor_pool
+            )
+            file_context.file_obj.security_descriptor = new_descriptor
+            self.security_descriptor_pool.release(old_descriptor)
+            self._log(
+                _JOURNAL_SET_SECURITY,
+                file_context.file_obj.index_number,
+                new_descriptor.to_bytes(),
+            )
 
     @operation
+    @journaled
     def rename(self, file_context, file_name, new_file_name, replace_if_exists):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        file_name = PureWindowsPath(file_name)
-        new_file_name = PureWindowsPath(new_file_name)
-
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
+        file_name = self.file_name_cache.split(file_name)
+        new_file_name = self.file_name_cache.split(new_file_name)
 
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
+        with self._namespace_lock.write():
+            # Retrieve file
+            try:
+                file_obj = self._get_entry(file_name)
+                parent_file_obj = self._get_entry(file_name.parent)
+                new_parent_file_obj = self._get_entry(new_file_name.parent)
+            except KeyError:
+                raise NTStatusObjectNameNotFound()
 
-        if new_file_name in self._entries:
-            # Case-sensitive comparison
-            if new_file_name.name != self._entries[new_file_name].path.name:
-                pass
-            elif not replace_if_exists:
-                raise NTStatusObjectNameCollision()
-            elif not isinstance(file_obj, FileObj):
-                raise NTStatusAccessDenied()
+            if isinstance(new_parent_file_obj, FileObj):
+                raise NTStatusNotADirectory()
 
-        for entry_path in list(self._entries):
-            try:
-                relative = entry_path.relative_to(file_name)
-                new_entry_path = new_file_name / relative
-                entry = self._entries.pop(entry_path)
-                entry.path = new_entry_path
-                self._entries[new_entry_path] = entry
-            except ValueError:
-                continue
+            replaced_obj = new_parent_file_obj.children.get(new_file_name.name.lower())
+            if replaced_obj is not None:
+                # Case-sensitive comparison
+                if new_file_name.name != replaced_obj.name:
+                    pass
+                elif not replace_if_exists:
+                    raise NTStatusObjectNameCollision()
+                elif not isinstance(file_obj, FileObj):
+                    raise NTStatusAccessDenied()
+
+            self._move_entry(file_obj, parent_file_obj, new_parent_file_obj, new_file_name)
+            self._log(
+                _JOURNAL_RENAME,
+                file_obj.index_number,
+                new_parent_file_obj.index_number,
+                new_file_name.name.encode("utf-8"),
+            )
 
     @operation
     def open(self, file_name, create_options, granted_access):
-        file_name = PureWindowsPath(file_name)
+        file_name = self.file_name_cache.split(file_name)
 
         # `granted_access` is already handle by winfsp
 
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
+        with self._namespace_lock.read():
+            # Retrieve file
+            try:
+                file_obj = self._get_entry(file_name)
+            except KeyError:
+                raise NTStatusObjectNameNotFound()
 
-        return OpenedObj(file_obj)
+            # Provide the file info right away, sparing a `get_file_info` call
+            return OpenResult(OpenedObj(file_obj), file_obj.get_file_info())
 
     @operation
     def close(self, file_context):
@@ -350,9 +1631,11 @@ class InMemoryFileSystemOperations(BaseFileSystemOperations):
 
     @operation
     def get_file_info(self, file_context):
-        return file_context.file_obj.get_file_info()
+        with self._file_locks.read(file_context.file_obj):
+            return file_context.file_obj.get_file_info()
 
     @operation
+    @journaled
     def set_basic_info(
         self,
         file_context,
@@ -366,113 +1649,144 @@ class InMemoryFileSystemOperations(BaseFileSystemOperations):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        file_obj = file_context.file_obj
-        if file_attributes != FILE_ATTRIBUTE.INVALID_FILE_ATTRIBUTES:
-            file_obj.attributes = file_attributes
-        if creation_time:
-            file_obj.creation_time = creation_time
-        if last_access_time:
-            file_obj.last_access_time = last_access_time
-        if last_write_time:
-            file_obj.last_write_time = last_write_time
-        if change_time:
-            file_obj.change_time = change_time
-
-        return file_obj.get_file_info()
+        with self._file_locks.write(file_context.file_obj):
+            file_obj = file_context.file_obj
+            if file_attributes != FILE_ATTRIBUTE.INVALID_FILE_ATTRIBUTES:
+                file_obj.attributes = file_attributes
+            if creation_time:
+                file_obj.creation_time = creation_time
+            if last_access_time:
+                file_obj.last_access_time = last_access_time
+            if last_write_time:
+                file_obj.last_write_time = last_write_time
+            if change_time:
+                file_obj.change_time = change_time
+            self._log_basic_info(file_obj)
+
+            return file_obj.get_file_info()
 
     @operation
+    @journaled
     def set_file_size(self, file_context, new_size, set_allocation_size):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        if set_allocation_size:
-            file_context.file_obj.set_allocation_size(new_size)
-        else:
-            file_context.file_obj.set_file_size(new_size)
+        with self._file_locks.write(file_context.file_obj):
+            if set_allocation_size:
+                file_context.file_obj.set_allocation_size(new_size)
+            else:
+                file_context.file_obj.set_file_size(new_size)
+            self._log(
+                _JOURNAL_SET_FILE_SIZE,
+                file_context.file_obj.index_number,
+                new_size,
+                set_allocation_size,
+            )
+            return file_context.file_obj.get_file_info()
 
     @operation
     def can_delete(self, file_context, file_name: str) -> None:
-        file_name = PureWindowsPath(file_name)
+        file_name = self.file_name_cache.split(file_name)
 
-        # Retrieve file
-        try:
-            file_obj = self._entries[file_name]
-        except KeyError:
-            raise NTStatusObjectNameNotFound
+        with self._namespace_lock.read():
+            # Retrieve file
+            try:
+                file_obj = self._get_entry(file_name)
+            except KeyError:
+                raise NTStatusObjectNameNotFound
 
-        if isinstance(file_obj, FolderObj):
-            for entry in self._entries.keys():
-                try:
-                    if entry.relative_to(file_name).parts:
-                        raise NTStatusDirectoryNotEmpty()
-                except ValueError:
-                    continue
+            if isinstance(file_obj, FolderObj) and file_obj.children:
+                raise NTStatusDirectoryNotEmpty()
 
     @operation
     def read_directory(self, file_context, marker):
-        entries = []
         file_obj = file_context.file_obj
 
         # Not a directory
         if isinstance(file_obj, FileObj):
             raise NTStatusNotADirectory()
 
-        # The "." and ".." should ONLY be included if the queried directory is not root
-        if file_obj.path != self._root_path:
-            parent_obj = self._entries[file_obj.path.parent]
-            entries.append({"file_name": ".", **file_obj.get_file_info()})
-            entries.append({"file_name": "..", **parent_obj.get_file_info()})
-
-        # Loop over all entries
-        for entry_path, entry_obj in self._entries.items():
-            try:
-                relative = entry_path.relative_to(file_obj.path)
-            # Filter out unrelated entries
-            except ValueError:
-                continue
-            # Filter out ourself or our grandchildren
-            if len(relative.parts) != 1:
-                continue
-            # Add direct chidren to the entry list
-            entries.append({"file_name": entry_path.name, **entry_obj.get_file_info()})
-
-        # Sort the entries
-        entries = sorted(entries, key=lambda x: x["file_name"])
+        return self._iter_directory(file_obj, marker)
 
-        # No filtering to apply
-        if marker is None:
-            return entries
+    def _iter_directory(self, file_obj, marker):
+        """
+        Yield the entries of `file_obj` following `marker`, "." and ".." first
+        and then the children sorted by name.
 
-        # Filter out all results before the marker
-        for i, entry in enumerate(entries):
-            if entry["file_name"] == marker:
-                return entries[i + 1 :]
+        The children are retrieved one page at a time, each page resuming
+        right after the last name yielded. So the caller only pays for the
+        entries it consumes, and the listing stays consistent even if entries
+        (including the marker) are deleted in the meantime.
+        """
+        # The "." and ".." should ONLY be included if the queried directory is not root
+        if file_obj.path != self._root_path and marker in (None, "."):
+            with self._namespace_lock.read():
+                parent_obj = self._get_entry(file_obj.path.parent)
+                dot_entries = [
+                    file_obj.get_file_info()._replace(file_name="."),
+                    parent_obj.get_file_info()._replace(file_name=".."),
+                ]
+            yield from dot_entries if marker is None else dot_entries[1:]
+        if marker in (".", ".."):
+            marker = None
+
+        page_size = self.read_directory_page_size
+        while True:
+            with self._namespace_lock.read():
+                page = [
+                    entry_obj.get_file_info()._replace(file_name=entry_obj.name)
+                    for entry_obj in file_obj.list_children(marker, page_size)
+                ]
+            yield from page
+            if len(page) < page_size:
+                return
+            marker = page[-1].file_name
 
     @operation
     def get_dir_info_by_name(self, file_context, file_name):
-        path = file_context.file_obj.path / file_name
-        try:
-            entry_obj = self._entries[path]
-        except KeyError:
-            raise NTStatusObjectNameNotFound()
+        with self._namespace_lock.read():
+            try:
+                entry_obj = file_context.file_obj.get_child(file_name)
+            except KeyError:
+                raise NTStatusObjectNameNotFound()
 
-        return {"file_name": file_name, **entry_obj.get_file_info()}
+            return entry_obj.get_file_info()._replace(file_name=file_name)
 
     @operation
     def read(self, file_context, offset, length):
-        return file_context.file_obj.read(offset, length)
+        with self._file_locks.read(file_context.file_obj):
+            return file_context.file_obj.read(offset, length)
+
+    @operation
+    def read_into(self, file_context, offset, buffer):
+        with self._file_locks.read(file_context.file_obj):
+            return file_context.file_obj.read_into(offset, buffer)
 
     @operation
+    @journaled
     def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        if constrained_io:
-            return file_context.file_obj.constrained_write(buffer, offset)
-        else:
-            return file_context.file_obj.write(buffer, offset, write_to_end_of_file)
+        with self._file_locks.write(file_context.file_obj):
+            file_obj = file_context.file_obj
+            if constrained_io:
+                length = file_obj.constrained_write(buffer, offset)
+            else:
+                if write_to_end_of_file:
+                    offset = file_obj.file_size
+                length = file_obj.write(buffer, offset, False)
+            if length and self.journal is not None:
+                self._log(_JOURNAL_WRITE, file_obj.index_number, offset, bytes(buffer[:length]))
+            file_info = file_obj.get_file_info()
+
+        if self.dedupe_store is not None:
+            self.dedupe_store.schedule(file_obj)
+        self._spill_cold_files()
+        return WriteResult(length, file_info)
 
     @operation
+    @journaled
     def cleanup(self, file_context, file_name, flags) -> None:
         if self.read_only:
             raise NTStatusMediaWriteProtected()
@@ -488,70 +1802,109 @@ class InMemoryFileSystemOperations(BaseFileSystemOperations):
 
         # Delete
         if flags & FspCleanupDelete:
+            with self._namespace_lock.write():
 
-            # Check for non-empty direcory
-            if any(key.parent == file_obj.path for key in self._entries):
-                return
-
-            # Delete immediately
-            try:
-                del self._entries[file_obj.path]
-            except KeyError:
-                raise NTStatusObjectNameNotFound()
-
-        # Resize
-        if flags & FspCleanupSetAllocationSize:
-            file_obj.adapt_allocation_size(file_obj.file_size)
-
-        # Set archive bit
-        if flags & FspCleanupSetArchiveBit and isinstance(file_obj, FileObj):
-            file_obj.attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
+                # Check for non-empty direcory
+                if isinstance(file_obj, FolderObj) and file_obj.children:
+                    return
 
-        # Set last access time
-        if flags & FspCleanupSetLastAccessTime:
-            file_obj.last_access_time = filetime_now()
-
-        # Set last access time
-        if flags & FspCleanupSetLastWriteTime:
-            file_obj.last_write_time = filetime_now()
-
-        # Set last access time
-        if flags & FspCleanupSetChangeTime:
-            file_obj.change_time = filetime_now()
+                # Delete immediately
+                try:
+                    parent_file_obj = self._get_entry(file_obj.path.parent)
+                    if parent_file_obj.get_child(file_obj.name) is not file_obj:
+                        raise KeyError(file_obj.path)
+                except KeyError:
+                    raise NTStatusObjectNameNotFound()
+                parent_file_obj.remove_child(file_obj)
+                self._release_entry(file_obj)
+                self._log(_JOURNAL_DELETE, file_obj.index_number)
+
+        with self._file_locks.write(file_obj):
+            # Resize
+            if flags & FspCleanupSetAllocationSize:
+                file_obj.adapt_allocation_size(file_obj.file_size)
+                self._log(
+                    _JOURNAL_SET_FILE_SIZE, file_obj.index_number, file_obj.allocation_size, True
+                )
+
+            # Set archive bit
+            if flags & FspCleanupSetArchiveBit and isinstance(file_obj, FileObj):
+                file_obj.attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
+
+            # Set last access time
+            if flags & FspCleanupSetLastAccessTime:
+                file_obj.last_access_time = filetime_now()
+
+            # Set last access time
+            if flags & FspCleanupSetLastWriteTime:
+                file_obj.last_write_time = filetime_now()
+
+            # Set last access time
+            if flags & FspCleanupSetChangeTime:
+                file_obj.change_time = filetime_now()
+
+            if flags & (
+                FspCleanupSetArchiveBit
+                | FspCleanupSetLastAccessTime
+                | FspCleanupSetLastWriteTime
+                | FspCleanupSetChangeTime
+            ):
+                self._log_basic_info(file_obj)
 
     @operation
+    @journaled
     def overwrite(
         self, file_context, file_attributes, replace_file_attributes: bool, allocation_size: int
-    ) -> None:
+    ) -> FileInfo:
         if self.read_only:
             raise NTStatusMediaWriteProtected()
 
-        file_obj = file_context.file_obj
+        with self._file_locks.write(file_context.file_obj):
+            file_obj = file_context.file_obj
 
-        # File attributes
-        file_attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
-        if replace_file_attributes:
-            file_obj.attributes = file_attributes
-        else:
-            file_obj.attributes |= file_attributes
+            # File attributes
+            file_attributes |= FILE_ATTRIBUTE.FILE_ATTRIBUTE_ARCHIVE
+            if replace_file_attributes:
+                file_obj.attributes = file_attributes
+            else:
+                file_obj.attributes |= file_attributes
 
-        # Allocation size
-        file_obj.set_allocation_size(allocation_size)
+            # Allocation size
+            file_obj.set_allocation_size(allocation_size)
 
-        # Set times
-        now = filetime_now()
-        file_obj.last_access_time = now
-        file_obj.last_write_time = now
-        file_obj.change_time = now
+            # Set times
+            now = filetime_now()
+            file_obj.last_access_time = now
+            file_obj.last_write_time = now
+            file_obj.change_time = now
+
+            self._log(_JOURNAL_SET_FILE_SIZE, file_obj.index_number, allocation_size, True)
+            self._log_basic_info(file_obj)
+            return file_obj.get_file_info()
 
     @operation
     def flush(self, file_context) -> None:
-        pass
+        if self.journal is not None:
+            self.journal.sync()
 
 
 def create_memory_file_system(
-    mountpoint, label="memfs", prefix="", verbose=True, debug=False, testing=False
+    mountpoint,
+    label="memfs",
+    prefix="",
+    verbose=True,
+    debug=False,
+    testing=False,
+    ram_budget=None,
+    spill_threshold=None,
+    image=None,
+    journal_dir=None,
+    dedupe=False,
 ):
+    # The content recovered from the journal would be replaced on each restart
+    if image is not None and journal_dir is not None:
+        raise ValueError("`image` cannot be used along with `journal_dir`")
+
     if debug:
         enable_debug_log()
 
@@ -564,7 +1917,15 @@ def create_memory_file_system(
     is_drive = mountpoint.parent == mountpoint
     reject_irp_prior_to_transact0 = not is_drive and not testing
 
-    operations = InMemoryFileSystemOperations(label)
+    operations = InMemoryFileSystemOperations(
+        label,
+        ram_budget=ram_budget,
+        spill_threshold=spill_threshold,
+        journal_dir=journal_dir,
+        dedupe=dedupe,
+    )
+    if image is not None:
+        operations.load_image(image)
     fs = FileSystem(
         str(mountpoint),
         operations,
@@ -609,6 +1970,7 @@ def main(mountpoint, label, prefix, verbose, debug):
     finally:
         print("Stopping FS")
         fs.stop()
+        fs.operations.shutdown()
         print("FS stopped")
 
 
@@ -1,10 +1,18 @@
+import os
 import sys
+import math
+import time
+import array
+import asyncio
+import struct
 import logging
 import threading
-from typing import List
-from functools import wraps
+from typing import Iterable, NamedTuple, Optional, Union
+from functools import wraps, partial
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from .plumbing import NTSTATUS, SecurityDescriptor, lib, ffi
+from .plumbing import NTSTATUS, SecurityDescriptor, lib, ffi, nt_success
 from .plumbing import NTStatusError
 
 
@@ -13,19 +21,89 @@ logger = logging.getLogger("winfspy")
 
 def _catch_unhandled_exceptions(fn):
     @wraps(fn)
-    def wrapper(*args, **kwargs):
+    def wrapper(self, *args, **kwargs):
         if sys.gettrace() != threading._trace_hook:
             sys.settrace(threading._trace_hook)
+        statistics = self.operation_statistics
+        if statistics is not None:
+            wall_start = time.perf_counter()
+            cpu_start = time.thread_time()
         try:
-            return fn(*args, **kwargs)
+            return fn(self, *args, **kwargs)
 
         except BaseException:
             logger.exception("Unhandled exception")
             return NTSTATUS.STATUS_UNEXPECTED_IO_ERROR
 
+        finally:
+            if statistics is not None:
+                statistics.record(
+                    fn.__name__,
+                    time.perf_counter() - wall_start,
+                    time.thread_time() - cpu_start,
+                )
+
     return wrapper
 
 
+class OperationStatistics:
+    """
+    Time spent by the dispatcher threads in each operation.
+
+    `wall_time` is the time spent in the handler, while `cpu_time` is the CPU
+    time consumed by the handling thread, which approximates the time the GIL
+    was held. An operation waiting on an I/O-bound backend has a high
+    wall/cpu ratio and benefits from more dispatcher threads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Operation name -> [count, wall time, cpu time]
+        self._operations = {}
+
+    def record(self, name: str, wall_time: float, cpu_time: float) -> None:
+        with self._lock:
+            stats = self._operations.get(name)
+            if stats is None:
+                stats = self._operations[name] = [0, 0.0, 0.0]
+            stats[0] += 1
+            stats[1] += wall_time
+            stats[2] += cpu_time
+
+    def get_stats(self) -> dict:
+        """
+        Returns a dict of operation name -> (count, wall time, cpu time).
+        """
+        with self._lock:
+            return {name: tuple(stats) for name, stats in self._operations.items()}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._operations.clear()
+
+    def recommended_dispatcher_threads(self, max_threads: Optional[int] = None) -> Optional[int]:
+        """
+        Number of dispatcher threads needed to keep the GIL busy, i.e. the
+        wall/cpu ratio of the recorded operations. Returns `None` if there is
+        nothing recorded yet.
+
+        Note the wall time includes the wait for the GIL, so the ratio is
+        overestimated once there are more threads than needed: hence
+        `max_threads` (defaults to 4 threads per CPU).
+        """
+        if max_threads is None:
+            max_threads = 4 * (os.cpu_count() or 1)
+        with self._lock:
+            wall_time = sum(stats[1] for stats in self._operations.values())
+            cpu_time = sum(stats[2] for stats in self._operations.values())
+        if not wall_time:
+            return None
+        # Thread CPU time has a coarse resolution on Windows (~15ms)
+        if not cpu_time:
+            return max_threads
+        return max(1, min(max_threads, math.ceil(wall_time / cpu_time)))
+
+
 # Because `encode('UTF16')` appends a BOM a the begining of the output
 _STRING_ENCODING = "UTF-16-LE" if sys.byteorder == "little" else "UTF-16-BE"
 
@@ -34,6 +112,63 @@ class BaseFileContext:
     pass
 
 
+class FileInfo(NamedTuple):
+    """
+    File information, to be returned by `get_file_info`, `set_basic_info`,
+    `get_dir_info_by_name` and `read_directory` (with `file_name` provided)
+    as a cheaper alternative to a dict.
+    """
+
+    file_attributes: int = 0
+    reparse_tag: int = 0
+    allocation_size: int = 0
+    file_size: int = 0
+    creation_time: int = 0
+    last_access_time: int = 0
+    last_write_time: int = 0
+    change_time: int = 0
+    index_number: int = 0
+    file_name: Optional[str] = None
+
+
+class OpenResult(NamedTuple):
+    """
+    File context along with its file info, to be returned by `create` and
+    `open` to avoid the subsequent `get_file_info` call.
+    """
+
+    file_context: object
+    file_info: Union[FileInfo, dict]
+
+
+class WriteResult(NamedTuple):
+    """
+    Number of bytes written along with the file info, to be returned by
+    `write` to avoid the subsequent `get_file_info` call.
+    """
+
+    bytes_transferred: int
+    file_info: Union[FileInfo, dict]
+
+
+# FSP_FSCTL_FILE_INFO layout, the trailing field being `HardLinks` (always 0)
+_FILE_INFO_STRUCT = struct.Struct("=IIQQQQQQQI4x")
+assert _FILE_INFO_STRUCT.size == ffi.sizeof("FSP_FSCTL_FILE_INFO")
+
+_DIR_INFO_SIZE = ffi.sizeof("FSP_FSCTL_DIR_INFO")
+_DIRECTORY_BUFFER_BATCH_SIZE = 1024
+
+
+def write_file_info(file_info, info):
+    """
+    Fill a `FSP_FSCTL_FILE_INFO*` from either a `FileInfo` or a dict.
+    """
+    if isinstance(info, FileInfo):
+        ffi.memmove(file_info, _FILE_INFO_STRUCT.pack(*info[:9], 0), _FILE_INFO_STRUCT.size)
+    else:
+        configure_file_info(file_info, **info)
+
+
 def configure_file_info(file_info, **kwargs):
     file_info.FileAttributes = kwargs.get("file_attributes", 0)
     file_info.ReparseTag = kwargs.get("reparse_tag", 0)
@@ -46,9 +181,436 @@ def configure_file_info(file_info, **kwargs):
     file_info.IndexNumber = kwargs.get("index_number", 0)
 
 
-class BaseFileSystemOperations:
+def _file_info_values(info):
+    if isinstance(info, FileInfo):
+        return info[:9]
+    return (
+        info.get("file_attributes", 0),
+        info.get("reparse_tag", 0),
+        info.get("allocation_size", 0),
+        info.get("file_size", 0),
+        info.get("creation_time", 0),
+        info.get("last_access_time", 0),
+        info.get("last_write_time", 0),
+        info.get("change_time", 0),
+        info.get("index_number", 0),
+    )
+
+
+class _DirInfoBatch:
+    """
+    Pack directory entries in a layout suitable for the batched
+    `FSP_FSCTL_DIR_INFO` helpers, so WinFSP is called once per batch
+    instead of once per entry.
+    """
+
     def __init__(self):
-        self._opened_objs = {}
+        self.file_infos = bytearray()
+        self.file_names = bytearray()
+        self.name_offsets = array.array("I", [0])
+
+    def __len__(self):
+        return len(self.name_offsets) - 1
+
+    def append(self, entry_info):
+        """
+        Returns the size the entry will use in the transfer buffer.
+        """
+        if isinstance(entry_info, FileInfo):
+            file_name = entry_info.file_name
+        else:
+            file_name = entry_info["file_name"]
+        # Note: Windows does not use NULL-terminated string
+        file_name_encoded = file_name.encode(_STRING_ENCODING)
+        if len(file_name_encoded) > lib.WFSPY_DIR_INFO_FILE_NAME_SIZEMAX:
+            raise ValueError(
+                f"`file_name` should be at most {lib.WFSPY_DIR_INFO_FILE_NAME_SIZEMAX} "
+                "bytes long once encoded in UTF16 !"
+            )
+        self.file_infos += _FILE_INFO_STRUCT.pack(*_file_info_values(entry_info), 0)
+        self.file_names += file_name_encoded
+        self.name_offsets.append(len(self.file_names))
+        # FSP_FSCTL_DIR_INFO base struct + WCHAR[] string, aligned on 8 bytes
+        return (_DIR_INFO_SIZE + len(file_name_encoded) + 7) & ~7
+
+    def _cooked_args(self):
+        # Buffers returned by `ffi.from_buffer` must be kept alive during the call
+        return (
+            ffi.cast("FSP_FSCTL_FILE_INFO*", ffi.from_buffer(self.file_infos)),
+            ffi.cast("UINT8*", ffi.from_buffer(self.file_names)),
+            ffi.cast("UINT32*", ffi.from_buffer(self.name_offsets)),
+            len(self),
+        )
+
+    def add_to_buffer(self, buffer, length, p_bytes_transferred):
+        """
+        Returns the number of entries that fit in the transfer buffer.
+        """
+        if not len(self):
+            return 0
+        file_infos, file_names, name_offsets, count = self._cooked_args()
+        return lib.add_FSP_FSCTL_DIR_INFO_batch(
+            file_infos, file_names, name_offsets, count, buffer, length, p_bytes_transferred
+        )
+
+    def fill_directory_buffer(self, p_dir_buffer, p_result):
+        """
+        Returns the number of entries added to the directory buffer.
+        """
+        if not len(self):
+            return 0
+        file_infos, file_names, name_offsets, count = self._cooked_args()
+        return lib.fill_FSP_FSCTL_DIR_INFO_batch(
+            file_infos, file_names, name_offsets, count, p_dir_buffer, p_result
+        )
+
+
+def _add_dir_infos(entries_info, buffer, length, p_bytes_transferred):
+    """
+    Add entries to the transfer buffer until it is full.
+
+    Returns True if all the entries have been added.
+    """
+    batch = _DirInfoBatch()
+    available = length - p_bytes_transferred[0]
+    exhausted = True
+    with _closing_iterator(entries_info):
+        for entry_info in entries_info:
+            available -= batch.append(entry_info)
+            # No need to pull more entries once the buffer is full
+            if available < 0:
+                exhausted = False
+                break
+    count = batch.add_to_buffer(buffer, length, p_bytes_transferred)
+    return exhausted and count == len(batch)
+
+
+def split_file_name(file_name):
+    """
+    Split a file name into its components, e.g. `\\foo\\bar` -> `("foo", "bar")`.
+    """
+    return tuple(part for part in file_name.split("\\") if part)
+
+
+class FileNameCache:
+    """
+    Bounded LRU cache of the file names provided by WinFSP.
+
+    The cache is keyed on the raw UTF-16 bytes of the names and yields
+    interned strings, so a name looked up repeatedly (e.g. `get_security_by_name`
+    -> `open` -> `get_file_info` for the same path) is only decoded once.
+
+    `split` is an optional callable (e.g. `split_file_name` or `PureWindowsPath`)
+    whose result is computed along with the decoded name and kept in cache,
+    see `FileNameCache.split`.
+    """
+
+    def __init__(self, maxsize=1024, split=None):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._split = split
+        self._lock = threading.Lock()
+        self._names = OrderedDict()
+        self._splitted_names = {}
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def cook(self, file_name) -> str:
+        """
+        Decode a `PWSTR` file name.
+        """
+        raw = ffi.buffer(file_name, lib.wcslen(file_name) * 2)[:]
+        with self._lock:
+            cooked = self._names.get(raw)
+            if cooked is not None:
+                self._names.move_to_end(raw)
+                self.hits += 1
+                return cooked
+            self.misses += 1
+
+        cooked = sys.intern(raw.decode(_STRING_ENCODING, "surrogatepass"))
+        splitted = self._split(cooked) if self._split is not None else None
+        with self._lock:
+            self._names[raw] = cooked
+            if self._split is not None:
+                self._splitted_names[cooked] = splitted
+            if len(self._names) > self.maxsize:
+                _, evicted = self._names.popitem(last=False)
+                self._splitted_names.pop(evicted, None)
+        return cooked
+
+    def split(self, file_name: str):
+        """
+        Returns the result of the `split` callable for `file_name`, without
+        computing it again if the name is in cache.
+
+        Raises `ValueError` if the cache was created without `split` callable.
+        """
+        if self._split is None:
+            raise ValueError("FileNameCache created without `split` callable")
+        with self._lock:
+            splitted = self._splitted_names.get(file_name)
+        if splitted is None:
+            splitted = self._split(file_name)
+        return splitted
+
+    def clear(self):
+        with self._lock:
+            self._names.clear()
+            self._splitted_names.clear()
+
+
+class NegativeLookupCache:
+    """
+    Bounded cache of the file names known not to exist, so the probes for
+    nonexistent names (e.g. `desktop.ini`, `Thumbs.db`) don't go through
+    `get_security_by_name` again and again.
+
+    Each entry is recorded along with the generation of its parent directory.
+    Creating a name in a directory increments the generation of this directory,
+    which invalidates all its entries at once. Renaming increments the epoch of
+    the whole cache, since the names below a renamed directory are affected.
+
+    With `case_sensitive` disabled, names are compared case-insensitively.
+    """
+
+    def __init__(self, maxsize=4096, case_sensitive=True):
+        self.maxsize = maxsize
+        self.case_sensitive = case_sensitive
+        self.hits = 0
+        self._lock = threading.Lock()
+        # File name -> (parent generation, epoch), least recently used first
+        self._entries = OrderedDict()
+        self._generations = {}
+        self._epoch = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _split(self, file_name):
+        if not self.case_sensitive:
+            file_name = file_name.casefold()
+        parent_name = file_name.rpartition("\\")[0] or "\\"
+        return file_name, parent_name
+
+    def lookup(self, file_name: str):
+        """
+        Returns `(True, None)` if `file_name` is known not to exist, `(False, token)`
+        otherwise. The token is to be provided to `add` if the name turns out
+        not to exist.
+        """
+        file_name, parent_name = self._split(file_name)
+        with self._lock:
+            token = (self._generations.get(parent_name, 0), self._epoch)
+            entry = self._entries.get(file_name)
+            if entry is None:
+                return False, token
+            if entry != token:
+                del self._entries[file_name]
+                return False, token
+            self._entries.move_to_end(file_name)
+            self.hits += 1
+            return True, None
+
+    def add(self, file_name: str, token) -> None:
+        file_name, parent_name = self._split(file_name)
+        with self._lock:
+            # The name might have been created since the lookup
+            if token != (self._generations.get(parent_name, 0), self._epoch):
+                return
+            self._entries[file_name] = token
+            self._entries.move_to_end(file_name)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, file_name: str) -> None:
+        """
+        To be called when `file_name` is created.
+        """
+        _, parent_name = self._split(file_name)
+        with self._lock:
+            self._generations[parent_name] = self._generations.get(parent_name, 0) + 1
+            # Keep the generations bounded, starting a new epoch is equivalent
+            if len(self._generations) > self.maxsize:
+                self._generations.clear()
+                self._epoch += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._epoch += 1
+
+
+class FileContextTable:
+    """
+    Opened file contexts, referenced by WinFSP through an integer handle (the
+    `PFileContext` value) instead of a cffi handle.
+
+    The contexts are stored in a slot array with a free-list, the handle being
+    made of the slot index and the generation of the slot. Hence resolving a
+    handle is a list lookup, and a stale handle (i.e. used after close) is
+    detected instead of resolving to the context now occupying the slot.
+    """
+
+    _SLOT_BITS = 24
+    _SLOT_MASK = (1 << _SLOT_BITS) - 1
+    _GENERATION_MASK = (1 << (ffi.sizeof("void*") * 8 - _SLOT_BITS)) - 1
+
+    def __init__(self, capacity=1024):
+        self._lock = threading.Lock()
+        self._contexts = [None] * capacity
+        self._generations = [0] * capacity
+        self._free_slots = list(reversed(range(capacity)))
+        self.peak_usage = 0
+
+    def __len__(self):
+        return len(self._contexts) - len(self._free_slots)
+
+    @property
+    def capacity(self):
+        return len(self._contexts)
+
+    def add(self, context):
+        """
+        Store `context` and returns its handle.
+        """
+        with self._lock:
+            if not self._free_slots:
+                capacity = len(self._contexts)
+                if capacity > self._SLOT_MASK:
+                    raise NTStatusError(NTSTATUS.STATUS_INSUFFICIENT_RESOURCES)
+                new_capacity = min(2 * capacity, self._SLOT_MASK + 1)
+                self._contexts += [None] * (new_capacity - capacity)
+                self._generations += [0] * (new_capacity - capacity)
+                self._free_slots = list(reversed(range(capacity, new_capacity)))
+            slot = self._free_slots.pop()
+            self._contexts[slot] = context
+            self.peak_usage = max(self.peak_usage, len(self))
+            generation = self._generations[slot]
+        # Slot is shifted by one so a handle is never NULL
+        return ffi.cast("void*", (generation << self._SLOT_BITS) | (slot + 1))
+
+    def _resolve(self, handle):
+        value = int(ffi.cast("uintptr_t", handle))
+        slot = (value & self._SLOT_MASK) - 1
+        if (
+            not 0 <= slot < len(self._contexts)
+            or self._contexts[slot] is None
+            or self._generations[slot] != value >> self._SLOT_BITS
+        ):
+            raise ValueError(f"Invalid or stale file context handle {value:#x}")
+        return slot
+
+    def get(self, handle):
+        """
+        Returns the context corresponding to `handle` (`None` for a NULL handle).
+        """
+        if handle == ffi.NULL:
+            return None
+        return self._contexts[self._resolve(handle)]
+
+    def remove(self, handle):
+        """
+        Release the slot of `handle`, returns the context it was storing.
+        """
+        with self._lock:
+            slot = self._resolve(handle)
+            context = self._contexts[slot]
+            self._contexts[slot] = None
+            self._generations[slot] = (self._generations[slot] + 1) & self._GENERATION_MASK
+            self._free_slots.append(slot)
+        return context
+
+    def contexts(self):
+        """
+        Returns the contexts currently opened, e.g. to look for leaks.
+        """
+        return [context for context in self._contexts if context is not None]
+
+    def get_stats(self) -> dict:
+        return {"used": len(self), "capacity": self.capacity, "peak_usage": self.peak_usage}
+
+
+@contextmanager
+def _closing_iterator(iterable):
+    try:
+        yield
+    finally:
+        # Release the resources of a generator that hasn't been exhausted
+        close = getattr(iterable, "close", None)
+        if close is not None:
+            close()
+
+
+class BaseFileSystemOperations:
+    def __init__(
+        self,
+        directory_buffer=False,
+        file_name_cache=None,
+        security_descriptor_pool=None,
+        operation_statistics=None,
+        negative_lookup_cache=None,
+    ):
+        """
+        With `directory_buffer` enabled, the listing of a directory is built once
+        per opened directory and kept in a WinFSP directory buffer. Continuation
+        requests (i.e. with a marker) are then served from this buffer without
+        calling `read_directory` again.
+
+        `file_name_cache` is an optional `FileNameCache` used to decode the
+        file names provided by WinFSP.
+
+        `security_descriptor_pool` is an optional `SecurityDescriptorPool` the
+        security descriptors passed to `create` are acquired from. It is then up
+        to the implementation to release them.
+
+        `operation_statistics` is an optional `OperationStatistics` recording
+        the time spent in each operation.
+
+        `negative_lookup_cache` is an optional `NegativeLookupCache` remembering
+        the names `get_security_by_name` didn't find. The implementation must
+        invalidate it if names get created without going through `create`.
+        """
+        self.file_contexts = FileContextTable()
+        self._file_system = None
+        self.file_name_cache = file_name_cache
+        self.security_descriptor_pool = security_descriptor_pool
+        self.operation_statistics = operation_statistics
+        self.negative_lookup_cache = negative_lookup_cache
+        self._directory_buffer_enabled = directory_buffer
+        self._directory_buffers = {}
+        # `read_into` is optional, `read` is used as a fallback
+        self._read_into_available = self._is_implemented("read_into")
+
+    def _is_implemented(self, name: str) -> bool:
+        # Optional operations are detected by checking if they are overloaded
+        return getattr(type(self), name) is not getattr(BaseFileSystemOperations, name)
+
+    def _bind_file_system(self, file_system) -> None:
+        # Called by the `FileSystem` these operations are provided to
+        self._file_system = file_system
+
+    def _write_file_info(self, cooked_file_context, file_info, info) -> NTSTATUS:
+        # Operations might return the file info along with their result,
+        # otherwise fall back on `get_file_info`
+        if info is None:
+            try:
+                info = self.get_file_info(cooked_file_context)
+
+            except NTStatusError as exc:
+                return exc.value
+
+        write_file_info(file_info, info)
+
+        return NTSTATUS.STATUS_SUCCESS
+
+    def _cook_file_name(self, file_name):
+        if self.file_name_cache is None:
+            return ffi.string(file_name)
+        return self.file_name_cache.cook(file_name)
 
     # ~~~ GET_VOLUME_INFO ~~~
 
@@ -121,11 +683,23 @@ class BaseFileSystemOperations:
         """
         Get file or directory attributes and security descriptor given a file name.
         """
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_name = self._cook_file_name(file_name)
+
+        negative_lookup_cache = self.negative_lookup_cache
+        if negative_lookup_cache is not None:
+            missing, token = negative_lookup_cache.lookup(cooked_file_name)
+            if missing:
+                return NTSTATUS.STATUS_OBJECT_NAME_NOT_FOUND
+
         try:
             fa, sd, sd_size = self.get_security_by_name(cooked_file_name)
 
         except NTStatusError as exc:
+            if (
+                negative_lookup_cache is not None
+                and exc.value == NTSTATUS.STATUS_OBJECT_NAME_NOT_FOUND
+            ):
+                negative_lookup_cache.add(cooked_file_name, token)
             return exc.value
 
         # Get file attributes
@@ -171,14 +745,17 @@ class BaseFileSystemOperations:
         """
         Create new file or directory.
         """
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_name = self._cook_file_name(file_name)
 
         # `granted_access` is already handle by winfsp
 
-        security_descriptor = SecurityDescriptor.from_cpointer(security_descriptor)
+        if self.security_descriptor_pool is not None:
+            security_descriptor = self.security_descriptor_pool.acquire(security_descriptor)
+        else:
+            security_descriptor = SecurityDescriptor.from_cpointer(security_descriptor)
 
         try:
-            cooked_file_context = self.create(
+            ret = self.create(
                 cooked_file_name,
                 create_options,
                 granted_access,
@@ -188,14 +765,20 @@ class BaseFileSystemOperations:
             )
 
         except NTStatusError as exc:
+            if self.security_descriptor_pool is not None:
+                self.security_descriptor_pool.release(security_descriptor)
             return exc.value
 
-        file_context = ffi.new_handle(cooked_file_context)
-        p_file_context[0] = file_context
-        # Prevent GC on obj and it handle
-        self._opened_objs[file_context] = cooked_file_context
+        if self.negative_lookup_cache is not None:
+            self.negative_lookup_cache.invalidate(cooked_file_name)
+
+        if isinstance(ret, OpenResult):
+            cooked_file_context, info = ret
+        else:
+            cooked_file_context, info = ret, None
+        p_file_context[0] = self.file_contexts.add(cooked_file_context)
 
-        return self.ll_get_file_info(file_context, file_info)
+        return self._write_file_info(cooked_file_context, file_info, info)
 
     def create(
         self,
@@ -205,7 +788,11 @@ class BaseFileSystemOperations:
         file_attributes,
         security_descriptor,
         allocation_size,
-    ) -> BaseFileContext:
+    ) -> Union[BaseFileContext, OpenResult]:
+        """
+        Returns the file context, or an `OpenResult` to avoid the subsequent
+        `get_file_info` call.
+        """
         raise NotImplementedError()
 
     # ~~~ OPEN ~~~
@@ -217,22 +804,26 @@ class BaseFileSystemOperations:
         """
         Open a file or directory.
         """
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_name = self._cook_file_name(file_name)
 
         try:
-            cooked_file_context = self.open(cooked_file_name, create_options, granted_access)
+            ret = self.open(cooked_file_name, create_options, granted_access)
 
         except NTStatusError as exc:
             return exc.value
 
-        file_context = ffi.new_handle(cooked_file_context)
-        p_file_context[0] = file_context
-        # Prevent GC on obj and it handle
-        self._opened_objs[file_context] = cooked_file_context
+        if isinstance(ret, OpenResult):
+            cooked_file_context, info = ret
+        else:
+            cooked_file_context, info = ret, None
+        p_file_context[0] = self.file_contexts.add(cooked_file_context)
 
-        return self.ll_get_file_info(file_context, file_info)
+        return self._write_file_info(cooked_file_context, file_info, info)
 
-    def open(self, file_context) -> BaseFileContext:
+    def open(self, file_name, create_options, granted_access) -> Union[BaseFileContext, OpenResult]:
+        """
+        Same return value than `create`.
+        """
         raise NotImplementedError()
 
     # ~~~ OVERWRITE ~~~
@@ -249,9 +840,9 @@ class BaseFileSystemOperations:
         """
         Overwrite a file.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
-            self.overwrite(
+            info = self.overwrite(
                 cooked_file_context,
                 file_attributes,
                 replace_file_attributes,
@@ -261,7 +852,7 @@ class BaseFileSystemOperations:
         except NTStatusError as exc:
             return exc.value
 
-        return self.ll_get_file_info(file_context, file_info)
+        return self._write_file_info(cooked_file_context, file_info, info)
 
     def overwrite(
         self,
@@ -269,7 +860,10 @@ class BaseFileSystemOperations:
         file_attributes,
         replace_file_attributes: bool,
         allocation_size: int,
-    ) -> None:
+    ) -> Optional[Union[FileInfo, dict]]:
+        """
+        Might return the file info to avoid the subsequent `get_file_info` call.
+        """
         raise NotImplementedError()
 
     # ~~~ CLEANUP ~~~
@@ -279,9 +873,9 @@ class BaseFileSystemOperations:
         """
         Cleanup a file.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         if file_name:
-            cooked_file_name = ffi.string(file_name)
+            cooked_file_name = self._cook_file_name(file_name)
         else:
             cooked_file_name = None
         # TODO: convert flags into kwargs ?
@@ -301,14 +895,19 @@ class BaseFileSystemOperations:
         """
         Close a file.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
+
+        p_dir_buffer = self._directory_buffers.pop(file_context, None)
+        if p_dir_buffer is not None:
+            lib.FspFileSystemDeleteDirectoryBuffer(p_dir_buffer)
+
         try:
             self.close(cooked_file_context)
 
         except NTStatusError as exc:
             return exc.value
 
-        del self._opened_objs[file_context]
+        self.file_contexts.remove(file_context)
 
     def close(self, file_context) -> None:
         raise NotImplementedError()
@@ -320,7 +919,18 @@ class BaseFileSystemOperations:
         """
         Read a file.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
+        if self._read_into_available:
+            # Let the implementation fill the WinFSP buffer without intermediate copy
+            cooked_buffer = memoryview(ffi.buffer(buffer, length))
+            try:
+                p_bytes_transferred[0] = self.read_into(cooked_file_context, offset, cooked_buffer)
+
+            except NTStatusError as exc:
+                return exc.value
+
+            return NTSTATUS.STATUS_SUCCESS
+
         try:
             data = self.read(cooked_file_context, offset, length)
 
@@ -335,6 +945,18 @@ class BaseFileSystemOperations:
     def read(self, file_context, offset: int, length: int) -> bytes:
         raise NotImplementedError()
 
+    def read_into(self, file_context, offset: int, buffer: memoryview) -> int:
+        """
+        Optional zero-copy alternative to `read`, used in its place when overloaded.
+
+        `buffer` is a writable memoryview over the WinFSP transfer buffer, its
+        length being the requested read length. The view must not be kept
+        after the call returns.
+
+        Returns: the number of bytes written in `buffer`
+        """
+        raise NotImplementedError()
+
     # ~~~ WRITE ~~~
 
     @_catch_unhandled_exceptions
@@ -352,11 +974,11 @@ class BaseFileSystemOperations:
         """
         Write a file.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         cooked_buffer = ffi.buffer(buffer, length)
 
         try:
-            p_bytes_transferred[0] = self.write(
+            ret = self.write(
                 cooked_file_context,
                 cooked_buffer,
                 offset,
@@ -367,9 +989,20 @@ class BaseFileSystemOperations:
         except NTStatusError as exc:
             return exc.value
 
-        return self.ll_get_file_info(file_context, file_info)
+        if isinstance(ret, WriteResult):
+            p_bytes_transferred[0], info = ret
+        else:
+            p_bytes_transferred[0], info = ret, None
+
+        return self._write_file_info(cooked_file_context, file_info, info)
 
-    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+    def write(
+        self, file_context, buffer, offset, write_to_end_of_file, constrained_io
+    ) -> Union[int, WriteResult]:
+        """
+        Returns the number of bytes written, or a `WriteResult` to avoid the
+        subsequent `get_file_info` call.
+        """
         raise NotImplementedError()
 
     # ~~~ FLUSH ~~~
@@ -379,16 +1012,24 @@ class BaseFileSystemOperations:
         """
         Flush a file or volume.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
-            self.flush(cooked_file_context)
+            info = self.flush(cooked_file_context)
 
         except NTStatusError as exc:
             return exc.value
 
-        return self.ll_get_file_info(file_context, file_info)
+        # No file info when flushing the volume
+        if cooked_file_context is None:
+            return NTSTATUS.STATUS_SUCCESS
 
-    def flush(self, file_context) -> None:
+        return self._write_file_info(cooked_file_context, file_info, info)
+
+    def flush(self, file_context) -> Optional[Union[FileInfo, dict]]:
+        """
+        `file_context` is `None` when flushing the volume. Might return the file
+        info to avoid the subsequent `get_file_info` call.
+        """
         raise NotImplementedError()
 
     # ~~~ GET_FILE_INFO ~~~
@@ -398,7 +1039,7 @@ class BaseFileSystemOperations:
         """
         Get file or directory information.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
             ret = self.get_file_info(cooked_file_context)
 
@@ -407,19 +1048,11 @@ class BaseFileSystemOperations:
 
         # TODO: handle WIN32 -> POSIX date conversion here ?
 
-        file_info.FileAttributes = ret.get("file_attributes", 0)
-        file_info.ReparseTag = ret.get("reparse_tag", 0)
-        file_info.AllocationSize = ret.get("allocation_size", 0)
-        file_info.FileSize = ret.get("file_size", 0)
-        file_info.CreationTime = ret.get("creation_time", 0)
-        file_info.LastAccessTime = ret.get("last_access_time", 0)
-        file_info.LastWriteTime = ret.get("last_write_time", 0)
-        file_info.ChangeTime = ret.get("change_time", 0)
-        file_info.IndexNumber = ret.get("index_number", 0)
+        write_file_info(file_info, ret)
 
         return NTSTATUS.STATUS_SUCCESS
 
-    def get_file_info(self, file_context) -> dict:
+    def get_file_info(self, file_context) -> Union[FileInfo, dict]:
         raise NotImplementedError()
 
     # ~~~ SET_BASIC_INFO ~~~
@@ -438,7 +1071,7 @@ class BaseFileSystemOperations:
         """
         Set file or directory basic information.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         # TODO: handle WIN32 -> POSIX date conversion here ?
         try:
             ret = self.set_basic_info(
@@ -454,15 +1087,7 @@ class BaseFileSystemOperations:
         except NTStatusError as exc:
             return exc.value
 
-        file_info.FileAttributes = ret.get("file_attributes", 0)
-        file_info.ReparseTag = ret.get("reparse_tag", 0)
-        file_info.AllocationSize = ret.get("allocation_size", 0)
-        file_info.FileSize = ret.get("file_size", 0)
-        file_info.CreationTime = ret.get("creation_time", 0)
-        file_info.LastAccessTime = ret.get("last_access_time", 0)
-        file_info.LastWriteTime = ret.get("last_write_time", 0)
-        file_info.ChangeTime = ret.get("change_time", 0)
-        file_info.IndexNumber = ret.get("index_number", 0)
+        write_file_info(file_info, ret)
 
         return NTSTATUS.STATUS_SUCCESS
 
@@ -475,7 +1100,7 @@ class BaseFileSystemOperations:
         last_write_time,
         change_time,
         file_info,
-    ) -> dict:
+    ) -> Union[FileInfo, dict]:
         raise NotImplementedError()
 
     # ~~~ SET_FILE_SIZE ~~~
@@ -485,17 +1110,22 @@ class BaseFileSystemOperations:
         """
         Set file/allocation size.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
 
         try:
-            self.set_file_size(cooked_file_context, new_size, set_allocation_size)
+            info = self.set_file_size(cooked_file_context, new_size, set_allocation_size)
 
         except NTStatusError as exc:
             return exc.value
 
-        return self.ll_get_file_info(file_context, file_info)
+        return self._write_file_info(cooked_file_context, file_info, info)
 
-    def set_file_size(self, file_context, new_size, set_allocation_size) -> None:
+    def set_file_size(
+        self, file_context, new_size, set_allocation_size
+    ) -> Optional[Union[FileInfo, dict]]:
+        """
+        Might return the file info to avoid the subsequent `get_file_info` call.
+        """
         raise NotImplementedError()
 
     # ~~~ CAN_DELETE ~~~
@@ -505,8 +1135,8 @@ class BaseFileSystemOperations:
         """
         Determine whether a file or directory can be deleted.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         try:
             self.can_delete(cooked_file_context, cooked_file_name)
 
@@ -525,9 +1155,9 @@ class BaseFileSystemOperations:
         """
         Renames a file or directory.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
-        cooked_new_file_name = ffi.string(new_file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
+        cooked_new_file_name = self._cook_file_name(new_file_name)
 
         try:
             self.rename(
@@ -540,6 +1170,10 @@ class BaseFileSystemOperations:
         except NTStatusError as exc:
             return exc.value
 
+        # The names below a renamed directory are affected too
+        if self.negative_lookup_cache is not None:
+            self.negative_lookup_cache.clear()
+
         return NTSTATUS.STATUS_SUCCESS
 
     def rename(self, file_context, file_name: str, new_file_name: str, replace_if_exists: bool):
@@ -552,7 +1186,7 @@ class BaseFileSystemOperations:
         """
         Get file or directory security descriptor.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
             sd, sd_size = self.get_security(cooked_file_context)
 
@@ -582,7 +1216,7 @@ class BaseFileSystemOperations:
         """
         Set file or directory security descriptor.
         """
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
             self.set_security(cooked_file_context, security_information, modification_descriptor)
 
@@ -602,7 +1236,13 @@ class BaseFileSystemOperations:
         Read a directory.
         """
         # `pattern` is already handle by winfsp
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
+
+        if self._directory_buffer_enabled:
+            return self._read_directory_buffer(
+                file_context, cooked_file_context, marker, buffer, length, p_bytes_transferred
+            )
+
         if marker:
             coocked_marker = ffi.string(marker)
         else:
@@ -611,31 +1251,66 @@ class BaseFileSystemOperations:
         try:
             entries_info = self.read_directory(cooked_file_context, coocked_marker)
 
+            # Entries are pulled one at a time so a lazy `read_directory` stops
+            # doing any work as soon as the transfer buffer is full
+            if not _add_dir_infos(entries_info, buffer, length, p_bytes_transferred):
+                return NTSTATUS.STATUS_SUCCESS
+
         except NTStatusError as exc:
             return exc.value
 
-        for entry_info in entries_info:
-            # Optimization FTW... FSP_FSCTL_DIR_INFO must be allocated along
-            # with it last field (FileNameBuf which is a string)
-            file_name = entry_info["file_name"]
-            file_name_encoded = file_name.encode(_STRING_ENCODING)
-            # FSP_FSCTL_DIR_INFO base struct + WCHAR[] string
-            # Note: Windows does not use NULL-terminated string
-            dir_info_size = ffi.sizeof("FSP_FSCTL_DIR_INFO") + len(file_name_encoded)
-            dir_info_raw = ffi.new("char[]", dir_info_size)
-            dir_info = ffi.cast("FSP_FSCTL_DIR_INFO*", dir_info_raw)
-            dir_info.Size = dir_info_size
-            ffi.memmove(dir_info.FileNameBuf, file_name_encoded, len(file_name_encoded))
-            configure_file_info(dir_info.FileInfo, **entry_info)
-            if not lib.FspFileSystemAddDirInfo(dir_info, buffer, length, p_bytes_transferred):
-                return NTSTATUS.STATUS_SUCCESS
-
         lib.FspFileSystemAddDirInfo(ffi.NULL, buffer, length, p_bytes_transferred)
         return NTSTATUS.STATUS_SUCCESS
 
-    def read_directory(self, file_context, marker: str) -> List[dict]:
-        """
-        Returns a list of info dict.
+    def _read_directory_buffer(
+        self, file_context, cooked_file_context, marker, buffer, length, p_bytes_transferred
+    ):
+        p_dir_buffer = self._directory_buffers.get(file_context)
+        if p_dir_buffer is None:
+            p_dir_buffer = self._directory_buffers.setdefault(file_context, ffi.new("PVOID*"))
+        p_result = ffi.new("NTSTATUS*")
+
+        # The buffer is only (re)built when it is empty or when the listing
+        # is restarted from the beginning (i.e. no marker is provided)
+        if lib.FspFileSystemAcquireDirectoryBuffer(p_dir_buffer, marker == ffi.NULL, p_result):
+            try:
+                entries_info = self.read_directory(cooked_file_context, None)
+                self._fill_directory_buffer(entries_info, p_dir_buffer, p_result)
+
+            except NTStatusError as exc:
+                p_result[0] = exc.value
+
+            finally:
+                lib.FspFileSystemReleaseDirectoryBuffer(p_dir_buffer)
+
+        if not nt_success(p_result[0]):
+            return p_result[0]
+
+        lib.FspFileSystemReadDirectoryBuffer(
+            p_dir_buffer, marker, buffer, length, p_bytes_transferred
+        )
+        return NTSTATUS.STATUS_SUCCESS
+
+    def _fill_directory_buffer(self, entries_info, p_dir_buffer, p_result):
+        # The whole listing goes into the directory buffer, so entries
+        # are sent by batches to keep memory usage bounded
+        with _closing_iterator(entries_info):
+            batch = _DirInfoBatch()
+            for entry_info in entries_info:
+                batch.append(entry_info)
+                if len(batch) < _DIRECTORY_BUFFER_BATCH_SIZE:
+                    continue
+                if batch.fill_directory_buffer(p_dir_buffer, p_result) != len(batch):
+                    return
+                batch = _DirInfoBatch()
+            batch.fill_directory_buffer(p_dir_buffer, p_result)
+
+    def read_directory(self, file_context, marker: str) -> Iterable[Union[FileInfo, dict]]:
+        """
+        Returns an iterable of info dict (or `FileInfo`). It can be a list or a lazy iterator
+        (e.g. a generator): entries are consumed in order and the iteration is
+        stopped (and the generator closed) once the transfer buffer is full,
+        so the remaining entries never get computed.
         Info dict fields:
             file_name
             creation_time
@@ -647,12 +1322,14 @@ class BaseFileSystemOperations:
             allocation_size
             file_size
 
-        Only direct children should be included in this list.
+        Only direct children should be included in this iterable.
         The special directories "." and ".." should ONLY be included if the queried directory is not root.
-        The list has to be consistently sorted.
+        The entries have to be consistently sorted.
         The marker argument marks where in the directory to start reading.
         Files with names that are greater than (not equal to) this marker should be returned.
         Might be None, in which case the filtering is disabled.
+        Given the entries are sorted, the marker can be used to seek directly to
+        the first entry to return instead of filtering the whole directory.
         """
         raise NotImplementedError()
 
@@ -671,7 +1348,7 @@ class BaseFileSystemOperations:
         """
         Resolve reparse points.
         """
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_name = self._cook_file_name(file_name)
         # TODO: handle p_io_status, buffer and p_size here
         try:
             self.resolve_reparse_points(
@@ -706,8 +1383,8 @@ class BaseFileSystemOperations:
         """
         Get reparse point.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         # TODO: handle buffer and p_size here
         try:
             self.get_reparse_point(cooked_file_context, cooked_file_name, buffer, p_size)
@@ -727,8 +1404,8 @@ class BaseFileSystemOperations:
         """
         Set reparse point.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         # TODO: handle buffer and size here
         try:
             self.set_reparse_point(cooked_file_context, cooked_file_name, buffer, size)
@@ -748,8 +1425,8 @@ class BaseFileSystemOperations:
         """
         Delete reparse point.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         # TODO: handle buffer and size here
         try:
             self.delete_reparse_point(cooked_file_context, cooked_file_name, buffer, size)
@@ -770,7 +1447,7 @@ class BaseFileSystemOperations:
         Get named streams information.
         Must set `volum_params.named_streams` to 1 for this method to be used.
         """
-        cooked_file_context = ffi.from_handle(file_context, buffer, length, p_bytes_transferred)
+        cooked_file_context = self.file_contexts.get(file_context)
         # TODO: handle p_bytes_transferred here
         try:
             self.get_stream_info(cooked_file_context, buffer, length, p_bytes_transferred)
@@ -792,8 +1469,8 @@ class BaseFileSystemOperations:
         this method to be used. This is the default when an `get_dir_info_by_name`
         implementation is provided.
         """
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         try:
             info = self.get_dir_info_by_name(cooked_file_context, cooked_file_name)
 
@@ -803,7 +1480,7 @@ class BaseFileSystemOperations:
         file_name_bytesize = lib.wcslen(file_name) * 2  # WCHAR
         ffi.memmove(dir_info.FileNameBuf, file_name, file_name_bytesize)
 
-        configure_file_info(dir_info.FileInfo, **info)
+        write_file_info(ffi.addressof(dir_info, "FileInfo"), info)
 
         # dir_info is already allocated for us with a 255 wchar buffer for file
         # name, but we have to set the actual used size here
@@ -811,9 +1488,9 @@ class BaseFileSystemOperations:
 
         return NTSTATUS.STATUS_SUCCESS
 
-    def get_dir_info_by_name(self, file_context, file_name: str) -> dict:
+    def get_dir_info_by_name(self, file_context, file_name: str) -> Union[FileInfo, dict]:
         """
-        Returned dict fields:
+        Returned dict (or `FileInfo`) fields:
             creation_time
             last_access_time
             last_write_time
@@ -838,7 +1515,7 @@ class BaseFileSystemOperations:
         output_buffer_length,
         p_bytes_transferred,
     ):
-        cooked_file_context = ffi.from_handle(file_context)
+        cooked_file_context = self.file_contexts.get(file_context)
         try:
             # TODO handle input/output buffers and p_bytes_transferred here
             self.control(
@@ -875,8 +1552,8 @@ class BaseFileSystemOperations:
 
     @_catch_unhandled_exceptions
     def ll_set_delete(self, file_context, file_name, delete_file):
-        cooked_file_context = ffi.from_handle(file_context)
-        cooked_file_name = ffi.string(file_name)
+        cooked_file_context = self.file_contexts.get(file_context)
+        cooked_file_name = self._cook_file_name(file_name)
         try:
             self.set_delete(cooked_file_context, cooked_file_name, delete_file)
 
@@ -891,3 +1568,379 @@ class BaseFileSystemOperations:
         method.
         """
         pass
+
+
+class FileSystemOperationsWrapper(BaseFileSystemOperations):
+    """
+    Forward all the operations to the wrapped `operations`, to be subclassed
+    in order to alter some of them (e.g. adding a cache layer).
+
+    The options of the low-level layer (directory buffer, file name cache etc.)
+    are the ones of the wrapped operations. The file contexts passed to the
+    operations are the ones returned by the wrapped `create` and `open`.
+    """
+
+    def __init__(self, operations: BaseFileSystemOperations):
+        if isinstance(operations, BaseAsyncFileSystemOperations):
+            raise ValueError("Asynchronous operations cannot be wrapped")
+        self.operations = operations
+        super().__init__(
+            directory_buffer=operations._directory_buffer_enabled,
+            file_name_cache=operations.file_name_cache,
+            security_descriptor_pool=operations.security_descriptor_pool,
+            operation_statistics=operations.operation_statistics,
+            negative_lookup_cache=operations.negative_lookup_cache,
+        )
+        self._read_into_available = operations._read_into_available
+
+    def _is_implemented(self, name: str) -> bool:
+        return self.operations._is_implemented(name)
+
+    def _bind_file_system(self, file_system) -> None:
+        super()._bind_file_system(file_system)
+        self.operations._bind_file_system(file_system)
+
+    def get_volume_info(self):
+        return self.operations.get_volume_info()
+
+    def set_volume_label(self, volume_label):
+        return self.operations.set_volume_label(volume_label)
+
+    def get_security_by_name(self, file_name):
+        return self.operations.get_security_by_name(file_name)
+
+    def create(
+        self,
+        file_name,
+        create_options,
+        granted_access,
+        file_attributes,
+        security_descriptor,
+        allocation_size,
+    ):
+        return self.operations.create(
+            file_name,
+            create_options,
+            granted_access,
+            file_attributes,
+            security_descriptor,
+            allocation_size,
+        )
+
+    def open(self, file_name, create_options, granted_access):
+        return self.operations.open(file_name, create_options, granted_access)
+
+    def overwrite(self, file_context, file_attributes, replace_file_attributes, allocation_size):
+        return self.operations.overwrite(
+            file_context, file_attributes, replace_file_attributes, allocation_size
+        )
+
+    def cleanup(self, file_context, file_name, flags):
+        return self.operations.cleanup(file_context, file_name, flags)
+
+    def close(self, file_context):
+        return self.operations.close(file_context)
+
+    def read(self, file_context, offset, length):
+        return self.operations.read(file_context, offset, length)
+
+    def read_into(self, file_context, offset, buffer):
+        return self.operations.read_into(file_context, offset, buffer)
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        return self.operations.write(
+            file_context, buffer, offset, write_to_end_of_file, constrained_io
+        )
+
+    def flush(self, file_context):
+        return self.operations.flush(file_context)
+
+    def get_file_info(self, file_context):
+        return self.operations.get_file_info(file_context)
+
+    def set_basic_info(
+        self,
+        file_context,
+        file_attributes,
+        creation_time,
+        last_access_time,
+        last_write_time,
+        change_time,
+        file_info,
+    ):
+        return self.operations.set_basic_info(
+            file_context,
+            file_attributes,
+            creation_time,
+            last_access_time,
+            last_write_time,
+            change_time,
+            file_info,
+        )
+
+    def set_file_size(self, file_context, new_size, set_allocation_size):
+        return self.operations.set_file_size(file_context, new_size, set_allocation_size)
+
+    def can_delete(self, file_context, file_name):
+        return self.operations.can_delete(file_context, file_name)
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        return self.operations.rename(file_context, file_name, new_file_name, replace_if_exists)
+
+    def get_security(self, file_context):
+        return self.operations.get_security(file_context)
+
+    def set_security(self, file_context, security_information, modification_descriptor):
+        return self.operations.set_security(
+            file_context, security_information, modification_descriptor
+        )
+
+    def read_directory(self, file_context, marker):
+        return self.operations.read_directory(file_context, marker)
+
+    def resolve_reparse_points(
+        self,
+        file_name,
+        reparse_point_index,
+        resolve_last_path_component,
+        p_io_status,
+        buffer,
+        p_size,
+    ):
+        return self.operations.resolve_reparse_points(
+            file_name,
+            reparse_point_index,
+            resolve_last_path_component,
+            p_io_status,
+            buffer,
+            p_size,
+        )
+
+    def get_reparse_point(self, file_context, file_name, buffer, p_size):
+        return self.operations.get_reparse_point(file_context, file_name, buffer, p_size)
+
+    def set_reparse_point(self, file_context, file_name, buffer, size):
+        return self.operations.set_reparse_point(file_context, file_name, buffer, size)
+
+    def delete_reparse_point(self, file_context, file_name, buffer, size):
+        return self.operations.delete_reparse_point(file_context, file_name, buffer, size)
+
+    def get_stream_info(self, file_context, buffer, length, p_bytes_transferred):
+        return self.operations.get_stream_info(file_context, buffer, length, p_bytes_transferred)
+
+    def get_dir_info_by_name(self, file_context, file_name):
+        return self.operations.get_dir_info_by_name(file_context, file_name)
+
+    def control(
+        self,
+        file_context,
+        control_code,
+        input_buffer,
+        input_buffer_length,
+        output_buffer,
+        output_buffer_length,
+        p_bytes_transferred,
+    ):
+        return self.operations.control(
+            file_context,
+            control_code,
+            input_buffer,
+            input_buffer_length,
+            output_buffer,
+            output_buffer_length,
+            p_bytes_transferred,
+        )
+
+    def set_delete(self, file_context, file_name, delete_file):
+        return self.operations.set_delete(file_context, file_name, delete_file)
+
+
+class BaseAsyncFileSystemOperations(BaseFileSystemOperations):
+    """
+    Operations where `read`, `write` and `read_directory` are coroutines.
+
+    Those coroutines run on a dedicated asyncio event loop. The WinFSP
+    dispatcher thread doesn't wait for them: `STATUS_PENDING` is returned right
+    away and the request is completed once the coroutine is done. Hence a few
+    dispatcher threads can keep many slow backend operations in flight.
+
+    Note the completion (e.g. copying the read data or getting the file info
+    after a write) runs on the event loop thread, so synchronous operations
+    (e.g. `get_file_info`) might be called from this thread.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # The data is copied straight into the WinFSP buffer once `read` is done
+        self._read_into_available = False
+        self.loop = asyncio.new_event_loop()
+        self._loop_thread = threading.Thread(
+            target=self.loop.run_forever, name="winfspy-async-operations", daemon=True
+        )
+        self._loop_thread.start()
+
+    def _start_pending_operation(self, coroutine, complete):
+        """
+        Run `coroutine` on the event loop, then pass its result to `complete`
+        which returns (status, information, file_info) to build the response.
+        """
+        p_kind = ffi.new("UINT32*")
+        p_hint = ffi.new("UINT64*")
+        lib.get_FSP_FSCTL_TRANSACT_REQ_identity(p_kind, p_hint)
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+        future.add_done_callback(
+            partial(self._complete_pending_operation, p_kind[0], p_hint[0], complete)
+        )
+        return NTSTATUS.STATUS_PENDING
+
+    def _complete_pending_operation(self, kind, hint, complete, future):
+        file_info = ffi.NULL
+        try:
+            status, information, file_info = complete(future.result())
+
+        except NTStatusError as exc:
+            status, information = exc.value, 0
+
+        except BaseException:
+            logger.exception("Unhandled exception")
+            status, information = NTSTATUS.STATUS_UNEXPECTED_IO_ERROR, 0
+
+        # Responding to a stopped file system would target a deleted object
+        file_system = self._file_system
+        if file_system is None or not file_system.started:
+            return
+        lib.send_FSP_FSCTL_TRANSACT_RSP(
+            file_system._file_system_ptr[0], kind, hint, status, information, file_info
+        )
+
+    # ~~~ READ ~~~
+
+    @_catch_unhandled_exceptions
+    def ll_read(self, file_context, buffer, offset, length, p_bytes_transferred) -> NTSTATUS:
+        """
+        Read a file.
+        """
+        cooked_file_context = self.file_contexts.get(file_context)
+
+        # `buffer` remains valid until the response is sent
+        def _complete(data):
+            ffi.memmove(buffer, data, len(data))
+            return NTSTATUS.STATUS_SUCCESS, len(data), ffi.NULL
+
+        return self._start_pending_operation(
+            self.read(cooked_file_context, offset, length), _complete
+        )
+
+    async def read(self, file_context, offset: int, length: int) -> bytes:
+        raise NotImplementedError()
+
+    # ~~~ WRITE ~~~
+
+    @_catch_unhandled_exceptions
+    def ll_write(
+        self,
+        file_context,
+        buffer,
+        offset,
+        length,
+        write_to_end_of_file,
+        constrained_io,
+        p_bytes_transferred,
+        file_info,
+    ) -> NTSTATUS:
+        """
+        Write a file.
+        """
+        cooked_file_context = self.file_contexts.get(file_context)
+        # `buffer` remains valid until the response is sent
+        cooked_buffer = ffi.buffer(buffer, length)
+
+        def _complete(ret):
+            if isinstance(ret, WriteResult):
+                bytes_transferred, info = ret
+            else:
+                bytes_transferred, info = ret, self.get_file_info(cooked_file_context)
+            # `file_info` belongs to the request, the response gets its own
+            response_file_info = ffi.new("FSP_FSCTL_FILE_INFO*")
+            write_file_info(response_file_info, info)
+            return NTSTATUS.STATUS_SUCCESS, bytes_transferred, response_file_info
+
+        return self._start_pending_operation(
+            self.write(
+                cooked_file_context, cooked_buffer, offset, write_to_end_of_file, constrained_io
+            ),
+            _complete,
+        )
+
+    async def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        raise NotImplementedError()
+
+    # ~~~ READ_DIRECTORY ~~~
+
+    @_catch_unhandled_exceptions
+    def ll_read_directory(self, file_context, pattern, marker, buffer, length, p_bytes_transferred):
+        """
+        Read a directory.
+        """
+        # `pattern` is already handle by winfsp
+        cooked_file_context = self.file_contexts.get(file_context)
+        # `marker` belongs to the request, which is not kept after STATUS_PENDING is returned
+        if marker:
+            coocked_marker = ffi.string(marker)
+        else:
+            coocked_marker = None
+
+        if not self._directory_buffer_enabled:
+
+            def _complete(entries_info):
+                p_bytes_transferred = ffi.new("ULONG*")
+                if _add_dir_infos(entries_info, buffer, length, p_bytes_transferred):
+                    lib.FspFileSystemAddDirInfo(ffi.NULL, buffer, length, p_bytes_transferred)
+                return NTSTATUS.STATUS_SUCCESS, p_bytes_transferred[0], ffi.NULL
+
+            return self._start_pending_operation(
+                self.read_directory(cooked_file_context, coocked_marker), _complete
+            )
+
+        # Continuation of a listing whose directory buffer is already built
+        p_dir_buffer = self._directory_buffers.get(file_context)
+        if p_dir_buffer is not None and coocked_marker is not None:
+            p_result = ffi.new("NTSTATUS*")
+            if not lib.FspFileSystemAcquireDirectoryBuffer(p_dir_buffer, False, p_result):
+                lib.FspFileSystemReadDirectoryBuffer(
+                    p_dir_buffer, marker, buffer, length, p_bytes_transferred
+                )
+                return NTSTATUS.STATUS_SUCCESS
+            # The buffer needs filling (e.g. the directory was empty), which is
+            # done once the listing is pending below
+            lib.FspFileSystemReleaseDirectoryBuffer(p_dir_buffer)
+
+        def _complete_directory_buffer(entries_info):
+            p_dir_buffer = self._directory_buffers.get(file_context)
+            if p_dir_buffer is None:
+                p_dir_buffer = self._directory_buffers.setdefault(file_context, ffi.new("PVOID*"))
+            p_result = ffi.new("NTSTATUS*")
+            # The directory buffer lock must be released by the thread acquiring it
+            if lib.FspFileSystemAcquireDirectoryBuffer(p_dir_buffer, True, p_result):
+                try:
+                    self._fill_directory_buffer(entries_info, p_dir_buffer, p_result)
+                finally:
+                    lib.FspFileSystemReleaseDirectoryBuffer(p_dir_buffer)
+            if not nt_success(p_result[0]):
+                return p_result[0], 0, ffi.NULL
+
+            p_bytes_transferred = ffi.new("ULONG*")
+            cooked_marker_buffer = (
+                ffi.new("wchar_t[]", coocked_marker) if coocked_marker is not None else ffi.NULL
+            )
+            lib.FspFileSystemReadDirectoryBuffer(
+                p_dir_buffer, cooked_marker_buffer, buffer, length, p_bytes_transferred
+            )
+            return NTSTATUS.STATUS_SUCCESS, p_bytes_transferred[0], ffi.NULL
+
+        return self._start_pending_operation(
+            self.read_directory(cooked_file_context, None), _complete_directory_buffer
+        )
+
+    async def read_directory(self, file_context, marker: str) -> Iterable[Union[FileInfo, dict]]:
+        raise NotImplementedError()
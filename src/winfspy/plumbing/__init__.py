@@ -3,7 +3,7 @@ from .status import NTSTATUS, cook_ntstatus, posix_to_ntstatus, ntstatus_to_posi
 from .file_attribute import FILE_ATTRIBUTE, CREATE_FILE_CREATE_OPTIONS
 from .win32_filetime import dt_to_filetime, filetime_to_dt, filetime_now
 from .file_system_interface import file_system_interface_trampoline_factory
-from .security_descriptor import SecurityDescriptor
+from .security_descriptor import SecurityDescriptor, SecurityDescriptorPool
 from .get_winfsp_dir import get_winfsp_dir, get_winfsp_bin_dir, get_winfsp_library_name
 from .exceptions import (
     WinFSPyError,
@@ -42,6 +42,7 @@ __all__ = (
     "file_system_interface_trampoline_factory",
     # Security descriptor
     "SecurityDescriptor",
+    "SecurityDescriptorPool",
     # Get winfsp directory
     "get_winfsp_dir",
     "get_winfsp_bin_dir",
@@ -1,3 +1,4 @@
+import threading
 from typing import NamedTuple, Any
 
 from .status import NTSTATUS, cook_ntstatus
@@ -8,7 +9,7 @@ from .exceptions import NTStatusError
 from .bindings import lib, ffi
 
 
-__all__ = ["SecurityDescriptor"]
+__all__ = ["SecurityDescriptor", "SecurityDescriptorPool"]
 
 
 class SecurityDescriptor(NamedTuple):
@@ -26,6 +27,13 @@ class SecurityDescriptor(NamedTuple):
         ffi.memmove(new_handle, handle, size)
         return cls(new_handle, size)
 
+    @classmethod
+    def from_bytes(cls, data):
+        if not data:
+            return cls(ffi.NULL, 0)
+        buffer = ffi.new("char[]", data)
+        return cls.from_cpointer(ffi.cast("SECURITY_DESCRIPTOR*", buffer))
+
     @classmethod
     def from_string(cls, string_format):
         # see https://docs.microsoft.com/fr-fr/windows/desktop/SecAuthZ/security-descriptor-string-format
@@ -59,7 +67,15 @@ class SecurityDescriptor(NamedTuple):
         lib.LocalFree(pwstr[0])
         return result
 
-    def evolve(self, security_information, modification_descriptor):
+    def to_bytes(self):
+        if self.handle == ffi.NULL:
+            return b""
+        return ffi.buffer(self.handle, self.size)[:]
+
+    def evolve(self, security_information, modification_descriptor, pool=None):
+        """
+        If `pool` is provided, the resulting descriptor is interned in this pool.
+        """
         psd = ffi.new("SECURITY_DESCRIPTOR**")
         status = lib.FspSetSecurityDescriptor(
             self.handle, security_information, modification_descriptor, psd
@@ -68,10 +84,78 @@ class SecurityDescriptor(NamedTuple):
             raise NTStatusError(status)
         handle = psd[0]
         size = lib.GetSecurityDescriptorLength(handle)
-        return type(self)(handle, size)
+        evolved = type(self)(handle, size)
+        if pool is not None:
+            evolved = pool.intern(evolved)
+        return evolved
 
     def is_valid(self):
         return bool(lib.IsValidSecurityDescriptor(self.handle))
 
     def __del__(self):
         lib.LocalFree(self.handle)
+
+
+class SecurityDescriptorPool:
+    """
+    Reference-counted pool of security descriptors, keyed by their content.
+
+    Most files share the same few descriptors, so handing out the same
+    immutable `SecurityDescriptor` for identical contents avoids both the
+    allocation and the memory of one copy per file.
+
+    Each `acquire`/`intern` call must be balanced by a `release` call once
+    the descriptor is no longer used (e.g. when the file is deleted).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Descriptor content -> [descriptor, reference count]
+        self._entries = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def acquire(self, handle) -> SecurityDescriptor:
+        """
+        Returns the pooled descriptor with the same content than the one
+        pointed by `handle`, a copy being made only if it isn't pooled yet.
+        """
+        if handle == ffi.NULL:
+            return SecurityDescriptor(ffi.NULL, 0)
+        size = lib.GetSecurityDescriptorLength(handle)
+        key = ffi.buffer(handle, size)[:]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [SecurityDescriptor.from_cpointer(handle), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def intern(self, descriptor: SecurityDescriptor) -> SecurityDescriptor:
+        """
+        Returns the pooled descriptor with the same content than `descriptor`,
+        the latter being added to the pool if it isn't pooled yet.
+        """
+        if descriptor.handle == ffi.NULL:
+            return descriptor
+        key = descriptor.to_bytes()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [descriptor, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, descriptor: SecurityDescriptor) -> None:
+        if descriptor.handle == ffi.NULL:
+            return
+        key = descriptor.to_bytes()
+        with self._lock:
+            entry = self._entries.get(key)
+            # Not a descriptor from this pool
+            if entry is None or entry[0] is not descriptor:
+                return
+            entry[1] -= 1
+            if not entry[1]:
+                del self._entries[key]
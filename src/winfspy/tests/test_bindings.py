@@ -2,7 +2,22 @@ import os
 import sys
 import subprocess
 
-from winfspy.plumbing import get_winfsp_dir, get_winfsp_library_name
+from winfspy import FileInfo
+from winfspy.operations import _FILE_INFO_STRUCT, _DirInfoBatch, write_file_info
+from winfspy.plumbing import ffi, get_winfsp_dir, get_winfsp_library_name
+
+# Values wider than 32 bits, so a field packed with the wrong size is noticed
+FILE_INFO = FileInfo(
+    file_attributes=0x20,
+    reparse_tag=0x80000000,
+    allocation_size=3 << 32,
+    file_size=4 << 32,
+    creation_time=5 << 32,
+    last_access_time=6 << 32,
+    last_write_time=7 << 32,
+    change_time=8 << 32,
+    index_number=9 << 32,
+)
 
 
 def run_import_winfspy(env):
@@ -45,3 +60,52 @@ def test_load_bindings(tmp_path):
     assert result.returncode == 1
     stderr = result.stderr.decode()
     assert "The winfsp binding could not be imported" in stderr
+
+
+def check_file_info(file_info, info):
+    assert file_info.FileAttributes == info.file_attributes
+    assert file_info.ReparseTag == info.reparse_tag
+    assert file_info.AllocationSize == info.allocation_size
+    assert file_info.FileSize == info.file_size
+    assert file_info.CreationTime == info.creation_time
+    assert file_info.LastAccessTime == info.last_access_time
+    assert file_info.LastWriteTime == info.last_write_time
+    assert file_info.ChangeTime == info.change_time
+    assert file_info.IndexNumber == info.index_number
+    assert file_info.HardLinks == 0
+
+
+def test_file_info_layout():
+    # The FSP_FSCTL_FILE_INFO layout is hardcoded to be packed in one go
+    buffer = ffi.new("char[]", _FILE_INFO_STRUCT.pack(*FILE_INFO[:9], 0))
+    check_file_info(ffi.cast("FSP_FSCTL_FILE_INFO*", buffer), FILE_INFO)
+
+    file_info = ffi.new("FSP_FSCTL_FILE_INFO*", {"HardLinks": 1})
+    write_file_info(file_info, FILE_INFO)
+    check_file_info(file_info, FILE_INFO)
+
+
+def test_dir_info_batch_layout():
+    batch = _DirInfoBatch()
+    entries = [
+        ("foo", FILE_INFO._replace(file_name="foo")),
+        ("bar.txt", {"file_name": "bar.txt", "file_size": 42}),
+    ]
+    sizes = [batch.append(entry_info) for _, entry_info in entries]
+    buffer = ffi.new("char[]", 1024)
+    p_bytes_transferred = ffi.new("ULONG*")
+    assert batch.add_to_buffer(buffer, 1024, p_bytes_transferred) == 2
+
+    # Each entry is aligned on 8 bytes, as expected by `_DirInfoBatch.append`
+    offset = 0
+    for (file_name, entry_info), size in zip(entries, sizes):
+        dir_info = ffi.cast("FSP_FSCTL_DIR_INFO*", buffer + offset)
+        file_name_encoded = file_name.encode("UTF-16-LE")
+        assert dir_info.Size == ffi.sizeof("FSP_FSCTL_DIR_INFO") + len(file_name_encoded)
+        assert size == (dir_info.Size + 7) & ~7
+        if isinstance(entry_info, dict):
+            entry_info = FileInfo(**entry_info)
+        check_file_info(dir_info.FileInfo, entry_info)
+        assert ffi.buffer(dir_info.FileNameBuf, len(file_name_encoded))[:] == file_name_encoded
+        offset += size
+    assert p_bytes_transferred[0] == offset
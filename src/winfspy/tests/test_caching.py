@@ -0,0 +1,239 @@
+import pytest
+
+from winfspy import BaseFileSystemOperations, FileInfo, NTStatusObjectNameNotFound
+from winfspy.caching import (
+    WriteBackCache,
+    ReadAheadCache,
+    CachingFileSystemOperations,
+    MetadataCache,
+)
+
+
+class DummyFile:
+    def __init__(self):
+        self.data = bytearray()
+
+
+class DummyOperations(BaseFileSystemOperations):
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+        self.file_info_lookups = 0
+        self.reads = []
+        self.writes = []
+
+    def open(self, file_name, create_options, granted_access):
+        return self.files.setdefault(file_name, DummyFile())
+
+    def close(self, file_context):
+        pass
+
+    def get_file_info(self, file_context):
+        self.file_info_lookups += 1
+        return FileInfo(file_size=len(file_context.data))
+
+    def read(self, file_context, offset, length):
+        self.reads.append((offset, length))
+        return bytes(file_context.data[offset : offset + length])
+
+    def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        self.writes.append((offset, len(buffer)))
+        end = offset + len(buffer)
+        if end > len(file_context.data):
+            file_context.data += bytearray(end - len(file_context.data))
+        file_context.data[offset:end] = buffer
+        return len(buffer)
+
+    def flush(self, file_context):
+        pass
+
+
+class DummyHandle:
+    def __init__(self, file):
+        self.file = file
+
+    @property
+    def data(self):
+        return self.file.data
+
+    @data.setter
+    def data(self, data):
+        self.file.data = data
+
+
+class CaseInsensitiveOperations(DummyOperations):
+    def open(self, file_name, create_options, granted_access):
+        # A distinct context per open, like most implementations
+        return DummyHandle(self.files.setdefault(file_name.lower(), DummyFile()))
+
+    def get_security_by_name(self, file_name):
+        if file_name.lower() not in self.files:
+            raise NTStatusObjectNameNotFound()
+        return 0, None, 0
+
+    def rename(self, file_context, file_name, new_file_name, replace_if_exists):
+        self.files[new_file_name.lower()] = self.files.pop(file_name.lower())
+
+
+def test_write_back_cache():
+    operations = DummyOperations()
+    cache = WriteBackCache(operations, max_age=60)
+    try:
+        file_context = cache.open("\\foo", 0, 0)
+
+        # Sequential, overlapping and appending writes are merged
+        assert cache.write(file_context, b"a" * 10, 0, False, False)[0] == 10
+        assert cache.write(file_context, b"b" * 10, 10, False, False)[0] == 10
+        assert cache.write(file_context, b"c" * 5, 5, False, False)[0] == 5
+        length, file_info = cache.write(file_context, b"d" * 5, 0, True, False)
+        assert (length, file_info.file_size) == (5, 25)
+        assert cache.get_file_info(file_context).file_size == 25
+        # Constrained I/O doesn't extend the file
+        assert cache.write(file_context, b"e" * 10, 20, False, True)[0] == 5
+        assert operations.writes == []
+        assert cache.get_stats()["dirty_bytes"] == 25
+
+        # Reading flushes the data as a single write
+        assert cache.read(file_context, 0, 25) == b"aaaaaccccc" + b"b" * 10 + b"e" * 5
+        assert operations.writes == [(0, 25)]
+        assert cache.get_stats()["dirty_bytes"] == 0
+
+        # Disjoint writes are kept apart
+        cache.write(file_context, b"f", 40, False, False)
+        cache.write(file_context, b"g", 30, False, False)
+        cache.flush(file_context)
+        assert operations.writes[1:] == [(30, 1), (40, 1)]
+        assert len(file_context.data) == 41
+
+    finally:
+        cache.shutdown()
+
+
+def test_write_back_cache_case_insensitive():
+    operations = CaseInsensitiveOperations()
+    cache = WriteBackCache(operations, max_age=60)
+    try:
+        upper_context = cache.open("\\Foo", 0, 0)
+        lower_context = cache.open("\\foo", 0, 0)
+        cache.write(upper_context, b"abc", 0, False, False)
+
+        # Dirty data is seen whatever the casing
+        assert cache.get_file_info(lower_context).file_size == 3
+        assert cache.read(lower_context, 0, 3) == b"abc"
+        assert operations.writes == [(0, 3)]
+
+    finally:
+        cache.shutdown()
+
+
+def test_read_ahead_cache():
+    operations = DummyOperations()
+    file_context = operations.open("\\foo", 0, 0)
+    file_context.data = bytearray(range(256)) * 16
+    cache = ReadAheadCache(operations, window_size=512, max_window_size=1024, trigger=2)
+    try:
+        file_context = cache.open("\\foo", 0, 0)
+        # Reads are served from the prefetched windows once sequential
+        for offset in range(0, 4096, 256):
+            assert cache.read(file_context, offset, 256) == file_context.data[offset : offset + 256]
+        assert cache.get_stats()["hits"] > 0
+
+        # Random access and writes don't return stale data
+        assert cache.read(file_context, 100, 10) == file_context.data[100:110]
+        cache.write(file_context, b"x" * 10, 110, False, False)
+        assert cache.read(file_context, 110, 10) == b"x" * 10
+
+        cache.close(file_context)
+        assert cache.get_stats()["buffered_bytes"] == 0
+
+    finally:
+        cache.shutdown()
+
+
+def test_caching_file_system_operations():
+    operations = DummyOperations()
+    cache = CachingFileSystemOperations(operations, block_size=16, max_cached_bytes=64)
+    file_context = cache.open("\\foo", 0, 0)
+    file_context.data = bytearray(range(100))
+
+    # Missing blocks are read at once, then served from the cache
+    assert cache.read(file_context, 10, 30) == bytes(range(10, 40))
+    assert operations.reads == [(0, 48)]
+    assert cache.read(file_context, 20, 10) == bytes(range(20, 30))
+    assert operations.reads == [(0, 48)]
+
+    # Least recently used blocks are evicted
+    assert cache.read(file_context, 90, 20) == bytes(range(90, 100))
+    assert cache.get_stats() == {"cached_bytes": 52, "hits": 1, "misses": 2, "evictions": 1}
+    assert cache.read(file_context, 20, 10) == bytes(range(20, 30))
+    assert cache.read(file_context, 0, 10) == bytes(range(10))
+    assert operations.reads[-1] == (0, 16)
+
+    # Writing invalidates the file
+    cache.write(file_context, b"x", 0, False, False)
+    assert cache.read(file_context, 0, 2) == b"x\x01"
+
+
+def test_caches_case_insensitive():
+    operations = CaseInsensitiveOperations()
+    operations.open("\\foo", 0, 0).data = bytearray(b"a" * 64)
+    operations.open("\\bar", 0, 0).data = bytearray(b"b" * 64)
+    read_ahead = ReadAheadCache(operations, window_size=16, trigger=1)
+    cache = CachingFileSystemOperations(read_ahead, block_size=16)
+    try:
+        foo_context = cache.open("\\foo", 0, 0)
+        bar_context = cache.open("\\bar", 0, 0)
+        assert cache.read(foo_context, 0, 16) == b"a" * 16
+        assert read_ahead.get_stats()["buffered_bytes"] > 0
+
+        # Replacing the file with another casing invalidates its cached data
+        cache.rename(bar_context, "\\BAR", "\\FOO", True)
+        assert read_ahead.get_stats()["buffered_bytes"] == 0
+        assert cache.read(cache.open("\\foo", 0, 0), 0, 16) == b"b" * 16
+
+    finally:
+        read_ahead.shutdown()
+
+
+def test_metadata_cache():
+    operations = DummyOperations()
+    cache = MetadataCache(operations, ttl=60)
+    file_context = cache.open("\\foo", 0, 0)
+
+    # Bursts of lookups are collapsed
+    assert cache.get_file_info(file_context).file_size == 0
+    assert cache.get_file_info(file_context).file_size == 0
+    assert operations.file_info_lookups == 1
+
+    # Mutating operations invalidate the cached file info
+    cache.write(file_context, b"foo", 0, False, False)
+    assert cache.get_file_info(file_context).file_size == 3
+    assert operations.file_info_lookups == 2
+    assert cache.get_stats() == {"entries": 1, "hits": 1, "misses": 2}
+
+    # No caching without TTL (i.e. `file_info_timeout` is 0)
+    cache = MetadataCache(operations)
+    file_context = cache.open("\\foo", 0, 0)
+    cache.get_file_info(file_context)
+    cache.get_file_info(file_context)
+    assert operations.file_info_lookups == 4
+
+
+def test_metadata_cache_case_insensitive():
+    operations = CaseInsensitiveOperations()
+    cache = MetadataCache(operations, ttl=60)
+    upper_context = cache.open("\\Foo", 0, 0)
+    lower_context = cache.open("\\foo", 0, 0)
+
+    # Entries are shared whatever the casing
+    assert cache.get_file_info(upper_context).file_size == 0
+    assert cache.get_file_info(lower_context).file_size == 0
+    assert operations.file_info_lookups == 1
+    cache.write(lower_context, b"foo", 0, False, False)
+    assert cache.get_file_info(upper_context).file_size == 3
+
+    # Renaming with another casing invalidates the entries
+    assert cache.get_security_by_name("\\Foo") == (0, None, 0)
+    cache.rename(lower_context, "\\foo", "\\bar", False)
+    with pytest.raises(NTStatusObjectNameNotFound):
+        cache.get_security_by_name("\\Foo")
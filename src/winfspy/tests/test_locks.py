@@ -0,0 +1,34 @@
+import threading
+
+from winfspy import ReadWriteLock, LockManager
+
+
+def test_read_write_lock():
+    lock = ReadWriteLock()
+    acquired = threading.Event()
+
+    def _write():
+        with lock.write():
+            acquired.set()
+
+    # Readers share the lock
+    with lock.read():
+        with lock.read():
+            writer = threading.Thread(target=_write)
+            writer.start()
+            # The writer waits for the readers
+            assert not acquired.wait(0.1)
+    writer.join()
+    assert acquired.is_set()
+
+
+def test_lock_manager():
+    manager = LockManager()
+    with manager.read("foo"):
+        with manager.read("foo"):
+            # Distinct keys don't conflict
+            with manager.write("bar"):
+                assert len(manager) == 2
+        assert len(manager) == 1
+    # Unused locks are dropped
+    assert len(manager) == 0
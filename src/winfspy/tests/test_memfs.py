@@ -0,0 +1,599 @@
+import struct
+import logging
+import threading
+from pathlib import Path, PureWindowsPath
+
+import pytest
+
+from winfspy import (
+    CREATE_FILE_CREATE_OPTIONS,
+    FILE_ATTRIBUTE,
+    NTStatusDirectoryNotEmpty,
+    NTStatusEndOfFile,
+    NTStatusMediaWriteProtected,
+    NTStatusNotADirectory,
+    NTStatusObjectNameCollision,
+    NTStatusObjectNameNotFound,
+)
+from winfspy.memfs import (
+    DedupeStore,
+    FileObj,
+    InMemoryFileSystemOperations,
+    Journal,
+    SpillStorage,
+    create_memory_file_system,
+)
+from winfspy.plumbing import SecurityDescriptor, lib
+
+
+SDDL = "O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"
+# See `FspCleanupDelete`
+CLEANUP_DELETE = 0x01
+
+
+def create(operations, file_name, directory=False, sddl=SDDL):
+    security_descriptor = operations.security_descriptor_pool.intern(
+        SecurityDescriptor.from_string(sddl)
+    )
+    if directory:
+        create_options = CREATE_FILE_CREATE_OPTIONS.FILE_DIRECTORY_FILE
+        file_attributes = FILE_ATTRIBUTE.FILE_ATTRIBUTE_DIRECTORY
+    else:
+        create_options = 0
+        file_attributes = FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL
+    return operations.create(
+        file_name, create_options, 0, file_attributes, security_descriptor, 0
+    ).file_context
+
+
+def delete(operations, file_context):
+    operations.cleanup(file_context, None, CLEANUP_DELETE)
+
+
+def get_state(operations):
+    state = {}
+    for file_obj, _ in operations._walk(operations._root_obj):
+        data = b""
+        if isinstance(file_obj, FileObj) and file_obj.file_size:
+            data = bytes(file_obj.read(0, file_obj.file_size))
+        state[file_obj.file_name] = (
+            file_obj.get_file_info(),
+            file_obj.security_descriptor.to_bytes(),
+            data,
+        )
+    return state, operations.get_volume_info()["volume_label"]
+
+
+def list_directory(operations, file_name, marker=None):
+    file_context = operations.open(file_name, 0, 0).file_context
+    return [entry.file_name for entry in operations.read_directory(file_context, marker)]
+
+
+def test_tree():
+    operations = InMemoryFileSystemOperations("memfs")
+    create(operations, "\\foo", directory=True)
+    create(operations, "\\foo\\Bar.txt")
+
+    # Names are looked up case-insensitively, but keep their case
+    bar_context = operations.open("\\FOO\\bar.TXT", 0, 0).file_context
+    assert bar_context.file_obj.file_name == "\\foo\\Bar.txt"
+    with pytest.raises(NTStatusObjectNameCollision):
+        create(operations, "\\Foo\\BAR.txt")
+    with pytest.raises(NTStatusObjectNameNotFound):
+        create(operations, "\\spam\\bar.txt")
+    with pytest.raises(NTStatusNotADirectory):
+        create(operations, "\\foo\\bar.txt\\spam")
+
+    # Renaming a folder moves its subtree
+    operations.rename(None, "\\foo", "\\spam", False)
+    assert bar_context.file_obj.file_name == "\\spam\\Bar.txt"
+    assert operations.open("\\spam\\bar.txt", 0, 0).file_context.file_obj is bar_context.file_obj
+    with pytest.raises(NTStatusObjectNameNotFound):
+        operations.open("\\foo\\bar.txt", 0, 0)
+
+    # Only empty folders can be deleted
+    spam_context = operations.open("\\spam", 0, 0).file_context
+    with pytest.raises(NTStatusDirectoryNotEmpty):
+        operations.can_delete(spam_context, "\\spam")
+    delete(operations, bar_context)
+    operations.can_delete(spam_context, "\\spam")
+    delete(operations, spam_context)
+    assert list_directory(operations, "\\") == []
+
+
+def test_read_directory():
+    operations = InMemoryFileSystemOperations("memfs")
+    operations.read_directory_page_size = 2
+    create(operations, "\\dir", directory=True)
+    contexts = {name: create(operations, "\\dir\\" + name) for name in ["c", "a", "E", "b", "d"]}
+
+    # Children are sorted by name, after "." and ".." (except at the root)
+    assert list_directory(operations, "\\dir") == [".", "..", "E", "a", "b", "c", "d"]
+    assert list_directory(operations, "\\dir", ".") == ["..", "E", "a", "b", "c", "d"]
+    assert list_directory(operations, "\\dir", "..") == ["E", "a", "b", "c", "d"]
+    assert list_directory(operations, "\\") == ["dir"]
+
+    # Renaming (possibly replacing) and deleting keep the children sorted
+    operations.rename(None, "\\dir\\E", "\\dir\\e", False)
+    operations.rename(None, "\\dir\\a", "\\dir\\f", False)
+    operations.rename(None, "\\dir\\b", "\\dir\\d", True)
+    delete(operations, contexts["c"])
+    assert list_directory(operations, "\\dir", "..") == ["d", "e", "f"]
+
+    # Listings resume right after the marker, even if it has been deleted
+    assert list_directory(operations, "\\dir", "c") == ["d", "e", "f"]
+    assert list_directory(operations, "\\dir", "f") == []
+
+    # Entries deleted during the listing are skipped
+    dir_context = operations.open("\\dir", 0, 0).file_context
+    entries = operations.read_directory(dir_context, "..")
+    assert next(entries).file_name == "d"
+    delete(operations, operations.open("\\dir\\f", 0, 0).file_context)
+    assert [entry.file_name for entry in entries] == ["e"]
+    assert dir_context.file_obj.sorted_names == ["d", "e"]
+
+
+def test_file_chunks():
+    chunk_size = FileObj.chunk_size
+    file_obj = FileObj(PureWindowsPath("\\foo"), FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, None)
+
+    # Reads and writes cross the chunk boundaries
+    data = bytes(range(256)) * (chunk_size // 128)
+    file_obj.write(data, chunk_size // 2, False)
+    assert file_obj.file_size == chunk_size // 2 + 2 * chunk_size
+    assert sorted(file_obj.chunks) == [0, 1, 2]
+    assert file_obj.read(chunk_size // 2, len(data)) == data
+    assert file_obj.read(0, chunk_size // 2) == bytes(chunk_size // 2)
+    buffer = bytearray(10)
+    assert file_obj.read_into(chunk_size - 5, buffer) == 10
+    assert buffer == data[chunk_size // 2 - 5 : chunk_size // 2 + 5]
+
+    # Holes are not allocated and read as zeros
+    file_obj.write(b"end", 10 * chunk_size, False)
+    assert sorted(file_obj.chunks) == [0, 1, 2, 10]
+    assert file_obj.read(5 * chunk_size, 10) == bytes(10)
+    assert file_obj.read(10 * chunk_size, 100) == b"end"
+    with pytest.raises(NTStatusEndOfFile):
+        file_obj.read(10 * chunk_size + 3, 1)
+    file_obj.write(b"!", 0, True)
+    assert file_obj.read(10 * chunk_size, 100) == b"end!"
+
+    # Truncating mid-chunk drops the data past the new size, which reads as
+    # zeros once the file grows again
+    file_obj.set_file_size(chunk_size + 10)
+    assert sorted(file_obj.chunks) == [0, 1]
+    file_obj.set_file_size(3 * chunk_size)
+    expected = data[chunk_size // 2 : chunk_size // 2 + 10] + bytes(10)
+    assert file_obj.read(chunk_size, 20) == expected
+
+    # Constrained writes don't extend the file
+    assert file_obj.constrained_write(b"x" * 10, 3 * chunk_size - 5) == 5
+    assert file_obj.file_size == 3 * chunk_size
+    assert file_obj.constrained_write(b"x", 3 * chunk_size) == 0
+
+    file_obj.set_allocation_size(0)
+    assert (file_obj.file_size, file_obj.chunks) == (0, {})
+
+
+def test_spill_storage():
+    chunk_size = FileObj.chunk_size
+    storage = SpillStorage(
+        chunk_size,
+        ram_budget=2 * chunk_size,
+        spill_threshold=4 * chunk_size,
+        arena_size=2 * chunk_size,
+    )
+
+    def new_file(name):
+        return FileObj(
+            PureWindowsPath(name), FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, None, storage=storage
+        )
+
+    def get_usage():
+        stats = storage.get_stats()
+        return stats["ram_usage"], stats["spilled_usage"], stats["spill_capacity"]
+
+    foo = new_file("\\foo")
+    bar = new_file("\\bar")
+    foo.write(b"f" * chunk_size, 0, False)
+    bar.write(b"b" * chunk_size, 0, False)
+    assert storage.pick_cold_files() == []
+
+    # Past the RAM budget, the least recently used files are spilled
+    foo.read(0, 1)
+    new_file("\\spam").write(b"s", 0, False)
+    assert storage.pick_cold_files() == [bar]
+    storage.spill(bar)
+    assert bar.spilled
+    assert get_usage() == (2 * chunk_size, chunk_size, 2 * chunk_size)
+
+    # Spilled data is accessed through the mapping
+    assert bar.read(0, chunk_size) == b"b" * chunk_size
+    bar.write(b"B", 1, False)
+    assert bar.read(0, 3) == b"bBb"
+
+    # Files past the threshold are spilled right away, arenas being added as needed
+    qux = new_file("\\qux")
+    qux.write(b"q" * (4 * chunk_size + 1), 0, False)
+    assert qux.spilled and not qux.chunk_slots.keys() ^ qux.chunks.keys()
+    assert qux.read(4 * chunk_size - 1, 2) == b"qq"
+    assert get_usage() == (2 * chunk_size, 6 * chunk_size, 6 * chunk_size)
+
+    # Freed slots are reused
+    qux.set_file_size(chunk_size)
+    assert get_usage() == (2 * chunk_size, 2 * chunk_size, 6 * chunk_size)
+    qux.write(b"Q" * 2 * chunk_size, chunk_size, False)
+    assert get_usage() == (2 * chunk_size, 4 * chunk_size, 6 * chunk_size)
+
+    # Shared slots are freed once no longer used
+    bar_copy = bar.copy(storage)
+    assert bar_copy.read(0, 3) == b"bBb"
+    bar.release()
+    assert get_usage() == (2 * chunk_size, 4 * chunk_size, 6 * chunk_size)
+    bar_copy.release()
+    assert get_usage() == (2 * chunk_size, 3 * chunk_size, 6 * chunk_size)
+
+
+def test_spill_storage_shared():
+    chunk_size = FileObj.chunk_size
+    storage = SpillStorage(chunk_size, ram_budget=3 * chunk_size)
+
+    def new_file(name):
+        return FileObj(
+            PureWindowsPath(name), FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, None, storage=storage
+        )
+
+    def get_usage():
+        stats = storage.get_stats()
+        return stats["ram_usage"], stats["shared_ram_usage"]
+
+    foo = new_file("\\foo")
+    foo.write(b"f" * 2 * chunk_size, 0, False)
+    bar = new_file("\\bar")
+    bar.write(b"b" * chunk_size, 0, False)
+    assert storage.pick_cold_files() == []
+
+    # Shared chunks still count in the RAM budget
+    foo_copy = foo.copy(storage)
+    assert get_usage() == (chunk_size, 2 * chunk_size)
+    foo.read(0, 1)
+    spam = new_file("\\spam")
+    spam.write(b"s", 0, False)
+    assert storage.pick_cold_files() == [bar]
+
+    # Until no longer used by any file
+    foo_copy.write(b"F", 0, False)
+    assert get_usage() == (3 * chunk_size, 2 * chunk_size)
+    foo.release()
+    assert get_usage() == (3 * chunk_size, chunk_size)
+    foo_copy.release()
+    assert get_usage() == (2 * chunk_size, 0)
+
+
+def test_dedupe_store():
+    chunk_size = FileObj.chunk_size
+    storage = SpillStorage(chunk_size, spill_threshold=3 * chunk_size)
+    store = DedupeStore(chunk_size)
+
+    def new_file(name, data):
+        file_obj = FileObj(
+            PureWindowsPath(name), FILE_ATTRIBUTE.FILE_ATTRIBUTE_NORMAL, None, storage=storage
+        )
+        file_obj.write(data, 0, False)
+        store.dedupe(file_obj)
+        return file_obj
+
+    def get_usage():
+        stats = storage.get_stats()
+        return stats["ram_usage"], stats["shared_ram_usage"], stats["spilled_usage"]
+
+    # Identical chunks are shared, and chunks of zeros dropped
+    foo_data = b"x" * chunk_size + bytes(chunk_size) + b"y" * 10
+    foo = new_file("\\foo", foo_data)
+    bar = new_file("\\bar", b"x" * chunk_size)
+    assert foo.chunks == bar.chunks == {}
+    assert sorted(foo.get_chunk_indexes()) == [0, 2]
+    assert bar.get_chunk(0) is foo.get_chunk(0)
+    assert foo.read(0, foo.file_size) == foo_data
+    assert store.get_stats()["blocks"] == 2
+    assert store.get_stats()["references"] == 3
+    assert get_usage() == (0, 2 * chunk_size, 0)
+
+    # Spilled chunks stay spilled
+    spam = new_file("\\spam", b"s" * 4 * chunk_size)
+    assert spam.spilled
+    assert spam.read(0, 4 * chunk_size) == b"s" * 4 * chunk_size
+    assert get_usage() == (0, 2 * chunk_size, chunk_size)
+
+    # A shared chunk is copied once written to
+    bar.write(b"X", 0, False)
+    assert bar.read(0, 2) == b"Xx"
+    assert foo.read(0, 2) == b"xx"
+    assert get_usage() == (chunk_size, 2 * chunk_size, chunk_size)
+
+    # Blocks are freed once no longer used
+    foo.release()
+    spam.release()
+    assert store.get_stats()["blocks"] == 0
+    assert get_usage() == (chunk_size, 0, 0)
+
+
+def test_dedupe_deleted_files(monkeypatch, caplog):
+    operations = InMemoryFileSystemOperations("memfs", dedupe=True)
+    try:
+        store = operations.dedupe_store
+        store.settle_delay = 3600
+        foo_context = create(operations, "\\foo")
+        operations.write(foo_context, b"foo", 0, False, False)
+        foo = foo_context.file_obj
+
+        # A deleted file is no longer deduplicated, and not released while being so
+        with operations._file_locks.write(foo):
+            thread = threading.Thread(target=delete, args=(operations, foo_context))
+            thread.start()
+            thread.join(0.1)
+            assert foo.chunks
+        thread.join()
+        assert not foo.chunks
+        assert foo not in store._scheduled
+
+        # Deduplication goes on after a failure
+        deduped = []
+        done = threading.Event()
+
+        def dedupe(file_obj):
+            deduped.append(file_obj)
+            if len(deduped) == 1:
+                raise RuntimeError("Boom")
+            done.set()
+
+        monkeypatch.setattr(store, "dedupe", dedupe)
+        store.settle_delay = 0
+        with caplog.at_level(logging.ERROR):
+            for file_name in ("\\bar", "\\spam"):
+                file_context = create(operations, file_name)
+                operations.write(file_context, b"data", 0, False, False)
+            assert done.wait(5)
+        assert [file_obj.file_name for file_obj in deduped] == ["\\bar", "\\spam"]
+        assert "Cannot deduplicate" in caplog.text
+    finally:
+        operations.shutdown()
+
+
+def test_image(tmp_path):
+    chunk_size = FileObj.chunk_size
+    operations = InMemoryFileSystemOperations("memfs")
+    create(operations, "\\dir", directory=True)
+    foo_context = create(operations, "\\dir\\foo", sddl="O:BAG:BAD:P(A;;FA;;;SY)")
+    operations.write(foo_context, b"foo", 0, False, False)
+    operations.write(foo_context, bytes(chunk_size), chunk_size, False, False)
+    operations.write(foo_context, b"end", 3 * chunk_size, False, False)
+    bar_context = create(operations, "\\bar")
+    operations.set_basic_info(bar_context, FILE_ATTRIBUTE.FILE_ATTRIBUTE_HIDDEN, 1, 2, 3, 4, None)
+    operations.set_volume_label("label")
+    path = tmp_path / "image"
+    operations.save_image(path)
+
+    loaded = InMemoryFileSystemOperations("other")
+    loaded.load_image(path)
+    assert get_state(loaded) == get_state(operations)
+
+    # Holes are kept, and the data is shared with the image until modified
+    loaded_foo_context = loaded.open("\\dir\\foo", 0, 0).file_context
+    assert sorted(loaded_foo_context.file_obj.get_chunk_indexes()) == [0, 1, 3]
+    assert loaded_foo_context.file_obj.chunks == {}
+    loaded.write(loaded_foo_context, b"F", 0, False, False)
+    assert sorted(loaded_foo_context.file_obj.chunks) == [0]
+    assert loaded.read(loaded_foo_context, 0, 3) == b"Foo"
+
+    # Saving over the loaded image detaches from it
+    loaded.save_image(path)
+    assert sorted(loaded_foo_context.file_obj.chunks) == [0, 1, 3]
+    assert loaded_foo_context.file_obj.shared_chunks == {}
+    reloaded = InMemoryFileSystemOperations("other")
+    reloaded.load_image(path)
+    assert get_state(reloaded) == get_state(loaded)
+
+
+def test_image_invalid(tmp_path):
+    path = tmp_path / "image"
+    InMemoryFileSystemOperations("memfs").save_image(path)
+    data = path.read_bytes()
+    operations = InMemoryFileSystemOperations("memfs")
+
+    path.write_bytes(b"NOTMEMFS" + data[8:])
+    with pytest.raises(ValueError):
+        operations.load_image(path)
+    path.write_bytes(data[:8] + struct.pack("<I", 2) + data[12:])
+    with pytest.raises(ValueError):
+        operations.load_image(path)
+
+
+def test_journal(tmp_path):
+    journal = Journal(tmp_path)
+    assert journal.recover() == []
+    records = [b"foo", b"bar" * 100, b""]
+    for record in records:
+        journal.append(record)
+    journal.sync()
+    journal.close()
+
+    # Records survive reopening
+    journal = Journal(tmp_path)
+    assert journal.recover() == records
+    journal.append(b"spam")
+    journal.close()
+
+    # A record cut off is dropped, and the journal truncated to the last good one
+    path = tmp_path / "journal-00000000"
+    data = path.read_bytes()
+    path.write_bytes(data[:-2])
+    journal = Journal(tmp_path)
+    assert journal.recover() == records
+    journal.close()
+    assert path.stat().st_size == len(data) - len(b"spam") - 8
+
+    # Same thing for a corrupted record
+    path.write_bytes(data[:20] + b"!" + data[21:])
+    journal = Journal(tmp_path)
+    assert journal.recover() == records[:1]
+    journal.close()
+    assert path.stat().st_size == len(b"foo") + 8
+
+
+def test_journal_replay(tmp_path):
+    operations = InMemoryFileSystemOperations("memfs", journal_dir=tmp_path)
+    create(operations, "\\dir", directory=True)
+    foo_context = create(operations, "\\dir\\foo")
+    operations.write(foo_context, b"foo" * 1000, 0, False, False)
+    operations.write(foo_context, b"!", 0, True, False)
+    operations.set_file_size(foo_context, 2000, False)
+    operations.rename(foo_context, "\\dir\\foo", "\\dir\\bar", False)
+    operations.rename(None, "\\dir", "\\spam", False)
+    operations.set_security(
+        foo_context,
+        lib.WFSPY_DACL_SECURITY_INFORMATION,
+        SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)").handle,
+    )
+    operations.set_basic_info(foo_context, FILE_ATTRIBUTE.FILE_ATTRIBUTE_HIDDEN, 1, 2, 3, 4, None)
+    delete(operations, create(operations, "\\spam\\deleted"))
+    operations.set_volume_label("label")
+    operations.flush(None)
+    state = get_state(operations)
+    operations.shutdown()
+
+    # Replaying the journal rebuilds the same tree
+    recovered = InMemoryFileSystemOperations("other", journal_dir=tmp_path)
+    try:
+        assert get_state(recovered) == state
+        assert list_directory(recovered, "\\spam", "..") == ["bar"]
+        # New entries don't reuse the index numbers
+        index_numbers = {file_info.index_number for file_info, _, _ in state[0].values()}
+        new_context = create(recovered, "\\new")
+        assert new_context.file_obj.index_number > max(index_numbers)
+    finally:
+        recovered.shutdown()
+
+
+def test_journal_checkpoint(tmp_path, monkeypatch, caplog):
+    operations = InMemoryFileSystemOperations("memfs", journal_dir=tmp_path)
+    foo_context = create(operations, "\\foo")
+    operations.write(foo_context, b"foo", 0, False, False)
+    operations.checkpoint()
+    operations.write(foo_context, b"bar", 3, False, False)
+    state = get_state(operations)
+    operations.shutdown()
+    assert sorted(path.name for path in tmp_path.iterdir()) == [
+        "image-00000002",
+        "journal-00000002",
+    ]
+
+    # Only the last generation is read
+    (tmp_path / "image-00000001").write_bytes(b"stale")
+    (tmp_path / "journal-00000001").write_bytes(b"stale")
+    recovered = InMemoryFileSystemOperations("other", journal_dir=tmp_path)
+    try:
+        assert get_state(recovered) == state
+        assert not (tmp_path / "journal-00000001").exists()
+
+        # Previous generations failing to be removed are removed on the next checkpoint
+        def failing_unlink(path):
+            raise OSError(f"{path} is in use")
+
+        unlink = Path.unlink
+        monkeypatch.setattr(Path, "unlink", failing_unlink)
+        with caplog.at_level(logging.WARNING):
+            recovered.checkpoint()
+        assert "Cannot remove" in caplog.text
+        assert (tmp_path / "image-00000002").exists()
+        monkeypatch.setattr(Path, "unlink", unlink)
+        recovered.checkpoint()
+        assert sorted(path.name for path in tmp_path.iterdir()) == [
+            "image-00000004",
+            "journal-00000004",
+        ]
+        # The data shared with the image loaded on recovery now comes from the last one
+        assert recovered.read(recovered.open("\\foo", 0, 0).file_context, 0, 6) == b"foobar"
+    finally:
+        recovered.shutdown()
+
+
+def test_journal_load_image(tmp_path):
+    operations = InMemoryFileSystemOperations("memfs")
+    create(operations, "\\dir", directory=True)
+    foo_context = create(operations, "\\dir\\foo")
+    operations.write(foo_context, b"foo", 0, False, False)
+    image_path = tmp_path / "image"
+    operations.save_image(image_path)
+
+    # The changes made after loading are replayed against the loaded image
+    journal_dir = tmp_path / "journal"
+    journaled = InMemoryFileSystemOperations("other", journal_dir=journal_dir)
+    create(journaled, "\\previous")
+    journaled.load_image(image_path)
+    bar_context = create(journaled, "\\dir\\bar")
+    journaled.write(bar_context, b"bar", 0, False, False)
+    foo_context = journaled.open("\\dir\\foo", 0, 0).file_context
+    journaled.write(foo_context, b"F", 0, False, False)
+    state = get_state(journaled)
+    journaled.shutdown()
+
+    recovered = InMemoryFileSystemOperations("other", journal_dir=journal_dir)
+    try:
+        assert get_state(recovered) == state
+        assert list_directory(recovered, "\\", "..") == ["dir"]
+    finally:
+        recovered.shutdown()
+
+    # The journal would be replaced by the image on each restart
+    with pytest.raises(ValueError):
+        create_memory_file_system(
+            tmp_path / "mountpoint", image=image_path, journal_dir=journal_dir
+        )
+
+
+def test_clone():
+    operations = InMemoryFileSystemOperations("memfs")
+    create(operations, "\\dir", directory=True)
+    foo_context = create(operations, "\\dir\\foo")
+    operations.write(foo_context, b"foo" * 50000, 0, False, False)
+    operations.set_basic_info(foo_context, FILE_ATTRIBUTE.FILE_ATTRIBUTE_HIDDEN, 0, 0, 0, 0, None)
+    state = get_state(operations)
+
+    clone = operations.clone()
+    assert get_state(clone) == state
+
+    # Writing to the clone leaves the original untouched
+    clone_context = clone.open("\\dir\\foo", 0, 0).file_context
+    clone.write(clone_context, b"bar", 0, False, False)
+    create(clone, "\\dir\\bar")
+    assert get_state(operations) == state
+    assert clone.read(clone_context, 0, 6) == b"barfoo"
+
+    # And the other way around
+    clone_state = get_state(clone)
+    operations.write(foo_context, b"spam", 99999, False, False)
+    operations.set_file_size(foo_context, 10, False)
+    delete(operations, create(operations, "\\dir\\spam"))
+    assert get_state(clone) == clone_state
+    assert clone.read(clone_context, 99999, 4) == b"foof"
+
+
+def test_snapshot():
+    operations = InMemoryFileSystemOperations("memfs")
+    foo_context = create(operations, "\\foo")
+    operations.write(foo_context, b"foo", 0, False, False)
+    state = get_state(operations)
+
+    snapshot = operations.snapshot()
+    snapshot_context = snapshot.open("\\foo", 0, 0).file_context
+    with pytest.raises(NTStatusMediaWriteProtected):
+        snapshot.write(snapshot_context, b"bar", 0, False, False)
+    with pytest.raises(NTStatusMediaWriteProtected):
+        create(snapshot, "\\bar")
+    with pytest.raises(NTStatusMediaWriteProtected):
+        snapshot.rename(snapshot_context, "\\foo", "\\bar", False)
+
+    # The snapshot is not affected by the original changing
+    operations.write(foo_context, b"bar", 0, False, False)
+    assert get_state(snapshot) == state
@@ -0,0 +1,317 @@
+import asyncio
+import queue
+from pathlib import PureWindowsPath
+from types import SimpleNamespace
+from typing import NamedTuple
+
+import pytest
+
+from winfspy import (
+    BaseAsyncFileSystemOperations,
+    BaseFileSystemOperations,
+    FileContextTable,
+    FileInfo,
+    FileNameCache,
+    NegativeLookupCache,
+    NTStatusEndOfFile,
+    OpenResult,
+    OperationStatistics,
+    WriteResult,
+    split_file_name,
+)
+from winfspy import operations as operations_module
+from winfspy.plumbing import NTSTATUS, ffi, lib
+
+
+def test_split_file_name():
+    assert split_file_name("\\") == ()
+    assert split_file_name("\\foo") == ("foo",)
+    assert split_file_name("\\foo\\bar") == ("foo", "bar")
+
+
+def test_file_name_cache():
+    cache = FileNameCache(maxsize=2, split=PureWindowsPath)
+    foo = ffi.new("wchar_t[]", "\\foo")
+    bar = ffi.new("wchar_t[]", "\\bar")
+    spam = ffi.new("wchar_t[]", "\\spam")
+
+    name = cache.cook(foo)
+    assert name == "\\foo"
+    assert cache.cook(ffi.new("wchar_t[]", "\\foo")) is name
+    assert cache.split(name) == PureWindowsPath("\\foo")
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Least recently used entry is evicted
+    cache.cook(bar)
+    cache.cook(foo)
+    cache.cook(spam)
+    assert (cache.hits, cache.misses) == (2, 3)
+    cache.cook(bar)
+    assert (cache.hits, cache.misses) == (2, 4)
+    assert cache.hit_rate == 2 / 6
+
+    # Names not in cache are split on the fly
+    assert cache.split("\\other") == PureWindowsPath("\\other")
+    with pytest.raises(ValueError):
+        FileNameCache().split("\\foo")
+
+
+def test_operation_statistics():
+    statistics = OperationStatistics()
+    assert statistics.recommended_dispatcher_threads() is None
+
+    statistics.record("ll_read", 0.010, 0.002)
+    statistics.record("ll_read", 0.010, 0.002)
+    statistics.record("ll_open", 0.005, 0.001)
+    assert statistics.get_stats()["ll_read"] == (2, 0.020, 0.004)
+    assert statistics.recommended_dispatcher_threads(max_threads=16) == 5
+    assert statistics.recommended_dispatcher_threads(max_threads=2) == 2
+
+    statistics.clear()
+    assert statistics.get_stats() == {}
+
+
+def test_file_context_table():
+    table = FileContextTable(capacity=1)
+    foo = object()
+    bar = object()
+
+    foo_handle = table.add(foo)
+    assert foo_handle != ffi.NULL
+    assert table.get(foo_handle) is foo
+
+    # The table grows once full
+    bar_handle = table.add(bar)
+    assert table.get(bar_handle) is bar
+    assert table.get_stats() == {"used": 2, "capacity": 2, "peak_usage": 2}
+
+    # A stale handle is not resolved to the context reusing its slot
+    assert table.remove(foo_handle) is foo
+    spam_handle = table.add(object())
+    assert spam_handle != foo_handle
+    with pytest.raises(ValueError):
+        table.get(foo_handle)
+    assert len(table.contexts()) == 2
+
+
+def test_negative_lookup_cache():
+    cache = NegativeLookupCache(maxsize=2)
+
+    missing, token = cache.lookup("\\foo\\desktop.ini")
+    assert not missing
+    cache.add("\\foo\\desktop.ini", token)
+    assert cache.lookup("\\foo\\desktop.ini") == (True, None)
+    assert cache.hits == 1
+
+    # Creating a name invalidates the entries of its directory only
+    _, token = cache.lookup("\\bar\\desktop.ini")
+    cache.add("\\bar\\desktop.ini", token)
+    cache.invalidate("\\foo\\other.txt")
+    assert cache.lookup("\\foo\\desktop.ini")[0] is False
+    assert cache.lookup("\\bar\\desktop.ini")[0] is True
+
+    # A name created between the lookup and the add is not recorded
+    _, token = cache.lookup("\\foo\\new.txt")
+    cache.invalidate("\\foo\\new.txt")
+    cache.add("\\foo\\new.txt", token)
+    assert cache.lookup("\\foo\\new.txt")[0] is False
+
+    # Clearing invalidates everything
+    cache.clear()
+    assert cache.lookup("\\bar\\desktop.ini")[0] is False
+
+    # Bounded
+    for name in ("\\a", "\\b", "\\c"):
+        cache.add(name, cache.lookup(name)[1])
+    assert len(cache) == 2
+    assert cache.lookup("\\a")[0] is False
+    assert cache.lookup("\\c")[0] is True
+
+
+def test_negative_lookup_cache_case_insensitive():
+    cache = NegativeLookupCache(case_sensitive=False)
+    cache.add("\\Foo\\Bar", cache.lookup("\\Foo\\Bar")[1])
+    assert cache.lookup("\\foo\\bar")[0] is True
+    cache.invalidate("\\FOO\\BAR")
+    assert cache.lookup("\\Foo\\Bar")[0] is False
+
+
+class TupleFileContext(NamedTuple):
+    file_name: str
+    file_size: int
+
+
+class TupleContextOperations(BaseFileSystemOperations):
+    def __init__(self, with_file_info):
+        super().__init__()
+        self.with_file_info = with_file_info
+
+    def open(self, file_name, create_options, granted_access):
+        file_context = TupleFileContext(file_name, 42)
+        if self.with_file_info:
+            return OpenResult(file_context, FileInfo(file_size=1))
+        return file_context
+
+    def get_file_info(self, file_context):
+        return FileInfo(file_size=file_context.file_size)
+
+
+@pytest.mark.parametrize("with_file_info", [False, True])
+def test_open_result(with_file_info):
+    # A file context being itself a tuple is not mistaken for an `OpenResult`
+    operations = TupleContextOperations(with_file_info)
+    p_file_context = ffi.new("void**")
+    file_info = ffi.new("FSP_FSCTL_FILE_INFO*")
+    operations.ll_open(ffi.new("wchar_t[]", "\\foo"), 0, 0, p_file_context, file_info)
+    file_context = operations.file_contexts.get(p_file_context[0])
+    assert file_context == TupleFileContext("\\foo", 42)
+    assert file_info.FileSize == (1 if with_file_info else 42)
+
+
+class TransactLib:
+    """
+    Stand-in for `lib` recording the responses to the pending operations,
+    along with the calls on the directory buffer.
+    """
+
+    def __init__(self, buffer_needs_filling=False):
+        self.buffer_needs_filling = buffer_needs_filling
+        self.responses = queue.Queue()
+        self.calls = []
+
+    def __getattr__(self, name):
+        return getattr(lib, name)
+
+    def get_FSP_FSCTL_TRANSACT_REQ_identity(self, p_kind, p_hint):
+        p_kind[0] = 1
+        p_hint[0] = 42
+
+    def send_FSP_FSCTL_TRANSACT_RSP(
+        self, file_system_ptr, kind, hint, status, information, file_info
+    ):
+        file_size = None if file_info == ffi.NULL else file_info.FileSize
+        self.responses.put((kind, hint, status, information, file_size))
+
+    def FspFileSystemAcquireDirectoryBuffer(self, p_dir_buffer, reset, p_result):
+        self.calls.append("acquire")
+        p_result[0] = NTSTATUS.STATUS_SUCCESS
+        return reset or self.buffer_needs_filling
+
+    def FspFileSystemReleaseDirectoryBuffer(self, p_dir_buffer):
+        self.calls.append("release")
+
+    def fill_FSP_FSCTL_DIR_INFO_batch(
+        self, file_infos, file_names, name_offsets, count, p_dir_buffer, p_result
+    ):
+        self.calls.append("fill")
+        return count
+
+    def FspFileSystemReadDirectoryBuffer(
+        self, p_dir_buffer, marker, buffer, length, p_bytes_transferred
+    ):
+        self.calls.append("read")
+        p_bytes_transferred[0] = 7
+
+
+class AsyncOperations(BaseAsyncFileSystemOperations):
+    def __init__(self):
+        super().__init__(directory_buffer=True)
+        self.listings = 0
+        # Bound to a started file system, so the responses get sent
+        self._bind_file_system(SimpleNamespace(started=True, _file_system_ptr=[ffi.NULL]))
+
+    async def read(self, file_context, offset, length):
+        if offset == 3:
+            raise NTStatusEndOfFile()
+        if offset > 3:
+            raise RuntimeError("Boom")
+        return b"foo"[:length]
+
+    async def write(self, file_context, buffer, offset, write_to_end_of_file, constrained_io):
+        return WriteResult(len(buffer), FileInfo(file_size=offset + len(buffer)))
+
+    async def read_directory(self, file_context, marker):
+        self.listings += 1
+        return [FileInfo(file_name="foo"), FileInfo(file_name="bar")]
+
+
+@pytest.fixture
+def async_operations():
+    operations = AsyncOperations()
+    yield operations
+    operations.loop.call_soon_threadsafe(operations.loop.stop)
+
+
+def test_async_operations(monkeypatch, async_operations):
+    transact_lib = TransactLib()
+    monkeypatch.setattr(operations_module, "lib", transact_lib)
+    file_context = async_operations.file_contexts.add(object())
+    buffer = ffi.new("char[]", 3)
+    p_bytes_transferred = ffi.new("ULONG*")
+
+    # The request is completed once the coroutine is done
+    status = async_operations.ll_read(file_context, buffer, 0, 3, p_bytes_transferred)
+    assert status == NTSTATUS.STATUS_PENDING
+    assert transact_lib.responses.get(timeout=5) == (1, 42, NTSTATUS.STATUS_SUCCESS, 3, None)
+    assert ffi.buffer(buffer)[:] == b"foo"
+
+    # Errors are reported in the response
+    async_operations.ll_read(file_context, buffer, 3, 3, p_bytes_transferred)
+    assert transact_lib.responses.get(timeout=5) == (1, 42, NTSTATUS.STATUS_END_OF_FILE, 0, None)
+    async_operations.ll_read(file_context, buffer, 4, 3, p_bytes_transferred)
+    assert transact_lib.responses.get(timeout=5) == (
+        1,
+        42,
+        NTSTATUS.STATUS_UNEXPECTED_IO_ERROR,
+        0,
+        None,
+    )
+
+    # The response carries the file info returned along with the result
+    status = async_operations.ll_write(
+        file_context, buffer, 10, 3, False, False, p_bytes_transferred, ffi.NULL
+    )
+    assert status == NTSTATUS.STATUS_PENDING
+    assert transact_lib.responses.get(timeout=5) == (1, 42, NTSTATUS.STATUS_SUCCESS, 3, 13)
+
+    # No response once the file system is stopped
+    async_operations._file_system.started = False
+    async_operations.ll_read(file_context, buffer, 0, 3, p_bytes_transferred)
+    asyncio.run_coroutine_threadsafe(asyncio.sleep(0), async_operations.loop).result()
+    with pytest.raises(queue.Empty):
+        transact_lib.responses.get(timeout=0.1)
+
+
+@pytest.mark.parametrize("buffer_needs_filling", [False, True])
+def test_async_read_directory(monkeypatch, async_operations, buffer_needs_filling):
+    transact_lib = TransactLib(buffer_needs_filling)
+    monkeypatch.setattr(operations_module, "lib", transact_lib)
+    file_context = async_operations.file_contexts.add(object())
+    buffer = ffi.new("char[]", 1024)
+    p_bytes_transferred = ffi.new("ULONG*")
+
+    # The directory buffer is built by the pending listing
+    status = async_operations.ll_read_directory(
+        file_context, ffi.NULL, ffi.NULL, buffer, 1024, p_bytes_transferred
+    )
+    assert status == NTSTATUS.STATUS_PENDING
+    assert transact_lib.responses.get(timeout=5) == (1, 42, NTSTATUS.STATUS_SUCCESS, 7, None)
+    assert transact_lib.calls == ["acquire", "fill", "release", "read"]
+    assert async_operations.listings == 1
+
+    # A continuation is served right away from the built buffer, unless it needs filling
+    transact_lib.calls.clear()
+    marker = ffi.new("wchar_t[]", "bar")
+    status = async_operations.ll_read_directory(
+        file_context, ffi.NULL, marker, buffer, 1024, p_bytes_transferred
+    )
+    if buffer_needs_filling:
+        assert status == NTSTATUS.STATUS_PENDING
+        assert transact_lib.responses.get(timeout=5) == (1, 42, NTSTATUS.STATUS_SUCCESS, 7, None)
+        assert transact_lib.calls == ["acquire", "release", "acquire", "fill", "release", "read"]
+        assert async_operations.listings == 2
+    else:
+        assert status == NTSTATUS.STATUS_SUCCESS
+        assert p_bytes_transferred[0] == 7
+        assert transact_lib.calls == ["acquire", "read"]
+        assert async_operations.listings == 1
@@ -1,7 +1,27 @@
-from winfspy.plumbing import SecurityDescriptor
+from winfspy.plumbing import SecurityDescriptor, SecurityDescriptorPool
 
 
 def test_security_descriptor():
     string = "O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"
     sd = SecurityDescriptor.from_string(string)
     assert sd.to_string() == string
+
+
+def test_security_descriptor_pool():
+    string = "O:BAG:BAD:P(A;;FA;;;SY)(A;;FA;;;BA)(A;;FA;;;WD)"
+    pool = SecurityDescriptorPool()
+    sd1 = pool.intern(SecurityDescriptor.from_string(string))
+    copy = SecurityDescriptor.from_string(string)
+    sd2 = pool.acquire(copy.handle)
+    assert sd1 is sd2
+    assert len(pool) == 1
+
+    other = pool.intern(SecurityDescriptor.from_string("O:BAG:BAD:P(A;;FA;;;SY)"))
+    assert other is not sd1
+    assert len(pool) == 2
+
+    pool.release(sd1)
+    pool.release(other)
+    assert len(pool) == 1
+    pool.release(sd2)
+    assert len(pool) == 0